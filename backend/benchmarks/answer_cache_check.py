@@ -0,0 +1,88 @@
+"""Offline check of when the answer cache hits: same question and context across conversations, never with history.
+
+Builds chat turns the way prepare_chat_turn does (build_chat_prompt plus
+context_fingerprint) without touching Mongo and answers them through
+answer_chat_turn with the stub LLM provider, counting upstream calls.
+Exits non-zero if any case hits or misses other than intended.
+
+    cd backend && python -m benchmarks.answer_cache_check
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import server  # noqa: E402
+from server import (ChatMessageRequest, StubLlmProvider, answer_cache, answer_cache_key,  # noqa: E402
+                    answer_chat_turn, build_chat_prompt, context_fingerprint, history_line)
+
+USER = {"id": "tenant", "company_name": "Acme"}
+AI_SETTINGS = {"ai_model": "gemini-3-flash-preview"}
+KNOWLEDGE = ["Spedizione gratuita per ordini sopra i 50 euro.", "Consegna in 2-3 giorni lavorativi."]
+PRODUCTS = [{"id": "p1", "name": "Scarpa da corsa", "price": "€ 89,00"}]
+
+
+def make_turn(message, history=(), knowledge=KNOWLEDGE, products=PRODUCTS):
+    pieces = [history_line(m) for m in history]
+    prompt = build_chat_prompt("SalesGenius", USER["company_name"], message, knowledge, products, pieces)
+    return {
+        "user": USER,
+        "ai_settings": AI_SETTINGS,
+        "system_message": prompt["system_message"],
+        "has_history": bool(pieces),
+        "context_fingerprint": context_fingerprint("SalesGenius", USER["company_name"], AI_SETTINGS,
+                                                   knowledge, products)
+    }
+
+
+def exchange(question, answer):
+    return [{"role": "assistant", "content": answer}, {"role": "user", "content": question}]
+
+
+async def ask(provider, session_id, message, **turn_args):
+    """(hit, upstream calls made) for one turn"""
+    turn = make_turn(message, **turn_args)
+    calls = len(provider.calls)
+    await answer_chat_turn(turn, ChatMessageRequest(widget_key="w", session_id=session_id, message=message))
+    return bool(turn.get("answer_cached")), len(provider.calls) - calls
+
+
+async def main():
+    provider = StubLlmProvider(latency_ms=5)
+    server.model_router.provider = provider
+    answer_cache.clear()
+    history_a = exchange("Avete scarpe da corsa?", "Sì, ecco la Scarpa da corsa.")
+    history_b = exchange("Fate resi?", "Sì, entro 30 giorni.")
+
+    # (label, turn, expected hit)
+    cases = [
+        ("first question in a conversation", dict(session_id="s1", message="Spedizione gratuita?"), False),
+        ("same question, another conversation", dict(session_id="s2", message="spedizione  gratuita"), True),
+        ("same question after history A", dict(session_id="s3", message="Spedizione gratuita?", history=history_a), False),
+        ("same question after history B", dict(session_id="s4", message="Spedizione gratuita?", history=history_b), False),
+        ("same question, other knowledge", dict(session_id="s5", message="Spedizione gratuita?",
+                                                knowledge=KNOWLEDGE[:1]), False),
+        ("same question, other products", dict(session_id="s6", message="Spedizione gratuita?", products=[]), False),
+    ]
+    failures = 0
+    for label, args, expected in cases:
+        hit, calls = await ask(provider, **args)
+        ok = hit == expected and calls == (0 if expected else 1)
+        failures += not ok
+        print(f"{'ok' if ok else 'FAIL':<5} {label:<40} {'hit' if hit else 'miss':<5} upstream calls {calls}")
+
+    # History is left out of the fingerprint, so only the has_history skip keeps these apart
+    same_key = answer_cache_key(make_turn("x", history=history_a), "x") == answer_cache_key(make_turn("x"), "x")
+    failures += not same_key
+    print(f"{'ok' if same_key else 'FAIL':<5} {'history is not part of the cache key':<40}")
+
+    print(f"\n{failures} failure(s)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
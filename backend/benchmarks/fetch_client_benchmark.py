@@ -0,0 +1,112 @@
+"""FetchClient against a local page server: throughput, connection reuse and limit checks.
+
+Serves a catalog-sized HTML page plus an oversized page and a gzip bomb,
+then fetches the catalog page with a fresh httpx client per call and with
+the shared FetchClient, and checks that the size, decompression and
+per-host limits hold.
+
+    cd backend && python -m benchmarks.fetch_client_benchmark --pages 300
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import httpx  # noqa: E402
+
+from benchmarks.stub_server import StubServer  # noqa: E402
+from server import FetchClient, FetchError, latency_metrics  # noqa: E402
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+CATALOG_PAGE = ("<html><body>" + "".join(
+    f'<div class="product-item"><a href="/p/{i}">Prodotto {i}</a><span class="price">€ {i}.00</span></div>'
+    for i in range(200)
+) + "</body></html>").encode()
+GZIP_BOMB = gzip.compress(b"\0" * (64 * 1024 * 1024))
+
+
+class PageServer:
+    """Stub handler that also tracks how many requests were in flight at once"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def __call__(self, method, path, headers, body):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if path == "/huge":
+                return 200, {"Content-Type": "text/html"}, b"x" * (3 * 1024 * 1024)
+            if path == "/bomb":
+                return 200, {"Content-Type": "text/html", "Content-Encoding": "gzip"}, GZIP_BOMB
+            return 200, {"Content-Type": "text/html; charset=utf-8"}, CATALOG_PAGE
+        finally:
+            self.in_flight -= 1
+
+
+async def fetch_fresh(url):
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        response = await client.get(url, follow_redirects=True)
+        return response.text
+
+
+async def timed(label, fetch, urls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(url):
+        async with semaphore:
+            await fetch(url)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(url) for url in urls))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<8} {len(urls) / elapsed:>8.0f} pages/s")
+
+
+async def main(pages, concurrency, per_host):
+    handler = PageServer(delay=0.002)
+    async with StubServer(handler) as server:
+        urls = [f"{server.base_url}/c/{i}" for i in range(pages)]
+        await timed("fresh", fetch_fresh, urls, concurrency)
+        fresh_connections = server.connections
+
+        client = FetchClient(max_connections=100, max_keepalive=20, max_per_host=per_host, timeout=10.0,
+                             max_bytes=2 * 1024 * 1024, max_decoded_bytes=8 * 1024 * 1024)
+        await client.start()
+        try:
+            handler.peak_in_flight = 0
+            await timed("pooled", lambda url: client.get(url), urls, concurrency)
+            print(f"connections opened: fresh {fresh_connections}, pooled {server.connections - fresh_connections}")
+            print(f"peak in-flight per host: {handler.peak_in_flight} (cap {per_host})")
+            ttfb = latency_metrics["fetch.ttfb"].summary()
+            print(f"ttfb p50 {ttfb['p50_ms']} ms  p95 {ttfb['p95_ms']} ms")
+
+            for path in ("/huge", "/bomb"):
+                try:
+                    await client.get(server.base_url + path)
+                    print(f"{path}: NOT rejected")
+                except FetchError as e:
+                    print(f"{path}: rejected ({e})")
+        finally:
+            await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--per-host", type=int, default=6)
+    args = parser.parse_args()
+    asyncio.run(main(args.pages, args.concurrency, args.per_host))
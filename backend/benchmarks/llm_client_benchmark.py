@@ -0,0 +1,128 @@
+"""Per-call overhead of the LlmChat-per-turn path vs the pooled PooledLlmClient.
+
+Runs against a local stub of an OpenAI-compatible /chat/completions
+endpoint, so the numbers are pure client overhead, not model latency:
+
+  llmchat  what call_llm_chat does without LLM_API_BASE. emergentintegrations'
+           LlmChat sends each message through litellm.acompletion, so this
+           calls litellm the same way, pointed at the stub. litellm keeps its
+           own client cache, so connections are reused and the gap to pooled
+           is per-turn routing overhead. Skipped when litellm (pinned in
+           requirements.txt) isn't installed.
+  fresh    a new httpx client per call: connection setup on every turn, the
+           worst case for a client that doesn't pool
+  pooled   the shared PooledLlmClient used when LLM_API_BASE is set
+
+Over TLS the gap to fresh is larger: every new connection also pays a handshake.
+
+    cd backend && python -m benchmarks.llm_client_benchmark --calls 500 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import httpx  # noqa: E402
+
+from benchmarks.stub_server import StubServer  # noqa: E402
+from server import LatencyStats, PooledLlmClient  # noqa: E402
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("LiteLLM").setLevel(logging.WARNING)
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench",
+    "choices": [{"index": 0, "finish_reason": "stop",
+                 "message": {"role": "assistant", "content": "Ciao! Come posso aiutarti?"}}],
+    "usage": {"prompt_tokens": 12, "completion_tokens": 6, "total_tokens": 18}
+}).encode()
+
+
+async def completions_handler(method, path, headers, body):
+    return 200, {"Content-Type": "application/json"}, COMPLETION
+
+
+async def llmchat_call(base_url, model, session_id, system_message, message, max_tokens):
+    """One turn as LlmChat sends it: per-turn message list, routed through litellm"""
+    import litellm
+
+    response = await litellm.acompletion(
+        model=f"openai/{model}",
+        api_base=base_url,
+        api_key="bench",
+        messages=[{"role": "system", "content": system_message}, {"role": "user", "content": message}],
+        max_tokens=max_tokens,
+        user=session_id
+    )
+    return response.choices[0].message.content
+
+
+async def fresh_client_call(base_url, model, session_id, system_message, message, max_tokens):
+    """What building a client per request costs: new pool, new connection, torn down after one call"""
+    client = PooledLlmClient(base_url, "bench", 10, 10, 5.0, 10.0)
+    await client.start()
+    try:
+        return await client(model, session_id, system_message, message, max_tokens)
+    finally:
+        await client.close()
+
+
+async def run(label, call, calls, concurrency):
+    stats = LatencyStats(window=calls)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await call("gemini-3-flash-preview", f"s{i}", "Sei un assistente.", "ciao", 100)
+            stats.record((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    elapsed = time.perf_counter() - started
+    summary = stats.summary()
+    print(f"{label:<8} {calls / elapsed:>9.0f} calls/s  p50 {summary['p50_ms']:>6.2f} ms  "
+          f"p95 {summary['p95_ms']:>6.2f} ms  p99 {summary['p99_ms']:>6.2f} ms")
+
+
+async def main(calls, concurrency):
+    async with StubServer(completions_handler) as server:
+        opened = {}
+        try:
+            import litellm  # noqa: F401
+        except ImportError:
+            print("llmchat  skipped: litellm not installed (pip install -r requirements.txt)")
+        else:
+            await run("llmchat", lambda *a: llmchat_call(server.base_url, *a), calls, concurrency)
+            opened["llmchat"] = server.connections
+
+        await run("fresh", lambda *a: fresh_client_call(server.base_url, *a), calls, concurrency)
+        opened["fresh"] = server.connections - sum(opened.values())
+
+        pooled = PooledLlmClient(server.base_url, "bench", 100, 20, 60.0, 10.0)
+        await pooled.start()
+        try:
+            await run("pooled", pooled, calls, concurrency)
+        finally:
+            await pooled.close()
+        opened["pooled"] = server.connections - sum(opened.values())
+        print("connections opened: " + ", ".join(f"{label} {count}" for label, count in opened.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.concurrency))
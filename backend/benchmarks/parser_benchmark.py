@@ -0,0 +1,151 @@
+"""HTML parser backends and the parse pool: time per page and event-loop stalls.
+
+Builds a Magento-style category page (header, mega menu, scripts and N
+product cards), a product detail page and a JSON-LD page, and times
+extract_products_from_html on each with every installed backend, checking
+that all backends find the same products. It then parses a batch of
+category pages inline on the event loop and through ParsePool while a
+heartbeat coroutine measures how long the loop was blocked (with the
+backend set in HTML_PARSER).
+
+    cd backend && python -m benchmarks.parser_benchmark --products 48 --rounds 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from server import HTML_PARSERS, ParsePool, extract_products_from_html, resolve_html_parser  # noqa: E402
+
+URL = "https://shop.example.it/catalogo/scarpe"
+
+CHROME = (
+    "<header><nav class='navigation'><ul>"
+    + "".join(f"<li class='level0'><a href='/c/{i}'>Categoria {i}</a><ul>"
+              + "".join(f"<li><a href='/c/{i}/{j}'>Sotto {j}</a></li>" for j in range(12)) + "</ul></li>"
+              for i in range(15))
+    + "</ul></nav></header>"
+    + "<script>" + "var tracking = {};" * 400 + "</script>"
+    + "<style>" + ".x{color:red}" * 400 + "</style>"
+)
+
+
+def category_page(products: int) -> str:
+    cards = "".join(
+        f"<li class='item product product-item'><div class='product-item-info'>"
+        f"<a class='product photo product-item-photo' href='/p/scarpa-{i}.html'>"
+        f"<span class='product-image-wrapper'><img class='product-image-photo' src='/media/{i}.jpg' alt='Scarpa {i}'></span></a>"
+        f"<div class='product details product-item-details'><strong class='product name product-item-name'>"
+        f"<a class='product-item-link' href='/p/scarpa-{i}.html'>Scarpa da corsa modello {i}</a></strong>"
+        f"<div class='price-box'><span class='price'>€ {i + 49},90</span></div>"
+        f"<div class='product-item-actions'><button class='action tocart'>Aggiungi</button></div></div></div></li>"
+        for i in range(products)
+    )
+    return f"<html><head><title>Scarpe</title></head><body>{CHROME}<ol class='products list'>{cards}</ol></body></html>"
+
+
+def product_page() -> str:
+    return (f"<html><head><title>Scarpa modello 7 | Shop</title></head><body>{CHROME}"
+            "<h1>Scarpa da corsa modello 7</h1><div class='product-image'><img src='/media/7.jpg'></div>"
+            "<span class='price'>€ 56,90</span><div class='product-description'>Tomaia in mesh traspirante.</div>"
+            "</body></html>")
+
+
+def jsonld_page(products: int) -> str:
+    items = [{"@type": "Product", "name": f"Scarpa {i}", "url": f"/p/{i}", "image": f"/media/{i}.jpg",
+              "offers": {"price": f"{i + 49}.90", "priceCurrency": "EUR"}} for i in range(products)]
+    data = {"@type": "ItemList", "itemListElement": items}
+    return (f"<html><head><script type='application/ld+json'>{json.dumps(data)}</script></head>"
+            f"<body>{CHROME}</body></html>")
+
+
+def time_backend(parser, html, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        products = extract_products_from_html(html, URL, "bench", "bench", parser=parser)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), products
+
+
+def signature(products):
+    return sorted((p.get("name"), p.get("price"), p.get("product_url"), p.get("image_url")) for p in products)
+
+
+async def max_loop_stall(work):
+    """Run work() while a heartbeat measures the longest gap between its ticks"""
+    stall, running = 0.0, True
+
+    async def heartbeat():
+        nonlocal stall
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last)
+            last = now
+
+    ticker = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - start
+    running = False
+    await ticker
+    return stall * 1000, elapsed
+
+
+async def loop_stalls(html, pages, workers):
+    async def inline():
+        for _ in range(pages):
+            extract_products_from_html(html, URL, "bench", "bench")
+            await asyncio.sleep(0)
+
+    pool = ParsePool(workers)
+    pool.start()
+    await pool.warm_up()
+
+    async def pooled():
+        await asyncio.gather(*(pool.run(extract_products_from_html, html, URL, "bench", "bench") for _ in range(pages)))
+
+    try:
+        for label, work in (("inline", inline), (f"pool x{workers}", pooled)):
+            stall, elapsed = await max_loop_stall(work)
+            print(f"{label:<10} {pages / elapsed:>7.1f} pages/s   max loop stall {stall:>7.1f} ms")
+    finally:
+        pool.close()
+
+
+def main(products, rounds, pages, workers):
+    backends = [parser for parser in HTML_PARSERS if resolve_html_parser(parser) == parser]
+    pages_by_kind = {"category": category_page(products), "product": product_page(), "json-ld": jsonld_page(products)}
+    print(f"{'page':<10} {'KB':>5}  " + "  ".join(f"{parser:>12}" for parser in backends))
+    for kind, html in pages_by_kind.items():
+        results = {parser: time_backend(parser, html, rounds) for parser in backends}
+        reference = signature(results["html.parser"][1])
+        cells = []
+        for parser in backends:
+            ms, found = results[parser]
+            same = "" if signature(found) == reference else " !"
+            cells.append(f"{ms:>8.2f} ms{same}")
+        print(f"{kind:<10} {len(html) // 1024:>5}  " + "  ".join(cells) + f"   ({len(reference)} products)")
+    print("(! = products differ from html.parser)\n")
+    asyncio.run(loop_stalls(pages_by_kind["category"], pages, workers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=48)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    main(args.products, args.rounds, args.pages, args.workers)
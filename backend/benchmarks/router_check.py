@@ -0,0 +1,148 @@
+"""Offline check of ModelRouter against StubLlmProvider: routing, hedging, fallback, deadline and cooldown.
+
+Each case builds a fresh router with short delays over the stub provider,
+sets per-model stub latencies and failures, and checks which model answered,
+which models were called and how long it took. Exits non-zero if any case
+misbehaves.
+
+    cd backend && python -m benchmarks.router_check
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from server import LlmTimeout, ModelRouter, StubLlmProvider  # noqa: E402
+
+FAST, SLOW = "gemini-3-flash-preview", "gemini-2.5-flash"
+MODELS = [FAST, SLOW]
+
+
+def make_router(latencies, failing=(), **options):
+    provider = StubLlmProvider()
+    provider.latency_ms.update(latencies)
+    provider.failing.update(failing)
+    settings = {"deadline": 1.0, "hedge_delay": 0.1, "min_hedge_delay": 0.05, "cooldown": 0.3, **options}
+    return ModelRouter(list(MODELS), provider, **settings), provider
+
+
+async def timed(call):
+    start = time.perf_counter()
+    try:
+        result = await call
+    except Exception as e:
+        result = e
+    return result, (time.perf_counter() - start) * 1000
+
+
+async def preferred_model():
+    router, provider = make_router({FAST: 20, SLOW: 20})
+    (_, model), ms = await timed(router.complete("s", "sys", "ciao", model=SLOW))
+    return model == SLOW and provider.calls == [SLOW], f"answered by {model}, calls {provider.calls}"
+
+
+async def hedge_on_slow_primary():
+    router, provider = make_router({FAST: 800, SLOW: 20})
+    (_, model), ms = await timed(router.complete("s", "sys", "ciao", model=FAST))
+    ok = model == SLOW and provider.calls == [FAST, SLOW] and ms < 400
+    return ok, f"answered by {model} in {ms:.0f} ms, calls {provider.calls}"
+
+
+async def no_hedge_when_disabled():
+    router, provider = make_router({FAST: 300, SLOW: 20}, hedging=False)
+    (_, model), ms = await timed(router.complete("s", "sys", "ciao", model=FAST))
+    return model == FAST and provider.calls == [FAST], f"answered by {model} in {ms:.0f} ms"
+
+
+async def fallback_on_error():
+    router, provider = make_router({FAST: 20, SLOW: 20}, failing={FAST}, hedge_delay=5.0)
+    (_, model), ms = await timed(router.complete("s", "sys", "ciao", model=FAST))
+    ok = model == SLOW and provider.calls == [FAST, SLOW] and ms < 200
+    return ok, f"answered by {model} in {ms:.0f} ms, calls {provider.calls}"
+
+
+async def deadline():
+    router, provider = make_router({FAST: 2000, SLOW: 2000}, deadline=0.3)
+    result, ms = await timed(router.complete("s", "sys", "ciao", model=FAST))
+    ok = isinstance(result, LlmTimeout) and 250 < ms < 600
+    return ok, f"{type(result).__name__} after {ms:.0f} ms"
+
+
+async def all_models_failing():
+    router, provider = make_router({FAST: 10, SLOW: 10}, failing={FAST, SLOW})
+    result, _ = await timed(router.complete("s", "sys", "ciao", model=FAST))
+    ok = isinstance(result, RuntimeError) and provider.calls == [FAST, SLOW]
+    return ok, f"{type(result).__name__}, calls {provider.calls}"
+
+
+async def cooldown():
+    router, provider = make_router({FAST: 5, SLOW: 5}, failing={FAST}, max_failures=3, hedge_delay=5.0)
+    for _ in range(3):
+        await router.complete("s", "sys", "ciao", model=FAST)
+    skipped = not router.healthy(FAST) and router.candidates(FAST) == [SLOW]
+    provider.failing.clear()
+    await asyncio.sleep(0.35)
+    recovered = router.healthy(FAST) and router.candidates(FAST)[0] == FAST
+    return skipped and recovered, f"skipped while cooling down {skipped}, back after cooldown {recovered}"
+
+
+async def fastest_without_preference():
+    router, provider = make_router({FAST: 60, SLOW: 5}, hedging=False)
+    for _ in range(4):
+        await router.complete("s", "sys", "ciao")
+    ok = router.candidates(None)[0] == SLOW
+    return ok, f"order {router.candidates(None)}"
+
+
+async def stream_fallback():
+    router, provider = make_router({FAST: 10, SLOW: 10}, failing={FAST})
+    start = time.perf_counter()
+    deltas = [delta async for delta in router.stream("s", "sys", "ciao", model=FAST)]
+    ms = (time.perf_counter() - start) * 1000
+    text = "".join(deltas)
+    ok = text.startswith(f"[{SLOW}]") and provider.calls == [FAST, SLOW] and len(deltas) > 1
+    return ok, f"{len(deltas)} deltas from {text.split()[0]} in {ms:.0f} ms"
+
+
+async def stream_deadline():
+    router, provider = make_router({FAST: 2000, SLOW: 2000}, deadline=0.3)
+    result, ms = await timed(_drain(router.stream("s", "sys", "ciao", model=FAST)))
+    ok = isinstance(result, LlmTimeout) and ms < 600
+    return ok, f"{type(result).__name__} after {ms:.0f} ms"
+
+
+async def _drain(deltas):
+    return [delta async for delta in deltas]
+
+
+CASES = [
+    ("tenant's model is used while healthy", preferred_model),
+    ("slow primary is hedged", hedge_on_slow_primary),
+    ("no hedge with hedging off", no_hedge_when_disabled),
+    ("provider error falls back", fallback_on_error),
+    ("deadline raises LlmTimeout", deadline),
+    ("all models failing raises", all_models_failing),
+    ("failing model cools down and recovers", cooldown),
+    ("fastest model first without preference", fastest_without_preference),
+    ("stream falls back before first delta", stream_fallback),
+    ("stream deadline raises LlmTimeout", stream_deadline),
+]
+
+
+async def main():
+    failures = 0
+    for label, case in CASES:
+        ok, detail = await case()
+        failures += not ok
+        print(f"{'ok' if ok else 'FAIL':<5} {label:<42} {detail}")
+    print(f"\n{failures} failure(s)")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,200 @@
+"""Product extraction against a saved storefront corpus: speed, memory and accuracy.
+
+Serves the pages in benchmarks/corpus (Magento, Shopware, WooCommerce,
+Shopify, JSON-LD and a page with no products) from a local StubServer,
+fetches them through fetch_client and runs extract_products_from_html with
+every installed parser backend. For each page and for each extraction
+strategy it reports pages/sec, peak memory, precision and recall (products
+matched on product_url) and how many matched products got the right name,
+price and image. corpus/expected.json holds the ground truth.
+
+    cd backend && python -m benchmarks.scraping_benchmark --rounds 20
+    cd backend && python -m benchmarks.scraping_benchmark --update-baseline
+    cd backend && python -m benchmarks.scraping_benchmark --check
+
+--check compares the accuracy figures with corpus/baseline.json and exits
+non-zero if any of them dropped; throughput is machine dependent and is
+only printed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from urllib.parse import urljoin
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from benchmarks.stub_server import StubServer  # noqa: E402
+from server import HTML_PARSERS, extract_products_from_html, fetch_client, resolve_html_parser  # noqa: E402
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+BASELINE = CORPUS / "baseline.json"
+METRICS = ("precision", "recall", "name", "price", "image")
+
+
+def load_corpus():
+    pages = json.loads((CORPUS / "expected.json").read_text(encoding="utf-8"))["pages"]
+    for page in pages:
+        page["body"] = (CORPUS / page["file"]).read_bytes()
+    return pages
+
+
+def corpus_handler(pages):
+    by_path = {page["path"]: page["body"] for page in pages}
+
+    async def handler(method, path, headers, body):
+        if path in by_path:
+            return 200, {"Content-Type": "text/html; charset=utf-8"}, by_path[path]
+        return 404, {}, b""
+
+    return handler
+
+
+def same_name(a, b):
+    return " ".join((a or "").split()).casefold() == " ".join((b or "").split()).casefold()
+
+
+def score(page_url, expected, found):
+    """Count matches between extracted and expected products (keyed on the resolved product_url)"""
+    wanted = {urljoin(page_url, p["product_url"]): p for p in expected}
+    seen = set()
+    counts = {"expected": len(expected), "found": len(found), "matched": 0, "name": 0, "price": 0, "image": 0}
+    for product in found:
+        url = urljoin(page_url, product.get("product_url") or "")
+        truth = wanted.get(url)
+        if truth is None or url in seen:
+            continue
+        seen.add(url)
+        counts["matched"] += 1
+        counts["name"] += same_name(product.get("name"), truth["name"])
+        price = product.get("price_value")
+        counts["price"] += price is not None and abs(price - truth["price_value"]) < 0.005
+        image = product.get("image_url")
+        counts["image"] += bool(image) and urljoin(page_url, image) == urljoin(page_url, truth["image_url"])
+    return counts
+
+
+def rates(counts):
+    """Precision/recall over products, name/price/image accuracy over matched products"""
+    matched = counts["matched"]
+    return {
+        "precision": matched / counts["found"] if counts["found"] else 1.0,
+        "recall": matched / counts["expected"] if counts["expected"] else 1.0,
+        "name": counts["name"] / matched if matched else 1.0,
+        "price": counts["price"] / matched if matched else 1.0,
+        "image": counts["image"] / matched if matched else 1.0,
+    }
+
+
+def add_counts(total, counts):
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+
+
+async def fetch_page(url):
+    response = await fetch_client.get(url)
+    return response.text
+
+
+async def run_backend(parser, pages, base_url, rounds):
+    """Fetch and extract every page rounds times; returns per-page results and pages/sec"""
+    results = {}
+    for page in pages:
+        url = base_url + page["path"]
+        html = await fetch_page(url)
+        # Untraced first pass so lazy imports and selector caches don't count as page memory
+        extract_products_from_html(html, url, "bench", "bench", parser=parser)
+        tracemalloc.start()
+        found = extract_products_from_html(html, url, "bench", "bench", parser=parser)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[page["file"]] = {"counts": score(url, page["products"], found), "peak_kb": peak / 1024}
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            url = base_url + page["path"]
+            extract_products_from_html(await fetch_page(url), url, "bench", "bench", parser=parser)
+    pages_per_sec = rounds * len(pages) / (time.perf_counter() - start)
+    return results, pages_per_sec
+
+
+def report(parser, pages, results, pages_per_sec):
+    print(f"\n{parser}: {pages_per_sec:.1f} pages/s (fetch + extract)")
+    print(f"  {'page':<26} {'strategy':<10} {'found':>5} {'exp':>4} {'prec':>6} {'recall':>6} "
+          f"{'name':>6} {'price':>6} {'image':>6} {'peak KB':>8}")
+    by_strategy = {}
+    summary = {"pages_per_sec": round(pages_per_sec, 1), "pages": {}, "strategies": {}}
+    for page in pages:
+        result = results[page["file"]]
+        counts = result["counts"]
+        add_counts(by_strategy.setdefault(page["strategy"], {}), counts)
+        page_rates = rates(counts)
+        summary["pages"][page["file"]] = {key: round(value, 3) for key, value in page_rates.items()}
+        print(f"  {page['file']:<26} {page['strategy']:<10} {counts['found']:>5} {counts['expected']:>4} "
+              + " ".join(f"{page_rates[key]:>6.2f}" for key in METRICS) + f" {result['peak_kb']:>8.0f}")
+    for strategy, counts in by_strategy.items():
+        strategy_rates = rates(counts)
+        summary["strategies"][strategy] = {key: round(value, 3) for key, value in strategy_rates.items()}
+        print(f"  {'[' + strategy + ']':<26} {'':<10} {counts['found']:>5} {counts['expected']:>4} "
+              + " ".join(f"{strategy_rates[key]:>6.2f}" for key in METRICS))
+    return summary
+
+
+def regressions(baseline, summaries):
+    problems = []
+    for parser, summary in summaries.items():
+        previous = baseline.get(parser)
+        if not previous:
+            continue
+        for page, page_rates in summary["pages"].items():
+            for key, value in page_rates.items():
+                before = previous["pages"].get(page, {}).get(key)
+                if before is not None and value < before:
+                    problems.append(f"{parser} {page} {key}: {before:.3f} -> {value:.3f}")
+    return problems
+
+
+async def main(rounds, update_baseline, check):
+    pages = load_corpus()
+    backends = [parser for parser in HTML_PARSERS if resolve_html_parser(parser) == parser]
+    summaries = {}
+    async with StubServer(corpus_handler(pages)) as server:
+        try:
+            for parser in backends:
+                results, pages_per_sec = await run_backend(parser, pages, server.base_url, rounds)
+                summaries[parser] = report(parser, pages, results, pages_per_sec)
+        finally:
+            await fetch_client.close()
+
+    if update_baseline:
+        BASELINE.write_text(json.dumps(summaries, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+        print(f"\nbaseline written to {BASELINE}")
+    if check:
+        if not BASELINE.exists():
+            print("\nno baseline: run with --update-baseline first")
+            return 1
+        problems = regressions(json.loads(BASELINE.read_text(encoding="utf-8")), summaries)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        print(f"\n{len(problems)} regression(s) against {BASELINE.name}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.rounds, args.update_baseline, args.check)))
@@ -0,0 +1,74 @@
+"""Minimal local HTTP/1.1 server for benchmarks and fixtures (stdlib only).
+
+Handlers get (method, path, headers, body) and return (status, headers, body).
+Keep-alive is honoured, so clients can be compared with and without
+connection reuse.
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, Tuple
+
+Handler = Callable[[str, str, Dict[str, str], bytes], Awaitable[Tuple[int, Dict[str, str], bytes]]]
+
+REASONS = {200: "OK", 304: "Not Modified", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class StubServer:
+    def __init__(self, handler: Handler, host: str = "127.0.0.1", port: int = 0):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.connections = 0
+        self.requests = 0
+        self._server = None
+        self._handlers = {}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        # Idle keep-alive connections would otherwise keep their handlers waiting
+        for writer in self._handlers:
+            writer.close()
+        await asyncio.gather(*self._handlers.values(), return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._handlers[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                self.requests += 1
+
+                status, response_headers, payload = await self.handler(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                head = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}", f"Content-Length: {len(payload)}"]
+                head += [f"{name}: {value}" for name, value in response_headers.items()]
+                head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self._handlers.pop(writer, None)
+            writer.close()
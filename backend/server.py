@@ -1,24 +1,46 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.responses import JSONResponse
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable
 import uuid
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 import httpx
+import numpy as np
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 import PyPDF2
-import io
 import re
 import json
-from bs4 import BeautifulSoup
+import math
+import heapq
+import bisect
+import unicodedata
+import zlib
+import hashlib
+import tempfile
+import html as html_lib
+from urllib import robotparser
+from urllib.parse import urljoin, urldefrag, urlsplit, urlunsplit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from bs4 import BeautifulSoup, FeatureNotFound
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -64,6 +86,8 @@ class KnowledgeSourceCreate(BaseModel):
     name: str
     url: Optional[str] = None
     content: Optional[str] = None
+    crawl: bool = False  # follow sitemap and pagination links to the whole catalog
+    max_pages: Optional[int] = None
 
 class KnowledgeSourceResponse(BaseModel):
     id: str
@@ -73,6 +97,16 @@ class KnowledgeSourceResponse(BaseModel):
     url: Optional[str] = None
     content_preview: Optional[str] = None
     status: str
+    products_count: Optional[int] = None
+    job_id: Optional[str] = None
+    crawl: Optional[bool] = None
+    crawl_stats: Optional[Dict[str, Any]] = None
+    html_bytes: Optional[int] = None
+    text_bytes: Optional[int] = None
+    text_tokens: Optional[int] = None
+    stored_bytes: Optional[int] = None
+    pdf_pages: Optional[int] = None
+    pdf_total_pages: Optional[int] = None
     created_at: str
 
 class WidgetConfigUpdate(BaseModel):
@@ -109,6 +143,7 @@ class AdminSettingsUpdate(BaseModel):
     notification_new_conversation: Optional[bool] = None
     ai_model: Optional[str] = None
     max_tokens_per_response: Optional[int] = None
+    prompt_token_budget: Optional[int] = None
 
 # Product Models
 class ProductResponse(BaseModel):
@@ -136,6 +171,7 @@ class ChatMessageRequest(BaseModel):
     session_id: str
     message: str
     widget_key: str  # User's widget key for identification
+    idempotency_key: Optional[str] = None  # Client-generated per message; retries reuse it
 
 class ChatMessageResponse(BaseModel):
     id: str
@@ -169,12 +205,57 @@ class AnalyticsOverview(BaseModel):
 
 # ==================== AUTH HELPERS ====================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
 
-def verify_password(password: str, hashed: str) -> bool:
+# bcrypt releases the GIL, so hashing in threads keeps the event loop free; a
+# dedicated, small pool means a login burst queues here instead of taking every
+# default-executor thread and every core from chat traffic
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+async def run_password_work(name: str, fn, *args):
+    start = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    record_latency(f"auth.{name}", (time.perf_counter() - start) * 1000)
+    return result
+
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+async def hash_password(password: str) -> str:
+    return await run_password_work("hash", _hash_password, password, BCRYPT_ROUNDS)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await run_password_work("verify", _verify_password, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a stored hash ($2b$<cost>$...) wasn't made with BCRYPT_ROUNDS"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+_rehashing: set = set()
+
+async def rehash_password(user_id: str, password: str, old_hash: str):
+    """Store the password under the current cost; skipped if it changed meanwhile"""
+    if user_id in _rehashing:
+        return
+    _rehashing.add(user_id)
+    try:
+        result = await db.users.update_one(
+            {"id": user_id, "password": old_hash}, {"$set": {"password": await hash_password(password)}}
+        )
+        if result.modified_count:
+            increment_counter("auth.rehashed")
+    except Exception as e:
+        logger.error(f"Password rehash failed for {user_id}: {e}")
+    finally:
+        _rehashing.discard(user_id)
+
 def create_token(user_id: str) -> str:
     payload = {
         "user_id": user_id,
@@ -188,83 +269,1568 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         user_id = payload.get("user_id")
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        principal = principal_cache.get(user_id)
+        if principal is None:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            # Resolved here once, as the team and admin routes read them
+            principal = {**user, "org_id": user.get("org_id", user["id"]), "role": user.get("role", "admin")}
+            principal_cache.set(user_id, principal)
+        # Handlers get their own copy so nothing they change leaks into the cache
+        return dict(principal)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+# ==================== METRICS ====================
+
+class LatencyStats:
+    """Rolling window of latency samples in milliseconds"""
+    def __init__(self, window: int = 2048):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+    
+    def record(self, ms: float):
+        self.samples.append(ms)
+        self.count += 1
+    
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    
+    def summary(self, suffix: str = "_ms") -> Dict:
+        return {
+            "count": self.count,
+            f"p50{suffix}": round(self.percentile(0.50), 2),
+            f"p95{suffix}": round(self.percentile(0.95), 2),
+            f"p99{suffix}": round(self.percentile(0.99), 2),
+            f"max{suffix}": round(max(self.samples), 2) if self.samples else 0.0
+        }
+
+latency_metrics: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+size_metrics: Dict[str, LatencyStats] = defaultdict(LatencyStats)
+counter_metrics: Dict[str, int] = defaultdict(int)
+
+def record_latency(name: str, ms: float):
+    latency_metrics[name].record(ms)
+
+def record_size(name: str, value: float):
+    """Same rolling percentiles as record_latency, for sizes such as prompt token counts"""
+    size_metrics[name].record(value)
+
+def increment_counter(name: str, value: int = 1):
+    counter_metrics[name] += value
+
+class StageTimer:
+    """Per-request stage timings, flushed into latency_metrics under a common prefix"""
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.stages: Dict[str, float] = {}
+        self.started = time.perf_counter()
+    
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (time.perf_counter() - start) * 1000
+    
+    async def timed(self, name: str, awaitable):
+        with self.stage(name):
+            return await awaitable
+    
+    def finish(self) -> Dict[str, float]:
+        self.stages["total"] = (time.perf_counter() - self.started) * 1000
+        for name, ms in self.stages.items():
+            record_latency(f"{self.prefix}.{name}", ms)
+        logger.debug(f"{self.prefix} timings: " + ", ".join(f"{n}={ms:.1f}ms" for n, ms in self.stages.items()))
+        return self.stages
+    
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages.items())
+
+
+# ==================== CACHES ====================
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire after a fixed TTL.
+
+    on_evict, if given, is called with every value that leaves the cache
+    (expired, evicted, replaced or invalidated).
+    """
+    def __init__(self, name: str, maxsize: int, ttl: float, on_evict: Optional[Callable[[Any], None]] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+    
+    def _discard(self, value):
+        if self.on_evict is not None:
+            self.on_evict(value)
+    
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            increment_counter(f"{self.name}.miss")
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self._discard(value)
+            increment_counter(f"{self.name}.miss")
+            return None
+        self._data.move_to_end(key)
+        increment_counter(f"{self.name}.hit")
+        return value
+    
+    def set(self, key, value):
+        previous = self._data.get(key)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if previous is not None and previous[1] is not value:
+            self._discard(previous[1])
+        while len(self._data) > self.maxsize:
+            _, (_, evicted) = self._data.popitem(last=False)
+            self._discard(evicted)
+            increment_counter(f"{self.name}.evict")
+    
+    def invalidate(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._discard(entry[1])
+    
+    def invalidate_where(self, predicate):
+        for key in [k for k, (_, value) in self._data.items() if predicate(value)]:
+            self._discard(self._data.pop(key)[1])
+    
+    def clear(self):
+        values = [value for _, value in self._data.values()]
+        self._data.clear()
+        for value in values:
+            self._discard(value)
+    
+    def __len__(self):
+        return len(self._data)
+
+class KeyedLocks:
+    """One asyncio lock (or semaphore, from factory) per key, kept only while it is held or awaited.
+
+    Keys are tenants or hosts, so entries are dropped as soon as the last
+    holder or waiter leaves instead of accumulating for every key ever seen.
+    """
+    def __init__(self, factory: Callable[[], Any] = asyncio.Lock):
+        self.factory = factory
+        self._entries: Dict[Any, list] = {}
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [self.factory(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
+    
+    def __len__(self):
+        return len(self._entries)
+
+# Resolved tenant (user, widget config, knowledge prompt) per widget_key
+tenant_cache = TTLCache(
+    "tenant_cache",
+    maxsize=int(os.environ.get('TENANT_CACHE_SIZE', '1000')),
+    ttl=float(os.environ.get('TENANT_CACHE_TTL_SECONDS', '60'))
+)
+
+async def get_tenant_context(widget_key: str) -> Optional[Dict]:
+    """Resolve a widget key to its tenant, widget config and AI settings.
+
+    A cached context is served while the tenant's "tenant" stamp in
+    db.index_versions still matches, so a settings change handled by another
+    worker shows up within INDEX_VERSION_CHECK_SECONDS.
+    """
+    context = tenant_cache.get(widget_key)
+    if context:
+        versions = await get_index_versions(context["user"]["id"])
+        if context["version"] == versions.get("tenant", 0):
+            return context
+        tenant_cache.invalidate(widget_key)
+    
+    user = await db.users.find_one({"widget_key": widget_key}, {"_id": 0, "password": 0})
+    if not user:
+        return None
+    
+    # Read the stamp before the documents: a write racing this build leaves the context stale, not stamped current
+    versions = await get_index_versions(user["id"], refresh=True)
+    widget_config, ai_settings = await asyncio.gather(
+        db.widget_configs.find_one({"user_id": user["id"]}, {"_id": 0}),
+        db.admin_settings.find_one(
+            {"org_id": user.get("org_id", user["id"])},
+            {"_id": 0, "ai_model": 1, "max_tokens_per_response": 1, "prompt_token_budget": 1}
+        )
+    )
+    context = {
+        "user": user,
+        "widget_config": widget_config,
+        "ai_settings": ai_settings or {},
+        "version": versions.get("tenant", 0)
+    }
+    tenant_cache.set(widget_key, context)
+    return context
+
+async def invalidate_tenant(user_id: str):
+    """Drop cached tenant context after a write to the user, widget config or admin settings"""
+    await bump_index_version(user_id, "tenant")
+    tenant_cache.invalidate_where(lambda context: context["user"]["id"] == user_id)
+    invalidate_answers(user_id)
+
+# Authenticated user per user id. The token is still verified on every request;
+# writes to a user invalidate it here, other workers see them within the TTL
+principal_cache = TTLCache(
+    "principal_cache",
+    maxsize=int(os.environ.get('PRINCIPAL_CACHE_SIZE', '5000')),
+    ttl=float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '30'))
+)
+
+def invalidate_principal(user_id: str):
+    """Drop the cached principal after a write to the user's profile, role or organisation"""
+    principal_cache.invalidate(user_id)
+
+# Generated replies per (tenant, normalised question, prompt fingerprint)
+answer_cache = TTLCache(
+    "answer_cache",
+    maxsize=int(os.environ.get('ANSWER_CACHE_SIZE', '5000')),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '3600'))
+)
+
+def invalidate_answers(user_id: str):
+    """Drop cached replies after the tenant's knowledge, products or persona change"""
+    answer_cache.invalidate_where(lambda entry: entry["user_id"] == user_id)
+
+# Stamps in db.index_versions, bumped by every write to a tenant's knowledge,
+# products or settings. The per-tenant indexes below and tenant_cache above are
+# cached per process; an entry is only served while the stamp it was built at
+# still matches, so writes handled by another worker are seen within
+# INDEX_VERSION_CHECK_SECONDS
+index_version_cache = TTLCache(
+    "index_versions",
+    maxsize=int(os.environ.get('INDEX_VERSION_CACHE_SIZE', '5000')),
+    ttl=float(os.environ.get('INDEX_VERSION_CHECK_SECONDS', '2'))
+)
+
+async def get_index_versions(user_id: str, refresh: bool = False) -> Dict:
+    """The tenant's {"knowledge": n, "products": n, "tenant": n} stamps"""
+    versions = None if refresh else index_version_cache.get(user_id)
+    if versions is None:
+        versions = await db.index_versions.find_one(
+            {"user_id": user_id}, {"_id": 0, "knowledge": 1, "products": 1, "tenant": 1}
+        ) or {}
+        index_version_cache.set(user_id, versions)
+    return versions
+
+async def index_is_current(index, user_id: str, kind: str) -> bool:
+    return index.version == (await get_index_versions(user_id)).get(kind, 0)
+
+async def bump_index_version(user_id: str, kind: str, *caches: TTLCache):
+    """Mark the tenant's `kind` indexes stale on every worker.
+
+    Loaded indexes in `caches` were already patched in place for this write;
+    one that was current before it takes the new stamp instead of a rebuild.
+    """
+    versions = await db.index_versions.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {kind: 1}},
+        projection={"_id": 0, "knowledge": 1, "products": 1, "tenant": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    index_version_cache.set(user_id, versions)
+    for cache in caches:
+        index = cache.get(user_id)
+        if index is not None and index.version == versions[kind] - 1:
+            index.version = versions[kind]
+
+
+# ==================== TEXT SEARCH HELPERS ====================
+
+ITALIAN_STOP_WORDS = frozenset("""
+a ad al all alla alle allo agli ai anche avere c che chi ci come con contro cui da dal dall dalla
+dalle dallo dagli dai degli dei del dell della delle dello di dove e ed era essere fra gli ha hanno
+ho i il in io l la le lei li lo loro lui ma mi mia mie miei mio ne negli nei nel nell nella nelle
+nello noi non o per perche piu po poi quale quali quando quanto quella quelle quelli quello questa
+queste questi questo se sei si sia siamo siete sono su sua sue sugli sui sul sull sulla sulle sullo
+suo suoi ti tra tu tua tue tuo tuoi tutti tutto un una uno vi voi vorrei cerco cercando avete
+""".split())
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def fold_accents(text: str) -> str:
+    """Lowercase and strip diacritics so 'però' and 'pero' match"""
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(text: str) -> List[str]:
+    """Split text into accent-folded search terms without Italian stop words"""
+    if not text:
+        return []
+    return [t for t in _TOKEN_RE.findall(fold_accents(text)) if len(t) > 1 and t not in ITALIAN_STOP_WORDS]
+
+
+# ==================== SEMANTIC SEARCH ====================
+
+SEMANTIC_SEARCH_ENABLED = os.environ.get('SEMANTIC_SEARCH_ENABLED', 'false').lower() == 'true'
+SEMANTIC_HASH_DIM = 512
+SEMANTIC_LSA_DIM = int(os.environ.get('SEMANTIC_LSA_DIM', '96'))
+SEMANTIC_LSA_MIN_DOCS = int(os.environ.get('SEMANTIC_LSA_MIN_DOCS', '200'))
+SEMANTIC_MIN_SCORE = float(os.environ.get('SEMANTIC_MIN_SCORE', '0.2'))
+SEMANTIC_INDEX_DIR = os.environ.get('SEMANTIC_INDEX_DIR')
+
+def remove_file(path: Optional[str]):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def hashed_vector(text: str) -> np.ndarray:
+    """Signed feature-hashed term vector (words plus in-word 4-grams), L2-normalised"""
+    vec = np.zeros(SEMANTIC_HASH_DIM, dtype=np.float32)
+    for term in tokenize(text):
+        features = [term]
+        if len(term) > 4:
+            features += [f"#{term[i:i + 4]}" for i in range(len(term) - 3)]
+        for position, feature in enumerate(features):
+            h = zlib.crc32(feature.encode('utf-8'))
+            weight = 1.0 if position == 0 else 0.5
+            vec[h % SEMANTIC_HASH_DIM] += weight if h & 0x80000000 else -weight
+    vec = np.sign(vec) * np.log1p(np.abs(vec))
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def product_text(product: Dict) -> str:
+    return " ".join(str(product.get(field) or "") for field in ("name", "category", "brand", "description"))
+
+def encode_vector(vec: np.ndarray) -> bytes:
+    """Compact float16 encoding stored on product documents"""
+    return vec.astype(np.float16).tobytes()
+
+def decode_vector(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+class SemanticIndex:
+    """Dense vectors for one tenant in a contiguous matrix; a query is one matrix-vector product.
+
+    Hashed term vectors are idf-weighted and, once the collection is large
+    enough, projected onto an LSA basis fitted on the tenant's own texts so
+    that co-occurring terms end up close to each other.
+    """
+    def __init__(self, name: str = None):
+        self.name = name
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.idf = np.ones(SEMANTIC_HASH_DIM, dtype=np.float32)
+        self.basis: Optional[np.ndarray] = None
+        self.matrix: Optional[np.ndarray] = None
+        self.fitted_count = 0
+        self.version = 0
+        self._path = None
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    @property
+    def stale(self) -> bool:
+        """Idf and basis were fitted on a much smaller collection"""
+        return len(self.ids) >= SEMANTIC_LSA_MIN_DOCS and len(self.ids) > 2 * self.fitted_count
+    
+    def fit(self, ids: List[str], vectors: np.ndarray):
+        n = len(ids)
+        df = np.count_nonzero(vectors, axis=0) if n else np.zeros(SEMANTIC_HASH_DIM)
+        self.idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        weighted = vectors * self.idf if n else np.zeros((0, SEMANTIC_HASH_DIM), dtype=np.float32)
+        self.basis = None
+        if n >= SEMANTIC_LSA_MIN_DOCS:
+            # Top eigenvectors of the D x D term covariance give the truncated SVD basis
+            eigenvalues, eigenvectors = np.linalg.eigh(weighted.T @ weighted)
+            self.basis = np.ascontiguousarray(eigenvectors[:, ::-1][:, :SEMANTIC_LSA_DIM], dtype=np.float32)
+        projected = self._project(weighted)
+        self._allocate(max(64, 2 * n), projected.shape[1])
+        self.matrix[:n] = projected
+        self.ids = list(ids)
+        self.rows = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.fitted_count = n
+    
+    def _project(self, weighted: np.ndarray) -> np.ndarray:
+        projected = weighted @ self.basis if self.basis is not None else weighted
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        return (projected / np.maximum(norms, 1e-9)).astype(np.float32)
+    
+    def _allocate(self, capacity: int, width: int):
+        """(Re)allocate the row matrix, memory-mapped under SEMANTIC_INDEX_DIR when configured"""
+        old, old_path = self.matrix, self._path
+        if SEMANTIC_INDEX_DIR and self.name:
+            os.makedirs(SEMANTIC_INDEX_DIR, exist_ok=True)
+            # Unique per allocation, so a rebuild never truncates a file an older index still maps
+            self._path = os.path.join(SEMANTIC_INDEX_DIR, f"{self.name}.{uuid.uuid4().hex[:8]}.{capacity}.npy")
+            self.matrix = np.lib.format.open_memmap(self._path, mode='w+', dtype=np.float32, shape=(capacity, width))
+        else:
+            self.matrix = np.zeros((capacity, width), dtype=np.float32)
+        if old is not None and old.shape[1] == width:
+            self.matrix[:len(self.ids)] = old[:len(self.ids)]
+        remove_file(old_path)
+    
+    def close(self):
+        """Delete the memory-mapped file; searches already holding the matrix keep working"""
+        remove_file(self._path)
+        self._path = None
+    
+    def add(self, item_id: str, vector: np.ndarray):
+        row_vector = self._project((vector * self.idf)[None, :])[0]
+        if self.matrix is None:
+            self._allocate(64, row_vector.shape[0])
+        row = self.rows.get(item_id)
+        if row is None:
+            row = len(self.ids)
+            if row >= self.matrix.shape[0]:
+                self._allocate(2 * self.matrix.shape[0], self.matrix.shape[1])
+            self.ids.append(item_id)
+            self.rows[item_id] = row
+        self.matrix[row] = row_vector
+    
+    def remove(self, item_id: str):
+        row = self.rows.pop(item_id, None)
+        if row is None:
+            return
+        # Move the last row into the hole to keep the matrix contiguous
+        last = len(self.ids) - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.ids[row] = self.ids[last]
+            self.rows[self.ids[row]] = row
+        self.ids.pop()
+    
+    def search(self, query: str, k: int, min_score: float = SEMANTIC_MIN_SCORE) -> List[tuple]:
+        """(id, cosine score) pairs for the k nearest rows"""
+        n = len(self.ids)
+        if not n:
+            return []
+        query_vector = hashed_vector(query)
+        if not query_vector.any():
+            return []
+        scores = self.matrix[:n] @ self._project((query_vector * self.idf)[None, :])[0]
+        top = np.argpartition(-scores, k)[:k] if n > k else np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top if scores[row] >= min_score]
+
+semantic_indexes = TTLCache(
+    "semantic_index",
+    maxsize=int(os.environ.get('SEMANTIC_INDEX_CACHE_SIZE', '200')),
+    ttl=float(os.environ.get('SEMANTIC_INDEX_TTL_SECONDS', '3600')),
+    on_evict=lambda index: index.close()
+)
+_semantic_index_locks = KeyedLocks()
+
+def attach_embeddings(products: List[Dict]) -> List[Dict]:
+    """Compute and store the hashed vector on product documents before they are written"""
+    for product in products:
+        product["embedding"] = encode_vector(hashed_vector(product_text(product)))
+    return products
+
+async def get_semantic_index(user_id: str) -> SemanticIndex:
+    """Load the tenant's product vectors, backfilling products written before vectors existed"""
+    index = semantic_indexes.get(user_id)
+    if index and not index.stale and await index_is_current(index, user_id, "products"):
+        return index
+    
+    async with _semantic_index_locks.hold(user_id):
+        index = semantic_indexes.get(user_id)
+        if index and not index.stale and await index_is_current(index, user_id, "products"):
+            return index
+        
+        start = time.perf_counter()
+        version = (await get_index_versions(user_id, refresh=True)).get("products", 0)
+        ids, vectors, backfill = [], [], []
+        async for product in db.products.find(
+            {"user_id": user_id},
+            {"_id": 0, "id": 1, "embedding": 1, "name": 1, "category": 1, "brand": 1, "description": 1}
+        ):
+            if product.get("embedding"):
+                vector = decode_vector(product["embedding"])
+            else:
+                vector = hashed_vector(product_text(product))
+                backfill.append(UpdateOne({"id": product["id"]}, {"$set": {"embedding": encode_vector(vector)}}))
+            ids.append(product["id"])
+            vectors.append(vector)
+        if backfill:
+            await db.products.bulk_write(backfill, ordered=False)
+        
+        index = SemanticIndex(name=f"products-{user_id}")
+        index.fit(ids, np.vstack(vectors) if vectors else np.zeros((0, SEMANTIC_HASH_DIM), dtype=np.float32))
+        index.version = version
+        record_latency("semantic_index.build", (time.perf_counter() - start) * 1000)
+        semantic_indexes.set(user_id, index)
+        return index
+
+async def semantic_search_products(user_id: str, query: str, limit: int) -> List[str]:
+    """Product ids nearest to the query in the tenant's vector space"""
+    index = await get_semantic_index(user_id)
+    start = time.perf_counter()
+    results = index.search(query, limit)
+    record_latency("semantic_index.search", (time.perf_counter() - start) * 1000)
+    return [product_id for product_id, _ in results]
+
+
+# ==================== KNOWLEDGE RETRIEVAL ====================
+
+KNOWLEDGE_CHUNK_CHARS = int(os.environ.get('KNOWLEDGE_CHUNK_CHARS', '800'))
+KNOWLEDGE_TOP_K = int(os.environ.get('KNOWLEDGE_TOP_K', '4'))
+
+def chunk_text(text: str, max_chars: int = KNOWLEDGE_CHUNK_CHARS) -> List[str]:
+    """Split text into chunks of roughly max_chars, preferring paragraph and sentence breaks"""
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text or ""):
+        paragraph = re.sub(r'\s+', ' ', paragraph).strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(' ', 0, max_chars)
+                cut = cut if cut > max_chars // 2 else max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].strip()
+            if sentence:
+                pieces.append(sentence)
+    
+    # Merge small pieces back together up to the chunk size
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+KNOWLEDGE_TEXT_MAX_CHARS = int(os.environ.get('KNOWLEDGE_TEXT_MAX_CHARS', '100000'))
+KNOWLEDGE_COMPRESS_CONTENT = os.environ.get('KNOWLEDGE_COMPRESS_CONTENT', 'true').lower() == 'true'
+
+def source_content_fields(text: str) -> Dict:
+    """Fields storing a source's text with its byte and token counts; the text
+    goes zlib-compressed into content_z when KNOWLEDGE_COMPRESS_CONTENT is set"""
+    encoded = text.encode("utf-8")
+    fields = {
+        "content_preview": text[:200] if text else None,
+        "text_bytes": len(encoded),
+        "text_tokens": estimate_tokens(text)
+    }
+    if KNOWLEDGE_COMPRESS_CONTENT and text:
+        compressed = zlib.compress(encoded, 6)
+        fields.update({"content": "", "content_z": compressed, "stored_bytes": len(compressed)})
+    else:
+        fields.update({"content": text, "content_z": None, "stored_bytes": len(encoded)})
+    return fields
+
+def source_text(source: Dict) -> str:
+    if source.get("content_z"):
+        return zlib.decompress(source["content_z"]).decode("utf-8")
+    return source.get("content") or ""
+
+def build_knowledge_chunks(source_id: str, user_id: str, text: str, start: int = 0) -> List[Dict]:
+    """Chunk documents for db.knowledge_chunks, numbered from start"""
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "source_id": source_id,
+            "user_id": user_id,
+            "position": position,
+            "text": chunk
+        }
+        for position, chunk in enumerate(chunk_text(text), start)
+    ]
+
+class BM25Index:
+    """Okapi BM25 over knowledge chunks, held in memory per tenant"""
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks: List[Dict] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[tuple]] = defaultdict(list)
+        self.total_length = 0
+        self.semantic: Optional[SemanticIndex] = SemanticIndex() if SEMANTIC_SEARCH_ENABLED else None
+        self.version = 0
+    
+    def add_chunks(self, chunks: List[Dict]):
+        for chunk in chunks:
+            terms = tokenize(chunk["text"])
+            doc_idx = len(self.chunks)
+            self.chunks.append(chunk)
+            if self.semantic is not None:
+                self.semantic.add(str(doc_idx), hashed_vector(chunk["text"]))
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+            counts = defaultdict(int)
+            for term in terms:
+                counts[term] += 1
+            for term, tf in counts.items():
+                self.postings[term].append((doc_idx, tf))
+    
+    def search(self, query: str, k: int) -> List[Dict]:
+        if not self.chunks:
+            return []
+        n = len(self.chunks)
+        avg_length = self.total_length / n or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_idx, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_idx] / avg_length)
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = [doc_idx for doc_idx, _ in heapq.nlargest(k, scores.items(), key=lambda item: item[1])]
+        if self.semantic is not None:
+            # Reciprocal rank fusion of lexical and vector rankings
+            fused = defaultdict(float)
+            for rank, doc_idx in enumerate(ranked):
+                fused[doc_idx] += 1 / (60 + rank)
+            for rank, (doc_id, _) in enumerate(self.semantic.search(query, k)):
+                fused[int(doc_id)] += 1 / (60 + rank)
+            ranked = heapq.nlargest(k, fused, key=fused.get)
+        return [self.chunks[doc_idx] for doc_idx in ranked]
+    
+    def leading_chunks(self, k: int) -> List[Dict]:
+        """Opening chunk of each source, used when the query matches nothing"""
+        return [c for c in self.chunks if c.get("position") == 0][:k]
+
+knowledge_indexes = TTLCache(
+    "knowledge_index",
+    maxsize=int(os.environ.get('KNOWLEDGE_INDEX_CACHE_SIZE', '500')),
+    ttl=float(os.environ.get('KNOWLEDGE_INDEX_TTL_SECONDS', '3600'))
+)
+_knowledge_index_locks = KeyedLocks()
+
+async def get_knowledge_index(user_id: str) -> BM25Index:
+    """Load the tenant's chunk index, chunking any source stored before chunking existed"""
+    index = knowledge_indexes.get(user_id)
+    if index and await index_is_current(index, user_id, "knowledge"):
+        return index
+    
+    async with _knowledge_index_locks.hold(user_id):
+        index = knowledge_indexes.get(user_id)
+        if index and await index_is_current(index, user_id, "knowledge"):
+            return index
+        
+        version = (await get_index_versions(user_id, refresh=True)).get("knowledge", 0)
+        sources, chunks = await asyncio.gather(
+            db.knowledge_sources.find({"user_id": user_id, "status": "active"}, {"_id": 0, "id": 1}).to_list(None),
+            db.knowledge_chunks.find({"user_id": user_id}, {"_id": 0}).sort("position", 1).to_list(None)
+        )
+        active_ids = {s["id"] for s in sources}
+        missing_ids = active_ids - {c["source_id"] for c in chunks}
+        if missing_ids:
+            legacy = await db.knowledge_sources.find(
+                {"id": {"$in": list(missing_ids)}}, {"_id": 0, "id": 1, "content": 1, "content_z": 1}
+            ).to_list(None)
+            backfill = []
+            for source in legacy:
+                backfill.extend(build_knowledge_chunks(source["id"], user_id, source_text(source)))
+            if backfill:
+                try:
+                    await db.knowledge_chunks.insert_many(backfill, ordered=False)
+                except BulkWriteError:
+                    # Another worker backfilled some of these sources first; (source_id, position)
+                    # is unique, so keep whichever chunks made it into the collection
+                    backfill = await db.knowledge_chunks.find(
+                        {"source_id": {"$in": list(missing_ids)}}, {"_id": 0}
+                    ).sort("position", 1).to_list(None)
+                for chunk in backfill:
+                    chunk.pop("_id", None)
+                chunks.extend(backfill)
+        
+        index = BM25Index()
+        index.add_chunks([c for c in chunks if c["source_id"] in active_ids])
+        index.version = version
+        knowledge_indexes.set(user_id, index)
+        return index
+
+async def index_knowledge_source(source_id: str, user_id: str, text: str) -> int:
+    """Chunk and store a new source, adding it to the tenant's loaded index"""
+    chunks = build_knowledge_chunks(source_id, user_id, text)
+    if chunks:
+        await db.knowledge_chunks.insert_many(chunks)
+        for chunk in chunks:
+            chunk.pop("_id", None)
+        index = knowledge_indexes.get(user_id)
+        if index:
+            index.add_chunks(chunks)
+        await bump_index_version(user_id, "knowledge", knowledge_indexes)
+    invalidate_answers(user_id)
+    return len(chunks)
+
+async def invalidate_knowledge_index(user_id: str):
+    """Force the tenant's chunk index to be rebuilt on next use, on every worker"""
+    knowledge_indexes.invalidate(user_id)
+    invalidate_answers(user_id)
+    await bump_index_version(user_id, "knowledge")
+
+async def retrieve_knowledge(user_id: str, query: str, k: int = KNOWLEDGE_TOP_K) -> List[str]:
+    """Top-k knowledge chunk texts for the visitor message, best first"""
+    index = await get_knowledge_index(user_id)
+    chunks = index.search(query, k) or index.leading_chunks(k)
+    return [chunk["text"] for chunk in chunks]
+
+
+# ==================== PRODUCT INDEX ====================
+
+PRODUCT_PUBLIC_FIELDS = {"_id": 0, "embedding": 0, "fingerprint": 0}
+PRODUCT_FIELD_WEIGHTS = {"name": 3.0, "category": 2.0, "brand": 2.0, "description": 1.0}
+PRODUCT_INDEX_FIELDS = {"_id": 0, "id": 1, "source_id": 1, **{field: 1 for field in PRODUCT_FIELD_WEIGHTS}}
+PREFIX_MATCH_WEIGHT = 0.7
+MAX_PREFIX_EXPANSIONS = 20
+SPARSE_SEARCH_LIMIT = 4096
+FUZZY_FIELDS = ("name", "category")
+FUZZY_MATCH_WEIGHT = 0.6
+MAX_FUZZY_EXPANSIONS = 3
+PRODUCT_FUZZY_THRESHOLD = float(os.environ.get('PRODUCT_FUZZY_THRESHOLD', '0.3'))
+
+def word_trigrams(word: str) -> set:
+    """Character trigrams of a word padded like pg_trgm ('  w', ' wo', ..., 'd ')"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ProductIndex:
+    """Per-tenant inverted index over product name, category, brand and description.
+
+    Postings live in dicts so writes are cheap; each term is frozen into NumPy
+    arrays on first query, so scoring a query is a handful of vectorised
+    gathers regardless of how common its terms are.
+    """
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, float]] = defaultdict(dict)
+        self.slots: Dict[str, int] = {}
+        self.ids: List[Optional[str]] = []
+        self.sources: List[Optional[str]] = []
+        self.doc_terms: List[tuple] = []
+        self.doc_fuzzy_terms: List[tuple] = []
+        self.fuzzy_terms: Dict[str, int] = {}
+        self.trigrams: Dict[str, set] = defaultdict(set)
+        self._frozen: Dict[str, tuple] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_dirty = False
+        self._tombstones = 0
+        self.version = 0
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def add(self, product: Dict):
+        if product["id"] in self.slots:
+            self.remove(product["id"])
+        weights = defaultdict(float)
+        fuzzy_terms = set()
+        for field, weight in PRODUCT_FIELD_WEIGHTS.items():
+            value = product.get(field)
+            if isinstance(value, str):
+                terms = tokenize(value)
+                for term in terms:
+                    weights[term] += weight
+                if field in FUZZY_FIELDS:
+                    fuzzy_terms.update(terms)
+        
+        slot = len(self.ids)
+        self.ids.append(product["id"])
+        self.sources.append(product.get("source_id"))
+        self.doc_terms.append(tuple(weights))
+        self.doc_fuzzy_terms.append(tuple(fuzzy_terms))
+        for term in fuzzy_terms:
+            if term not in self.fuzzy_terms:
+                self.fuzzy_terms[term] = 0
+                for trigram in word_trigrams(term):
+                    self.trigrams[trigram].add(term)
+            self.fuzzy_terms[term] += 1
+        self.slots[product["id"]] = slot
+        for term, weight in weights.items():
+            if term not in self.postings:
+                self._vocabulary_dirty = True
+            self.postings[term][slot] = weight
+            self._frozen.pop(term, None)
+    
+    def add_many(self, products: List[Dict]):
+        for product in products:
+            self.add(product)
+    
+    def remove(self, product_id: str):
+        slot = self.slots.pop(product_id, None)
+        if slot is None:
+            return
+        for term in self.doc_terms[slot]:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(slot, None)
+                self._frozen.pop(term, None)
+                if not postings:
+                    del self.postings[term]
+                    self._vocabulary_dirty = True
+        for term in self.doc_fuzzy_terms[slot]:
+            self.fuzzy_terms[term] -= 1
+            if not self.fuzzy_terms[term]:
+                del self.fuzzy_terms[term]
+                for trigram in word_trigrams(term):
+                    self.trigrams[trigram].discard(term)
+        self.ids[slot] = None
+        self.sources[slot] = None
+        self.doc_terms[slot] = ()
+        self.doc_fuzzy_terms[slot] = ()
+        self._tombstones += 1
+        if self._tombstones > 1000 and self._tombstones > len(self.slots):
+            self.compact()
+    
+    def remove_source(self, source_id: str):
+        for slot, product_source in enumerate(self.sources):
+            if product_source == source_id and self.ids[slot]:
+                self.remove(self.ids[slot])
+    
+    def compact(self):
+        """Renumber slots after many removals so score arrays stay dense"""
+        live = [slot for slot, product_id in enumerate(self.ids) if product_id is not None]
+        remap = {old: new for new, old in enumerate(live)}
+        self.ids = [self.ids[slot] for slot in live]
+        self.sources = [self.sources[slot] for slot in live]
+        self.doc_terms = [self.doc_terms[slot] for slot in live]
+        self.doc_fuzzy_terms = [self.doc_fuzzy_terms[slot] for slot in live]
+        self.slots = {product_id: slot for slot, product_id in enumerate(self.ids)}
+        self.postings = defaultdict(dict, {
+            term: {remap[slot]: weight for slot, weight in postings.items()}
+            for term, postings in self.postings.items()
+        })
+        self._frozen.clear()
+        self._tombstones = 0
+    
+    def expand(self, term: str) -> Dict[str, float]:
+        """The term itself plus vocabulary words it prefixes, like the old substring regex"""
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self.postings)
+            self._vocabulary_dirty = False
+        expansions = {term: 1.0} if term in self.postings else {}
+        start = bisect.bisect_left(self._vocabulary, term)
+        for word in self._vocabulary[start:start + MAX_PREFIX_EXPANSIONS + 1]:
+            if not word.startswith(term):
+                break
+            expansions.setdefault(word, PREFIX_MATCH_WEIGHT)
+        return expansions
+    
+    def similar_terms(self, term: str, threshold: float) -> Dict[str, float]:
+        """Name/category words whose trigram similarity to term is at least threshold"""
+        query = word_trigrams(term)
+        min_shared = threshold * len(query)
+        shared = defaultdict(int)
+        for trigram in query:
+            for word in self.trigrams.get(trigram, ()):
+                shared[word] += 1
+        similar = {}
+        for word, common in shared.items():
+            if common < min_shared:
+                continue
+            # Padded trigram count of a word is len + 1 (repeats aside)
+            similarity = common / (len(query) + len(word) + 1 - common)
+            if similarity >= threshold:
+                similar[word] = similarity
+        best = heapq.nlargest(MAX_FUZZY_EXPANSIONS, similar.items(), key=lambda item: item[1])
+        return {word: FUZZY_MATCH_WEIGHT * similarity for word, similarity in best}
+    
+    def query_expansions(self, query: str, fuzzy_threshold: Optional[float] = None) -> List[Dict[str, float]]:
+        """Per query term: matching vocabulary words and their weights"""
+        expansions = []
+        for term in dict.fromkeys(tokenize(query)):
+            words = self.expand(term)
+            if fuzzy_threshold is not None and term not in self.postings:
+                # Misspelled or unknown word: fall back to trigram neighbours
+                for word, weight in self.similar_terms(term, fuzzy_threshold).items():
+                    words.setdefault(word, weight)
+            expansions.append(words)
+        return expansions
+    
+    def term_arrays(self, word: str) -> tuple:
+        frozen = self._frozen.get(word)
+        if frozen is None:
+            postings = self.postings[word]
+            frozen = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings))
+            )
+            self._frozen[word] = frozen
+        return frozen
+    
+    def search(self, query: str, limit: int, fuzzy_threshold: Optional[float] = None) -> List[str]:
+        """Product ids ranked by number of matched query terms, then by tf-idf score"""
+        expansions = [words for words in self.query_expansions(query, fuzzy_threshold) if words]
+        if not expansions or not self.slots:
+            return []
+        
+        n = len(self.slots)
+        if sum(len(self.postings[word]) for words in expansions for word in words) < SPARSE_SEARCH_LIMIT:
+            return self._search_sparse(expansions, limit)
+        
+        total = np.zeros(len(self.ids), dtype=np.float32)
+        matched = np.zeros(len(self.ids), dtype=np.float32)
+        for words in expansions:
+            term_score = np.zeros(len(self.ids), dtype=np.float32)
+            for word, weight in words.items():
+                slots, tfs = self.term_arrays(word)
+                factor = weight * math.log(1 + n / len(slots))
+                term_score[slots] = np.maximum(term_score[slots], factor * tfs)
+            total += term_score
+            matched += term_score > 0
+        
+        hits = np.flatnonzero(matched)
+        if hits.size == 0:
+            return []
+        # Products matching every term rank above partial matches
+        rank = matched[hits] * (float(total.max()) + 1.0) + total[hits]
+        if hits.size > limit:
+            top = np.argpartition(-rank, limit)[:limit]
+            hits, rank = hits[top], rank[top]
+        return [self.ids[slot] for slot in hits[np.argsort(-rank, kind="stable")]]
+    
+    def _search_sparse(self, expansions: List[Dict[str, float]], limit: int) -> List[str]:
+        """Dict-based scoring for selective queries, where array setup would dominate"""
+        n = len(self.slots)
+        total = defaultdict(float)
+        matched = defaultdict(int)
+        for words in expansions:
+            term_score = {}
+            for word, weight in words.items():
+                postings = self.postings[word]
+                factor = weight * math.log(1 + n / len(postings))
+                for slot, tf in postings.items():
+                    score = factor * tf
+                    if score > term_score.get(slot, 0.0):
+                        term_score[slot] = score
+            for slot, score in term_score.items():
+                total[slot] += score
+                matched[slot] += 1
+        ranked = heapq.nlargest(limit, total, key=lambda slot: (matched[slot], total[slot]))
+        return [self.ids[slot] for slot in ranked]
+
+product_indexes = TTLCache(
+    "product_index",
+    maxsize=int(os.environ.get('PRODUCT_INDEX_CACHE_SIZE', '500')),
+    ttl=float(os.environ.get('PRODUCT_INDEX_TTL_SECONDS', '3600'))
+)
+_product_index_locks = KeyedLocks()
+
+async def get_product_index(user_id: str) -> ProductIndex:
+    """Load the tenant's product index, building it from db.products on first use"""
+    index = product_indexes.get(user_id)
+    if index and await index_is_current(index, user_id, "products"):
+        return index
+    
+    async with _product_index_locks.hold(user_id):
+        index = product_indexes.get(user_id)
+        if index and await index_is_current(index, user_id, "products"):
+            return index
+        
+        start = time.perf_counter()
+        index = ProductIndex()
+        index.version = (await get_index_versions(user_id, refresh=True)).get("products", 0)
+        async for product in db.products.find({"user_id": user_id}, PRODUCT_INDEX_FIELDS):
+            index.add(product)
+        record_latency("product_index.build", (time.perf_counter() - start) * 1000)
+        product_indexes.set(user_id, index)
+        return index
+
+async def index_products(user_id: str, products: List[Dict]):
+    """Add or replace products in the tenant's keyword and vector indexes if they are loaded"""
+    invalidate_answers(user_id)
+    index = product_indexes.get(user_id)
+    if index:
+        index.add_many(products)
+    vectors = semantic_indexes.get(user_id)
+    if vectors:
+        for product in products:
+            embedding = product.get("embedding")
+            vectors.add(product["id"], decode_vector(embedding) if embedding else hashed_vector(product_text(product)))
+    await bump_index_version(user_id, "products", product_indexes, semantic_indexes)
+
+async def unindex_products(user_id: str, product_ids: List[str] = None, source_id: str = None):
+    """Remove products (by id or by source) from the tenant's indexes if they are loaded"""
+    invalidate_answers(user_id)
+    vectors = semantic_indexes.get(user_id)
+    if vectors:
+        for product_id in product_ids or []:
+            vectors.remove(product_id)
+        if source_id:
+            semantic_indexes.invalidate(user_id)
+    index = product_indexes.get(user_id)
+    if index:
+        for product_id in product_ids or []:
+            index.remove(product_id)
+        if source_id:
+            index.remove_source(source_id)
+    await bump_index_version(user_id, "products", product_indexes, semantic_indexes)
+
+
+# ==================== HTTP FETCH ====================
+
+class FetchError(Exception):
+    """Raised when an outbound fetch breaks one of the FetchClient limits"""
+
+class FetchResult:
+    """Fully read response of FetchClient.get"""
+    def __init__(self, url: str, status_code: int, headers: httpx.Headers, content: bytes,
+                 encoding: Optional[str], elapsed_ms: float):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.elapsed_ms = elapsed_ms
+    
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+class FetchClient:
+    """Application-wide client for outbound page fetches.
+
+    One pooled httpx.AsyncClient (HTTP/2 when enabled and h2 is installed),
+    at most max_per_host concurrent requests per host, and a cap on both the
+    bytes downloaded and the bytes they decompress to, so a huge or
+    gzip-bomb page fails fast instead of filling memory. Timings and sizes
+    go to the metrics under fetch.*.
+    """
+    def __init__(self, max_connections: int, max_keepalive: int, max_per_host: int, timeout: float,
+                 max_bytes: int, max_decoded_bytes: int, http2: bool = False,
+                 user_agent: str = "SalesGeniusBot/1.0"):
+        self.max_per_host = max_per_host
+        self.max_bytes = max_bytes
+        self.max_decoded_bytes = max_decoded_bytes
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.timeout = httpx.Timeout(timeout, connect=min(timeout, 10.0))
+        self.http2 = http2 and self._h2_available()
+        self.user_agent = user_agent
+        self._host_slots = KeyedLocks(lambda: asyncio.Semaphore(self.max_per_host))
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @staticmethod
+    def _h2_available() -> bool:
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("FETCH_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+            return False
+    
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={"User-Agent": self.user_agent}
+            )
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None, max_bytes: Optional[int] = None) -> FetchResult:
+        if self._client is None:
+            # Used outside the app lifecycle (scripts, one-off jobs): open lazily
+            await self.start()
+        max_bytes = max_bytes or self.max_bytes
+        host = httpx.URL(url).host
+        start = time.perf_counter()
+        try:
+            async with self._host_slots.hold(host):
+                record_latency("fetch.host_wait", (time.perf_counter() - start) * 1000)
+                request_start = time.perf_counter()
+                async with self._client.stream("GET", url, headers=headers) as response:
+                    record_latency("fetch.ttfb", (time.perf_counter() - request_start) * 1000)
+                    declared = response.headers.get("content-length")
+                    if declared and declared.isdigit() and int(declared) > max_bytes:
+                        raise FetchError(f"{url}: response of {declared} bytes exceeds {max_bytes}")
+                    chunks, decoded = [], 0
+                    async for chunk in response.aiter_bytes():
+                        decoded += len(chunk)
+                        if response.num_bytes_downloaded > max_bytes:
+                            raise FetchError(f"{url}: response exceeds {max_bytes} bytes")
+                        if decoded > self.max_decoded_bytes:
+                            raise FetchError(f"{url}: decompressed body exceeds {self.max_decoded_bytes} bytes")
+                        chunks.append(chunk)
+                    elapsed_ms = (time.perf_counter() - request_start) * 1000
+                    result = FetchResult(str(response.url), response.status_code, response.headers,
+                                         b"".join(chunks), response.encoding, elapsed_ms)
+                    downloaded = response.num_bytes_downloaded
+        except FetchError:
+            increment_counter("fetch.rejected")
+            raise
+        except httpx.HTTPError:
+            increment_counter("fetch.errors")
+            raise
+        record_latency("fetch.total", (time.perf_counter() - start) * 1000)
+        increment_counter("fetch.requests")
+        increment_counter("fetch.bytes_downloaded", downloaded)
+        increment_counter("fetch.bytes_decoded", len(result.content))
+        increment_counter(f"fetch.status_{result.status_code // 100}xx")
+        return result
+
+fetch_client = FetchClient(
+    max_connections=int(os.environ.get('FETCH_MAX_CONNECTIONS', '100')),
+    max_keepalive=int(os.environ.get('FETCH_MAX_KEEPALIVE', '20')),
+    max_per_host=int(os.environ.get('FETCH_MAX_PER_HOST', '6')),
+    timeout=float(os.environ.get('FETCH_TIMEOUT_SECONDS', '30')),
+    max_bytes=int(os.environ.get('FETCH_MAX_BYTES', str(10 * 1024 * 1024))),
+    max_decoded_bytes=int(os.environ.get('FETCH_MAX_DECODED_BYTES', str(30 * 1024 * 1024))),
+    http2=os.environ.get('FETCH_HTTP2', 'false').lower() == 'true'
+)
+
+
+# ==================== HTML PARSING ====================
+
+HTML_PARSERS = ("html.parser", "lxml", "selectolax")
+
+class LexborNode:
+    """Wraps a selectolax (Lexbor) node in the part of the BeautifulSoup Tag API
+    the scraping helpers use: select, select_one, get, get_text and string.
+
+    Lexbor's css() also matches the node it is called on, which BeautifulSoup
+    does not, so the node itself is filtered out.
+    """
+    __slots__ = ("node",)
+    
+    def __init__(self, node):
+        self.node = node
+    
+    def select(self, selector: str) -> List["LexborNode"]:
+        return [LexborNode(match) for match in self.node.css(selector) if match.mem_id != self.node.mem_id]
+    
+    def select_one(self, selector: str) -> Optional["LexborNode"]:
+        for match in self.node.css(selector):
+            if match.mem_id != self.node.mem_id:
+                return LexborNode(match)
+        return None
+    
+    def get(self, attribute: str, default=None):
+        attributes = self.node.attributes
+        if attribute not in attributes:
+            return default
+        # Valueless attributes come back as None; BeautifulSoup returns ""
+        return attributes[attribute] or ""
+    
+    def get_text(self, strip: bool = False) -> str:
+        return self.node.text(strip=strip)
+    
+    @property
+    def string(self) -> str:
+        return self.node.text()
+
+def resolve_html_parser(name: str) -> str:
+    """The requested parser backend, or html.parser when its package isn't installed"""
+    if name not in HTML_PARSERS:
+        logger.warning(f"Unknown HTML_PARSER {name!r}, using html.parser")
+        return "html.parser"
+    try:
+        if name == "selectolax":
+            import selectolax.lexbor  # noqa: F401
+        elif name == "lxml":
+            BeautifulSoup("", "lxml")
+    except (ImportError, FeatureNotFound):
+        logger.warning(f"HTML_PARSER is {name} but it isn't installed, using html.parser")
+        return "html.parser"
+    return name
+
+HTML_PARSER = resolve_html_parser(os.environ.get('HTML_PARSER', 'html.parser'))
+
+def parse_html(html: str, parser: Optional[str] = None):
+    """Parse a page with the configured backend; the result supports select/select_one"""
+    parser = parser or HTML_PARSER
+    if parser == "selectolax":
+        from selectolax.lexbor import LexborHTMLParser
+        return LexborNode(LexborHTMLParser(html).root)
+    return BeautifulSoup(html, parser)
+
+class ParsePool:
+    """Runs HTML parsing and product extraction in worker processes.
+
+    Parsing a large category page is pure-Python CPU work; on the event loop
+    it stalls every concurrent chat request. Workers are spawned (not
+    forked, the app has threads by then) and import this module, so they
+    parse with the same HTML_PARSER. With workers=0, or before start(),
+    calls run in a thread instead, which keeps scripts simple at the cost
+    of sharing the GIL.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+    
+    def start(self):
+        if self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+    
+    async def warm_up(self):
+        """Spawn the workers now rather than on the first page"""
+        if self._executor is not None:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self._executor, resolve_html_parser, HTML_PARSER)
+                                   for _ in range(self.workers)))
+    
+    async def run(self, fn, *args):
+        start = time.perf_counter()
+        if self._executor is None:
+            result = await asyncio.to_thread(fn, *args)
+        else:
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+            except BrokenProcessPool:
+                # A worker died (killed on a huge page): replace the pool; the job retry takes the page again
+                increment_counter("parse.broken_pool")
+                self._executor = None
+                self.start()
+                raise
+        record_latency(f"parse.{fn.__name__}", (time.perf_counter() - start) * 1000)
+        return result
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+parse_pool = ParsePool(int(os.environ.get('PARSE_WORKERS', '2')))
+
+
+# ==================== PAGE TEXT ====================
+
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "svg", "canvas", "iframe", "form",
+                    "nav", "header", "footer", "aside", "button", "select", "dialog"]
+BOILERPLATE_SELECTORS = ('[role="navigation"], [role="banner"], [role="contentinfo"], [role="dialog"], '
+                         '[aria-hidden="true"], [hidden], .breadcrumb, .breadcrumbs, .skip-link, '
+                         '[id*="cookie"], [class*="cookie"], [class*="newsletter"], .modal, .sidebar')
+BLOCK_TAGS = ["p", "div", "section", "article", "main", "li", "tr", "td", "th", "dt", "dd", "br",
+              "blockquote", "pre", "table", "ul", "ol", "dl", "figcaption", "address"]
+HEADING_TAGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+STRUCTURED_FIELDS = ("name", "description", "brand", "sku", "gtin13", "price", "priceCurrency", "availability",
+                     "telephone", "email", "streetAddress", "addressLocality", "postalCode", "openingHours", "text")
+STRUCTURED_MAX_LINES = 300
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def structured_data_lines(data) -> List[str]:
+    """One compact line per schema.org object in a JSON-LD document, offers folded into their product"""
+    lines = []
+    
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+            return
+        if not isinstance(node, dict) or len(lines) >= STRUCTURED_MAX_LINES:
+            return
+        offers = node.get("offers")
+        if isinstance(offers, list):
+            offers = offers[0] if offers else None
+        fields = {**offers, **node} if isinstance(offers, dict) else node
+        values = []
+        for key in STRUCTURED_FIELDS:
+            value = fields.get(key)
+            if isinstance(value, dict):
+                value = value.get("name")
+            if isinstance(value, (str, int, float)) and str(value).strip():
+                value = " ".join(_TAG_RE.sub(" ", html_lib.unescape(str(value))).split())
+                if key == "availability":
+                    value = value.rsplit("/", 1)[-1]
+                values.append(f"{key}: {value[:500]}")
+        node_type = node.get("@type")
+        if node_type and values:
+            lines.append(f"[{node_type if isinstance(node_type, str) else '/'.join(map(str, node_type))}] "
+                         + "; ".join(values))
+        for key, value in node.items():
+            if key != "offers" and key not in STRUCTURED_FIELDS and isinstance(value, (dict, list)):
+                walk(value)
+    
+    walk(data)
+    return lines
+
+def extract_page_text(html: str, parser: Optional[str] = None) -> str:
+    """Readable text of a page for the knowledge base.
+
+    Keeps the title, meta description, headings (as markdown-style "#"
+    lines starting a paragraph), the text of the main content and one line
+    per JSON-LD object; drops scripts, styles, navigation, header, footer,
+    forms and banners, and normalizes whitespace. Runs on BeautifulSoup, so
+    the selectolax backend is swapped for lxml here.
+    """
+    parser = parser or HTML_PARSER
+    if parser == "selectolax":
+        parser = resolve_html_parser("lxml")
+    soup = BeautifulSoup(html, parser)
+    
+    head = []
+    if soup.title and soup.title.get_text(strip=True):
+        head.append("# " + " ".join(soup.title.get_text().split()))
+    description = soup.select_one('meta[name="description"], meta[property="og:description"]')
+    if description and description.get("content", "").strip():
+        head.append(" ".join(description["content"].split()))
+    
+    structured = []
+    for script in soup.select('script[type="application/ld+json"]'):
+        try:
+            structured.extend(structured_data_lines(json.loads(script.string or "")))
+        except ValueError:
+            pass
+    
+    for element in soup(BOILERPLATE_TAGS):
+        element.decompose()
+    for element in soup.select(BOILERPLATE_SELECTORS):
+        if not element.decomposed:
+            element.decompose()
+    root = soup.find("main") or soup.find(attrs={"role": "main"}) or soup.body or soup
+    
+    for heading in root.find_all(HEADING_TAGS):
+        heading.insert_before("\n\n" + "#" * int(heading.name[1]) + " ")
+        heading.insert_after("\n")
+    for block in root.find_all(BLOCK_TAGS):
+        block.insert_before("\n")
+        block.insert_after("\n")
+    
+    lines, previous = [], None
+    for line in root.get_text().split("\n"):
+        line = " ".join(line.split())
+        if line == previous or (not line and not previous):
+            continue
+        lines.append(line)
+        previous = line
+    body = "\n".join(lines).strip()
+    body = re.sub(r"\n(?=#)", "\n\n", body)
+    # The title usually repeats as the page's h1
+    if head and body.startswith(head[0]):
+        body = body[len(head[0]):].lstrip()
+    
+    return "\n\n".join(part for part in ("\n".join(head), body, "\n".join(structured)) if part)
+
+
+# ==================== PDF INGESTION ====================
+
+MAX_PDF_UPLOAD_BYTES = int(os.environ.get('MAX_PDF_UPLOAD_BYTES', str(200 * 1024 * 1024)))
+MAX_PDF_PAGES = int(os.environ.get('MAX_PDF_PAGES', '1000'))
+PDF_UPLOAD_CHUNK_BYTES = 1024 * 1024
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', '20'))
+PDF_SPOOL_DIR = os.environ.get('PDF_SPOOL_DIR') or None
+
+# Room for the multipart boundaries and the other form fields around the file
+PDF_FORM_OVERHEAD_BYTES = 64 * 1024
+
+# Uploads wait in GridFS until their job has indexed them, so any worker can pick the job up
+pdf_uploads = AsyncIOMotorGridFSBucket(db, bucket_name="pdf_uploads")
+
+class RequestSizeLimit:
+    """ASGI middleware capping request bodies per path before anything reads them.
+
+    Form parameters are parsed (and spooled) before the route runs, so the
+    route can't reject an oversized upload itself. A declared Content-Length
+    over the limit is answered with 413 straight away; a body sent without
+    one is counted as it arrives and cut off once it passes the limit.
+    """
+    def __init__(self, app, limits: Dict[str, int], detail: str = "Richiesta troppo grande"):
+        self.app = app
+        self.limits = limits
+        self.detail = detail
+    
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        
+        headers = dict(scope["headers"])
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            increment_counter("http.request_too_large")
+            return await JSONResponse({"detail": self.detail}, status_code=413)(scope, receive, send)
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    increment_counter("http.request_too_large")
+                    raise HTTPException(status_code=413, detail=self.detail)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def pdf_page_count(path: str) -> int:
+    with open(path, "rb") as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Text of pages start..stop-1 of the PDF at path, one string per page.
+
+    Runs in the parse pool. Each task opens the spooled file itself and
+    PyPDF2 reads objects from it on demand, so neither the whole document
+    nor its text has to cross the process boundary.
+    """
+    texts = []
+    with open(path, "rb") as pdf_file:
+        reader = PyPDF2.PdfReader(pdf_file)
+        for number in range(start, stop):
+            try:
+                texts.append(reader.pages[number].extract_text() or "")
+            except Exception as e:
+                # One damaged page shouldn't fail a whole catalog
+                logger.warning(f"PDF page {number + 1} unreadable: {e}")
+                texts.append("")
+    return texts
+
+async def ingest_pdf(path: str, source_id: str, user_id: str, progress: "JobProgress") -> Dict:
+    """Extract a spooled PDF PDF_PAGES_PER_TASK pages at a time across the parse
+    pool and store each batch's chunks as soon as the batches before it are in.
+
+    Only a couple of batches per worker are in flight, so memory stays flat
+    however long the document is.
+    """
+    total_pages = await parse_pool.run(pdf_page_count, path)
+    pages = min(total_pages, MAX_PDF_PAGES)
+    await progress.update("parsing", 0, pages)
+    
+    starts = iter(range(0, pages, PDF_PAGES_PER_TASK))
+    pending = deque()
+    
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            stop = min(start + PDF_PAGES_PER_TASK, pages)
+            pending.append(asyncio.ensure_future(parse_pool.run(extract_pdf_pages, path, start, stop)))
+    
+    for _ in range(max(parse_pool.workers, 1) * 2):
+        submit()
+    
+    parts, kept_chars, chunks, done = [], 0, 0, 0
+    try:
+        while pending:
+            texts = await pending.popleft()
+            submit()
+            batch = "\n".join(text for text in texts if text)
+            done += len(texts)
+            batch_chunks = build_knowledge_chunks(source_id, user_id, batch, start=chunks)
+            if batch_chunks:
+                await db.knowledge_chunks.insert_many(batch_chunks)
+                chunks += len(batch_chunks)
+            # Every page is chunked; the source document keeps the leading text like URL sources
+            if kept_chars < KNOWLEDGE_TEXT_MAX_CHARS:
+                parts.append(batch[:KNOWLEDGE_TEXT_MAX_CHARS - kept_chars])
+                kept_chars += len(parts[-1])
+            await progress.update("parsing", done, pages)
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    return {"text": "\n".join(parts)[:KNOWLEDGE_TEXT_MAX_CHARS], "pages": pages, "total_pages": total_pages, "chunks": chunks}
+
+async def delete_pdf_uploads(**metadata):
+    """Remove stored uploads matching the given metadata (source_id or user_id)"""
+    query = {f"metadata.{key}": value for key, value in metadata.items()}
+    async for upload in pdf_uploads.find(query):
+        await pdf_uploads.delete(upload._id)
+
+
 # ==================== PRODUCT SCRAPING HELPERS ====================
 
 async def extract_products_from_url(url: str, source_id: str, user_id: str) -> List[Dict]:
-    """Extract product information from a URL using various strategies"""
+    """Fetch a page and extract its products in the parse pool; fetch errors propagate so the calling job can retry"""
+    response = await fetch_client.get(url)
+    return await parse_pool.run(extract_products_from_html, response.text, url, source_id, user_id)
+
+def extract_products_from_html(html: str, url: str, source_id: str, user_id: str,
+                               parser: Optional[str] = None) -> List[Dict]:
+    """Extract product information from a fetched page using various strategies"""
+    return extract_products_from_soup(parse_html(html, parser), url, source_id, user_id)
+
+def extract_products_from_soup(soup, url: str, source_id: str, user_id: str) -> List[Dict]:
     products = []
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, follow_redirects=True)
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-            base_url = '/'.join(url.split('/')[:3])
-            
-            # Strategy 1: Look for JSON-LD structured data
-            json_ld_scripts = soup.find_all('script', type='application/ld+json')
-            for script in json_ld_scripts:
-                try:
-                    data = json.loads(script.string)
-                    if isinstance(data, list):
-                        for item in data:
-                            if item.get('@type') == 'Product':
-                                products.append(parse_jsonld_product(item, url, source_id, user_id, base_url))
-                    elif data.get('@type') == 'Product':
-                        products.append(parse_jsonld_product(data, url, source_id, user_id, base_url))
-                    elif data.get('@type') == 'ItemList':
-                        for item in data.get('itemListElement', []):
-                            if item.get('@type') == 'Product' or item.get('item', {}).get('@type') == 'Product':
-                                prod = item if item.get('@type') == 'Product' else item.get('item', {})
-                                products.append(parse_jsonld_product(prod, url, source_id, user_id, base_url))
-                except:
-                    pass
-            
-            # Strategy 2: Look for common e-commerce product patterns
-            if not products:
-                # Extended selectors for Magento, Shopware, WooCommerce, Shopify
-                product_selectors = [
-                    # Magento
-                    '.product-item-container', '.product-item', '.item.product',
-                    '.products-grid .item', '.category-products .item',
-                    # Shopware
-                    '.product-box', '.card.product-box', '.product-card',
-                    # WooCommerce
-                    '.woocommerce-loop-product', '.products li.product',
-                    # Shopify
-                    '.product-grid-item', '.collection-product', '.grid__item',
-                    # Generic
-                    '.product', '[data-product]', 'article.product',
-                    '.product-container', '.product-wrapper'
-                ]
-                
-                for selector in product_selectors:
-                    items = soup.select(selector)
-                    for item in items[:50]:  # Limit to 50 products per page
-                        product = extract_product_from_element(item, base_url, source_id, user_id)
-                        if product and product.get('name') and len(product.get('name', '')) > 2:
-                            # Skip if name is just a category name
-                            if product.get('product_url') and product.get('product_url') != url:
-                                products.append(product)
-                    if len(products) >= 3:  # Found enough products
-                        break
-            
-            # Strategy 3: Look for individual product page
-            if not products:
-                product = extract_single_product(soup, url, source_id, user_id, base_url)
-                if product and product.get('name'):
-                    products.append(product)
+        base_url = '/'.join(url.split('/')[:3])
+        
+        # Strategy 1: Look for JSON-LD structured data
+        json_ld_scripts = soup.select('script[type="application/ld+json"]')
+        for script in json_ld_scripts:
+            try:
+                data = json.loads(script.string)
+                if isinstance(data, list):
+                    for item in data:
+                        if item.get('@type') == 'Product':
+                            products.append(parse_jsonld_product(item, url, source_id, user_id, base_url))
+                elif data.get('@type') == 'Product':
+                    products.append(parse_jsonld_product(data, url, source_id, user_id, base_url))
+                elif data.get('@type') == 'ItemList':
+                    for item in data.get('itemListElement', []):
+                        if item.get('@type') == 'Product' or item.get('item', {}).get('@type') == 'Product':
+                            prod = item if item.get('@type') == 'Product' else item.get('item', {})
+                            products.append(parse_jsonld_product(prod, url, source_id, user_id, base_url))
+            except:
+                pass
+        
+        # Strategy 2: Look for common e-commerce product patterns
+        if not products:
+            # Extended selectors for Magento, Shopware, WooCommerce, Shopify
+            product_selectors = [
+                # Magento
+                '.product-item-container', '.product-item', '.item.product',
+                '.products-grid .item', '.category-products .item',
+                # Shopware
+                '.product-box', '.card.product-box', '.product-card',
+                # WooCommerce
+                '.woocommerce-loop-product', '.products li.product',
+                # Shopify
+                '.product-grid-item', '.collection-product', '.grid__item',
+                # Generic
+                '.product', '[data-product]', 'article.product',
+                '.product-container', '.product-wrapper'
+            ]
             
+            for selector in product_selectors:
+                items = soup.select(selector)
+                for item in items[:50]:  # Limit to 50 products per page
+                    product = extract_product_from_element(item, base_url, source_id, user_id)
+                    if product and product.get('name') and len(product.get('name', '')) > 2:
+                        # Skip if name is just a category name
+                        if product.get('product_url') and product.get('product_url') != url:
+                            products.append(product)
+                if len(products) >= 3:  # Found enough products
+                    break
+        
+        # Strategy 3: Look for individual product page
+        if not products:
+            product = extract_single_product(soup, url, source_id, user_id, base_url)
+            if product and product.get('name'):
+                products.append(product)
+        
     except Exception as e:
         logger.error(f"Error extracting products from {url}: {e}")
     
@@ -398,87 +1964,1798 @@ def extract_product_from_element(element, base_url: str, source_id: str, user_id
     product['in_stock'] = True
     return product
 
-def extract_single_product(soup, url: str, source_id: str, user_id: str, base_url: str) -> Dict:
-    """Extract single product from a product detail page"""
-    product = {
+def extract_single_product(soup, url: str, source_id: str, user_id: str, base_url: str) -> Dict:
+    """Extract single product from a product detail page"""
+    product = {
+        "id": str(uuid.uuid4()),
+        "source_id": source_id,
+        "user_id": user_id,
+        "product_url": url,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    # Find name from h1 or title
+    h1 = soup.select_one('h1')
+    if h1:
+        product['name'] = h1.get_text(strip=True)[:200]
+    else:
+        title = soup.select_one('title')
+        if title:
+            product['name'] = title.get_text(strip=True).split('|')[0].split('-')[0].strip()[:200]
+    
+    # Find main image
+    main_img = soup.select_one('.product-image img, .woocommerce-product-gallery img, [class*="product"] img')
+    if main_img:
+        img_src = main_img.get('src') or main_img.get('data-src')
+        if img_src and not img_src.startswith('http'):
+            img_src = base_url + img_src if img_src.startswith('/') else base_url + '/' + img_src
+        product['image_url'] = img_src
+    
+    # Find price
+    price_el = soup.select_one('.price, [class*="price"], .woocommerce-Price-amount')
+    if price_el:
+        product['price'] = price_el.get_text(strip=True)
+        price_match = re.search(r'[\d,.]+', product['price'].replace(',', '.'))
+        if price_match:
+            try:
+                product['price_value'] = float(price_match.group().replace(',', '.'))
+            except:
+                pass
+    
+    # Find description
+    desc_el = soup.select_one('.description, .product-description, [class*="description"]')
+    if desc_el:
+        product['description'] = desc_el.get_text(strip=True)[:500]
+    
+    product['in_stock'] = True
+    return product
+
+async def search_products(user_id: str, query: str, limit: int = 6,
+                          fuzzy_threshold: Optional[float] = PRODUCT_FUZZY_THRESHOLD,
+                          semantic: bool = SEMANTIC_SEARCH_ENABLED) -> List[Dict]:
+    """Search products by text query; unknown words are matched by trigram similarity
+    unless fuzzy_threshold is None, and semantic neighbours fill any remaining slots"""
+    index = await get_product_index(user_id)
+    
+    start = time.perf_counter()
+    product_ids = index.search(query, limit, fuzzy_threshold)
+    record_latency("product_index.search", (time.perf_counter() - start) * 1000)
+    if semantic and len(product_ids) < limit:
+        for product_id in await semantic_search_products(user_id, query, limit):
+            if len(product_ids) >= limit:
+                break
+            if product_id not in product_ids:
+                product_ids.append(product_id)
+    if not product_ids:
+        return []
+    
+    products = await db.products.find(
+        {"user_id": user_id, "id": {"$in": product_ids}},
+        PRODUCT_PUBLIC_FIELDS
+    ).to_list(len(product_ids))
+    by_id = {p["id"]: p for p in products}
+    return [by_id[product_id] for product_id in product_ids if product_id in by_id]
+
+
+# ==================== CATALOG CRAWLER ====================
+
+CRAWL_MAX_PAGES = int(os.environ.get('CRAWL_MAX_PAGES', '2000'))
+CRAWL_CONCURRENCY = int(os.environ.get('CRAWL_CONCURRENCY', '4'))
+CRAWL_DOMAIN_DELAY_SECONDS = float(os.environ.get('CRAWL_DOMAIN_DELAY_SECONDS', '0.5'))
+CRAWL_MAX_CRAWL_DELAY_SECONDS = 10.0
+CRAWL_PRODUCT_BATCH = int(os.environ.get('CRAWL_PRODUCT_BATCH', '200'))
+CRAWL_PROGRESS_SECONDS = 5.0
+CRAWL_MAX_SITEMAPS = 50
+SITEMAP_MAX_BYTES = 50 * 1024 * 1024
+PAGINATION_SELECTORS = ('link[rel="next"], a[rel="next"], .pages a, .pagination a, '
+                        '.page-numbers a, .pagination__item a, a.next, a.action.next')
+NON_PAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg", ".ico", ".pdf",
+                       ".zip", ".css", ".js", ".json", ".xml", ".gz", ".mp4")
+_SITEMAP_LOC_RE = re.compile(r"<loc>\s*(.*?)\s*</loc>", re.IGNORECASE | re.DOTALL)
+
+def normalize_crawl_url(url: str) -> str:
+    """Canonical form used to deduplicate crawl URLs: no fragment, lower-case scheme and host"""
+    url, _ = urldefrag(url.strip())
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+
+def parse_sitemap(body: bytes) -> tuple:
+    """Split a sitemap into (page urls, nested sitemap urls); gzipped sitemaps are accepted"""
+    if body[:2] == b"\x1f\x8b":
+        # Raw .xml.gz files bypass the HTTP decoding cap, so bound the inflated size here
+        body = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body, SITEMAP_MAX_BYTES)
+    text = body.decode("utf-8", errors="replace")
+    locs = [html_lib.unescape(loc) for loc in _SITEMAP_LOC_RE.findall(text)]
+    if "<sitemapindex" in text[:2000].lower():
+        return [], locs
+    return locs, []
+
+def find_pagination_links(soup, page_url: str) -> List[str]:
+    links = []
+    for element in soup.select(PAGINATION_SELECTORS):
+        href = element.get('href')
+        if href and not href.startswith(('#', 'javascript')):
+            links.append(urljoin(page_url, href))
+    return links
+
+def parse_catalog_page(html: str, url: str, source_id: str, user_id: str, parser: Optional[str] = None) -> tuple:
+    """Products and pagination links of one crawled page, from a single parse.
+
+    The single-product fallback turns any page into a "product" named after
+    its <h1>; on crawled CMS and blog pages that is noise, so it is only
+    kept when a price was found.
+    """
+    soup = parse_html(html, parser)
+    products = [
+        product for product in extract_products_from_soup(soup, url, source_id, user_id)
+        if product.get('price') or product.get('product_url') != url
+    ]
+    return products, find_pagination_links(soup, url)
+
+def conditional_headers(state: Optional[Dict]) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since for a page fetched before"""
+    headers = {}
+    if state:
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+    return headers
+
+def page_unchanged(response: FetchResult, state: Optional[Dict]) -> bool:
+    if not state:
+        return False
+    return response.status_code == 304 or (
+        response.status_code == 200 and hashlib.sha1(response.content).hexdigest() == state.get("content_hash")
+    )
+
+def page_state(response: FetchResult, products: List[Dict]) -> Dict:
+    """What a rescan needs to know about a page: validators, content hash and the products it listed"""
+    return {
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "content_hash": hashlib.sha1(response.content).hexdigest(),
+        "product_urls": sorted({p["product_url"] for p in products if p.get("product_url")})
+    }
+
+class DomainThrottle:
+    """Spaces requests to the same host at least delay seconds apart.
+
+    Callers pass through a per-host lock and the gap is measured from the
+    previous caller's release, so workers that wake late (the loop was busy
+    parsing) still go one at a time instead of bursting.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._last: Dict[str, float] = {}
+    
+    async def wait(self, host: str):
+        async with self._locks[host]:
+            gap = self._last.get(host, 0.0) + self.delay - time.monotonic()
+            if gap > 0:
+                await asyncio.sleep(gap)
+            self._last[host] = time.monotonic()
+
+class CatalogCrawler:
+    """Crawls a store's catalog starting from one URL.
+
+    The frontier is seeded with the start page and the sitemaps listed in
+    robots.txt (or /sitemap.xml), and grows with the pagination links of
+    every crawled page. URLs are normalized and deduplicated, limited to the
+    start host, robots.txt rules and max_pages. A few workers fetch through
+    fetch_client, spaced per host by the throttle delay (or the robots.txt
+    crawl-delay when it is longer). Products are deduplicated by product_url
+    and handed to on_products in batches; on_progress receives the running
+    stats at every batch and at least every CRAWL_PROGRESS_SECONDS.
+
+    known_pages (url -> page_state of an earlier crawl) makes the crawl
+    incremental: known pages are queued up front, fetched with conditional
+    requests, and skipped without parsing when unchanged. page_states ends
+    up holding the state of every page still in the catalog and
+    changed_pages the urls whose state is new.
+    """
+    def __init__(self, start_url: str, source_id: str, user_id: str, on_products, on_progress,
+                 max_pages: int = CRAWL_MAX_PAGES, concurrency: int = CRAWL_CONCURRENCY,
+                 delay: float = CRAWL_DOMAIN_DELAY_SECONDS, batch_size: int = CRAWL_PRODUCT_BATCH,
+                 known_pages: Optional[Dict[str, Dict]] = None):
+        self.start_url = normalize_crawl_url(start_url)
+        self.host = urlsplit(self.start_url).netloc
+        self.source_id = source_id
+        self.user_id = user_id
+        self.on_products = on_products
+        self.on_progress = on_progress
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.throttle = DomainThrottle(delay)
+        self.known_pages = known_pages or {}
+        self.page_states: Dict[str, Dict] = {}
+        self.changed_pages: set = set()
+        self.robots: Optional[robotparser.RobotFileParser] = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.seen: set = set()
+        self.product_urls: set = set()
+        self.batch: List[Dict] = []
+        self.pages = 0
+        self.unchanged = 0
+        self.products = 0
+        self.errors = 0
+        self.started = time.perf_counter()
+        self._last_report = self.started
+        self.cancelled: Optional[Exception] = None
+    
+    def enqueue(self, url: str) -> bool:
+        if self.cancelled:
+            return False
+        url = normalize_crawl_url(url)
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or parts.netloc != self.host:
+            return False
+        if parts.path.lower().endswith(NON_PAGE_EXTENSIONS):
+            return False
+        if url in self.seen or len(self.seen) >= self.max_pages:
+            return False
+        if self.robots and not self.robots.can_fetch(fetch_client.user_agent, url):
+            return False
+        self.seen.add(url)
+        self.queue.put_nowait(url)
+        return True
+    
+    async def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> FetchResult:
+        await self.throttle.wait(urlsplit(url).netloc)
+        return await fetch_client.get(url, headers=headers)
+    
+    async def load_robots(self) -> List[str]:
+        """Read robots.txt for disallow rules, crawl-delay and sitemap locations"""
+        robots_url = urljoin(self.start_url, "/robots.txt")
+        try:
+            response = await self.fetch(robots_url)
+        except (FetchError, httpx.HTTPError):
+            return []
+        if response.status_code != 200:
+            return []
+        parser = robotparser.RobotFileParser(robots_url)
+        parser.parse(response.text.splitlines())
+        self.robots = parser
+        crawl_delay = parser.crawl_delay(fetch_client.user_agent)
+        if crawl_delay:
+            self.throttle.delay = max(self.throttle.delay, min(float(crawl_delay), CRAWL_MAX_CRAWL_DELAY_SECONDS))
+        return parser.site_maps() or []
+    
+    async def load_sitemaps(self, sitemap_urls: List[str]):
+        pending = deque(sitemap_urls or [urljoin(self.start_url, "/sitemap.xml")])
+        visited = set()
+        while pending and len(visited) < CRAWL_MAX_SITEMAPS and len(self.seen) < self.max_pages:
+            sitemap_url = urljoin(self.start_url, pending.popleft())
+            if sitemap_url in visited:
+                continue
+            visited.add(sitemap_url)
+            try:
+                response = await self.fetch(sitemap_url)
+            except (FetchError, httpx.HTTPError) as e:
+                logger.info(f"Sitemap {sitemap_url} skipped: {e}")
+                continue
+            if response.status_code != 200:
+                continue
+            pages, nested = parse_sitemap(response.content)
+            for page_url in pages:
+                self.enqueue(urljoin(sitemap_url, page_url))
+            pending.extend(urljoin(sitemap_url, nested_url) for nested_url in nested)
+    
+    def keep_known(self, url: str):
+        # A page that failed transiently keeps its products until a rescan reaches it again
+        if url in self.known_pages:
+            self.page_states[url] = self.known_pages[url]
+    
+    async def crawl_page(self, url: str, response: Optional[FetchResult] = None):
+        known = self.known_pages.get(url)
+        if response is None:
+            response = await self.fetch(url, conditional_headers(known))
+        if page_unchanged(response, known):
+            self.unchanged += 1
+            self.page_states[url] = known
+            return
+        if response.status_code != 200:
+            self.errors += 1
+            if response.status_code not in (404, 410):
+                self.keep_known(url)
+            return
+        if "html" not in response.headers.get("content-type", "text/html"):
+            return
+        products, links = await parse_pool.run(parse_catalog_page, response.text, url, self.source_id, self.user_id)
+        self.pages += 1
+        self.page_states[url] = page_state(response, products)
+        self.changed_pages.add(url)
+        for link in links:
+            self.enqueue(link)
+        for product in products:
+            product_url = product.get("product_url")
+            if not product_url or product_url in self.product_urls:
+                continue
+            self.product_urls.add(product_url)
+            self.batch.append(product)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+        elif time.perf_counter() - self._last_report >= CRAWL_PROGRESS_SECONDS:
+            await self.report()
+    
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        if batch:
+            self.products += len(batch)
+            await self.on_products(batch)
+        await self.report()
+    
+    async def report(self):
+        self._last_report = time.perf_counter()
+        await self.on_progress(self.stats())
+    
+    def stats(self) -> Dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        return {
+            "pages": self.pages,
+            "unchanged_pages": self.unchanged,
+            "products": self.products,
+            "errors": self.errors,
+            "discovered": len(self.seen),
+            "queued": self.queue.qsize(),
+            "pages_per_sec": round(self.pages / elapsed, 2),
+            "products_per_sec": round(self.products / elapsed, 2),
+            "elapsed_seconds": round(elapsed, 1)
+        }
+    
+    async def _worker(self):
+        while True:
+            url = await self.queue.get()
+            try:
+                await self.crawl_page(url)
+            except JobCancelled as e:
+                # The job was cancelled: stop the crawl instead of failing page by page
+                self.cancelled = e
+                self.drain()
+            except Exception as e:
+                self.errors += 1
+                self.keep_known(url)
+                logger.warning(f"Crawl of {url} failed: {e}")
+            finally:
+                self.queue.task_done()
+    
+    def drain(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+    
+    async def run(self, start_response: Optional[FetchResult] = None) -> Dict:
+        """Crawl until the frontier is exhausted or max_pages were discovered; start_response
+        skips refetching a start page the caller already has"""
+        sitemaps = await self.load_robots()
+        self.seen.add(self.start_url)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            if start_response is None:
+                self.queue.put_nowait(self.start_url)
+            else:
+                await self.crawl_page(self.start_url, start_response)
+            for url in self.known_pages:
+                self.enqueue(url)
+            await self.load_sitemaps(sitemaps)
+            await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        if self.cancelled:
+            raise self.cancelled
+        await self.flush()
+        stats = self.stats()
+        record_size("crawl.pages", stats["pages"])
+        record_size("crawl.pages_per_sec", stats["pages_per_sec"])
+        return stats
+
+
+# ==================== LLM SCHEDULING ====================
+
+class LlmOverloaded(Exception):
+    """Raised when an LLM request can't be queued or waited too long for a slot"""
+
+class LlmScheduler:
+    """Global cap on in-flight LLM calls with start-time fair queuing across tenants.
+
+    Each queued request gets a virtual finish tag of max(V, tenant's last tag)
+    + 1/weight; free slots go to the smallest tag, so a tenant with a burst
+    only delays its own requests while others keep their share.
+    """
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_per_tenant: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.virtual_time = 0.0
+        self._heap: List[tuple] = []
+        self._sequence = 0
+        self._last_finish: Dict[str, float] = {}
+        self._prune_at = 64
+        self._queued: Dict[str, int] = defaultdict(int)
+    
+    @property
+    def queued(self) -> int:
+        return sum(self._queued.values())
+    
+    def snapshot(self) -> Dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "queued_by_tenant": {tenant: n for tenant, n in self._queued.items() if n}
+        }
+    
+    async def _acquire(self, tenant_id: str, weight: float):
+        if self.active < self.max_concurrency and not self._heap:
+            self.active += 1
+            return
+        if self.queued >= self.max_queue or self._queued.get(tenant_id, 0) >= self.max_queue_per_tenant:
+            increment_counter("llm_scheduler.rejected")
+            raise LlmOverloaded()
+        
+        start_tag = max(self.virtual_time, self._last_finish.get(tenant_id, 0.0))
+        finish_tag = start_tag + 1.0 / max(weight, 0.01)
+        self._last_finish[tenant_id] = finish_tag
+        if len(self._last_finish) > self._prune_at:
+            self._prune_finish_tags()
+        waiter = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._heap, (finish_tag, self._sequence, start_tag, tenant_id, waiter))
+        self._queued[tenant_id] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return
+            waiter.cancel()
+            increment_counter("llm_scheduler.timed_out")
+            raise LlmOverloaded()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just as we were cancelled: give it back
+                self._release()
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                self._dequeue(tenant_id)
+    
+    def _dequeue(self, tenant_id: str):
+        self._queued[tenant_id] -= 1
+        if not self._queued[tenant_id]:
+            del self._queued[tenant_id]
+    
+    def _prune_finish_tags(self):
+        """Forget tags the virtual clock has passed: max(V, tag) no longer depends on them"""
+        self._last_finish = {t: tag for t, tag in self._last_finish.items() if tag > self.virtual_time}
+        self._prune_at = max(64, 2 * len(self._last_finish))
+    
+    def _release(self):
+        self.active -= 1
+        while self._heap and self.active < self.max_concurrency:
+            _, _, start_tag, tenant_id, waiter = heapq.heappop(self._heap)
+            if waiter.done():
+                continue
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self._dequeue(tenant_id)
+            self.active += 1
+            waiter.set_result(None)
+        if not self._heap and self._last_finish:
+            # Backlog drained: the next busy period starts every tenant level
+            self.virtual_time = max(self.virtual_time, *self._last_finish.values())
+            self._last_finish.clear()
+    
+    @asynccontextmanager
+    async def slot(self, tenant_id: str, weight: float = 1.0):
+        """Hold a concurrency slot, acquired once the tenant's turn comes up"""
+        queued_at = time.perf_counter()
+        await self._acquire(tenant_id, weight)
+        record_latency("llm_scheduler.queue_wait", (time.perf_counter() - queued_at) * 1000)
+        increment_counter("llm_scheduler.dispatched")
+        try:
+            yield
+        finally:
+            self._release()
+    
+    async def run(self, tenant_id: str, call, weight: float = 1.0):
+        """Await call() once the tenant's turn comes up"""
+        async with self.slot(tenant_id, weight):
+            return await call()
+
+class DeltaBroadcast:
+    """Deltas of one streamed generation, replayed from the first one to every follower.
+
+    The producer runs as its own task, so no single follower owns it; it is
+    cancelled once the last follower goes away before it has finished.
+    """
+    def __init__(self, produce, on_abandon):
+        self.parts: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.followers = 0
+        self._changed = asyncio.Event()
+        self._on_abandon = on_abandon
+        self.task = asyncio.ensure_future(self._pump(produce))
+    
+    async def _pump(self, produce):
+        try:
+            async for delta in produce():
+                self.parts.append(delta)
+                self._notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+    
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    async def follow(self):
+        self.followers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(self.parts):
+                    yield self.parts[position]
+                    position += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.followers -= 1
+            if not self.followers and not self.done:
+                self._on_abandon()
+                self.task.cancel()
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one execution.
+
+    The first caller starts call() as a task; callers arriving while it runs
+    await the same task. The task is shielded, so a waiter going away never
+    cancels the work the others are waiting on. stream() does the same for
+    calls that yield deltas.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Any, asyncio.Task] = {}
+        self._streams: Dict[Any, DeltaBroadcast] = {}
+    
+    async def do(self, key, call):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+            increment_counter(f"{self.name}.leader")
+        else:
+            increment_counter(f"{self.name}.shared")
+        return await asyncio.shield(task)
+    
+    def start(self, key, timeout: float) -> Optional[asyncio.Future]:
+        """Lead a flight whose result the caller sets itself, e.g. at the end of a streamed response.
+
+        Returns None if key is already in flight. The future resolves to None
+        after timeout if the caller never gets to set it.
+        """
+        if key in self._flights:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._flights[key] = future
+        future.add_done_callback(lambda _: self._flights.pop(key, None))
+        expiry = loop.call_later(timeout, lambda: future.done() or future.set_result(None))
+        future.add_done_callback(lambda _: expiry.cancel())
+        increment_counter(f"{self.name}.leader")
+        return future
+    
+    async def join(self, key):
+        """Result of the flight running for key, None if there is none"""
+        task = self._flights.get(key)
+        if task is None:
+            return None
+        increment_counter(f"{self.name}.shared")
+        return await asyncio.shield(task)
+    
+    async def stream(self, key, produce):
+        """Yield every delta of produce(), sharing one run among concurrent callers with the same key.
+
+        Callers joining late get the deltas already produced first. The run
+        is cancelled once every caller has gone away, and a caller arriving
+        after that starts a new one.
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            def forget(*_):
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+            
+            broadcast = DeltaBroadcast(produce, forget)
+            self._streams[key] = broadcast
+            broadcast.task.add_done_callback(forget)
+            increment_counter(f"{self.name}.leader")
+        else:
+            increment_counter(f"{self.name}.shared")
+        deltas = broadcast.follow()
+        try:
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+    
+    def __len__(self):
+        return len(self._flights) + len(self._streams)
+
+llm_scheduler = LlmScheduler(
+    max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', '16')),
+    max_queue=int(os.environ.get('LLM_MAX_QUEUE', '200')),
+    max_queue_per_tenant=int(os.environ.get('LLM_MAX_QUEUE_PER_TENANT', '20')),
+    queue_timeout=float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', '10'))
+)
+
+# In-flight generations keyed like answer_cache, and in-flight chat turns keyed by idempotency key
+answer_flights = SingleFlight("answer_flights")
+chat_flights = SingleFlight("chat_flights")
+# A streamed turn leads its flight until the reply is saved; retries stop waiting for it after this
+CHAT_STREAM_FLIGHT_TIMEOUT_SECONDS = float(os.environ.get('CHAT_STREAM_FLIGHT_TIMEOUT_SECONDS', '60'))
+
+
+# ==================== MODEL ROUTING ====================
+
+# Models tenants can pick in admin settings; "provider" is the LlmChat provider name
+LLM_MODELS = {
+    "gemini-3-flash-preview": {"provider": "gemini", "name": "Gemini 3 Flash", "cost_input": 0.10, "cost_output": 0.40},
+    "gemini-2.5-flash": {"provider": "gemini", "name": "Gemini 2.5 Flash", "cost_input": 0.15, "cost_output": 0.60},
+    "gpt-5.2": {"provider": "openai", "name": "GPT-5.2", "cost_input": 2.50, "cost_output": 10.00}
+}
+DEFAULT_AI_MODEL = "gemini-3-flash-preview"
+DEFAULT_MAX_TOKENS_PER_RESPONSE = 500
+
+class LlmTimeout(Exception):
+    """Raised when no model answered before the request deadline"""
+
+async def call_llm_chat(model: str, session_id: str, system_message: str, message: str, max_tokens: int) -> str:
+    """One completion through LlmChat"""
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=session_id,
+        system_message=system_message
+    ).with_model(LLM_MODELS[model]["provider"], model)
+    if max_tokens:
+        chat = chat.with_max_tokens(max_tokens)
+    return await chat.send_message(UserMessage(text=message))
+
+class PooledLlmClient:
+    """Long-lived client for an OpenAI-compatible chat completions endpoint (LLM_API_BASE).
+
+    One httpx.AsyncClient is opened at startup and shared by every request,
+    so keep-alive connections (and their TLS sessions) are reused instead of
+    being set up per chat turn. Closed on shutdown.
+    """
+    def __init__(self, base_url: str, api_key: str, max_connections: int, max_keepalive: int,
+                 keepalive_expiry: float, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                limits=self.limits,
+                timeout=self.timeout
+            )
+    
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def _payload(self, model: str, session_id: str, system_message: str, message: str, max_tokens: int) -> Dict:
+        if self._client is None:
+            raise RuntimeError("LLM client not started")
+        payload = {
+            # provider/model, as LiteLLM-style gateways expect
+            "model": f"{LLM_MODELS[model]['provider']}/{model}" if model in LLM_MODELS else model,
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": message}
+            ],
+            "user": session_id
+        }
+        if max_tokens:
+            payload["max_tokens"] = max_tokens
+        return payload
+    
+    async def __call__(self, model: str, session_id: str, system_message: str, message: str, max_tokens: int) -> str:
+        payload = self._payload(model, session_id, system_message, message, max_tokens)
+        response = await self._client.post("/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+    
+    async def stream(self, model: str, session_id: str, system_message: str, message: str, max_tokens: int):
+        """Yield the content deltas of a streamed completion ("stream": true, sent as server-sent events)"""
+        payload = {**self._payload(model, session_id, system_message, message, max_tokens), "stream": True}
+        async with self._client.stream("POST", "/chat/completions", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                if delta:
+                    yield delta
+
+llm_client = PooledLlmClient(
+    base_url=os.environ.get('LLM_API_BASE', ''),
+    api_key=os.environ.get('CUSTOM_LLM_KEY') or os.environ.get('EMERGENT_LLM_KEY', ''),
+    max_connections=int(os.environ.get('LLM_POOL_MAX_CONNECTIONS', '100')),
+    max_keepalive=int(os.environ.get('LLM_POOL_MAX_KEEPALIVE', '20')),
+    keepalive_expiry=float(os.environ.get('LLM_POOL_KEEPALIVE_SECONDS', '60')),
+    timeout=float(os.environ.get('LLM_DEADLINE_SECONDS', '25'))
+)
+
+def default_llm_provider():
+    """Stub when LLM_PROVIDER=stub, the pooled client when LLM_API_BASE is set, LlmChat otherwise"""
+    if os.environ.get('LLM_PROVIDER') == 'stub':
+        return StubLlmProvider()
+    if os.environ.get('LLM_API_BASE'):
+        return llm_client
+    return call_llm_chat
+
+class StubLlmProvider:
+    """Offline stand-in for call_llm_chat with per-model latency and failures (LLM_PROVIDER=stub)"""
+    def __init__(self, latency_ms: float = 50.0):
+        self.latency_ms: Dict[str, float] = defaultdict(lambda: latency_ms)
+        self.failing: set = set()
+        self.calls: List[str] = []
+    
+    async def __call__(self, model: str, session_id: str, system_message: str, message: str, max_tokens: int) -> str:
+        self.calls.append(model)
+        await asyncio.sleep(self.latency_ms[model] / 1000)
+        if model in self.failing:
+            raise RuntimeError(f"stub model {model} unavailable")
+        words = f"[{model}] Risposta di prova a: {message}".split()
+        return " ".join(words[:max_tokens] if max_tokens else words)
+    
+    async def stream(self, model: str, session_id: str, system_message: str, message: str, max_tokens: int):
+        reply = await self(model, session_id, system_message, message, max_tokens)
+        for delta in re.findall(r'\S+\s*', reply):
+            await asyncio.sleep(0.005)
+            yield delta
+
+class ModelRouter:
+    """Pick a model per request, enforce a deadline and hedge slow calls.
+
+    The tenant's model is tried first while healthy, otherwise the fastest
+    healthy model by rolling p50. If the primary hasn't answered after its
+    rolling p95 (hedge_delay until enough samples exist), the same prompt is
+    sent to the fastest other healthy model and the first reply wins. A
+    model failing max_failures times in a row is skipped for cooldown seconds.
+    """
+    def __init__(self, models: List[str], provider, deadline: float, hedge_delay: float,
+                 min_hedge_delay: float = 0.25, min_samples: int = 20,
+                 max_failures: int = 3, cooldown: float = 30.0, hedging: bool = True):
+        self.models = models
+        self.provider = provider
+        self.deadline = deadline
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.hedging = hedging
+        self.latency: Dict[str, LatencyStats] = defaultdict(lambda: LatencyStats(window=256))
+        self._failures: Dict[str, int] = defaultdict(int)
+        self._unhealthy_until: Dict[str, float] = {}
+    
+    def healthy(self, model: str) -> bool:
+        return self._unhealthy_until.get(model, 0.0) <= time.monotonic()
+    
+    def _expected_ms(self, model: str) -> float:
+        stats = self.latency[model]
+        # Unmeasured models sort first so they get sampled
+        return stats.percentile(0.50) if stats.samples else 0.0
+    
+    def candidates(self, preferred: Optional[str]) -> List[str]:
+        """Models to try, in order"""
+        ranked = sorted((m for m in self.models if m != preferred and self.healthy(m)), key=self._expected_ms)
+        if preferred in LLM_MODELS and self.healthy(preferred):
+            ranked.insert(0, preferred)
+        if not ranked:
+            # Everything is cooling down: still try the tenant's model rather than fail outright
+            ranked = [preferred if preferred in LLM_MODELS else self.models[0]]
+        return ranked
+    
+    def hedge_after(self, model: str) -> float:
+        stats = self.latency[model]
+        if len(stats.samples) < self.min_samples:
+            return self.hedge_delay
+        return max(self.min_hedge_delay, stats.percentile(0.95) / 1000)
+    
+    def _succeeded(self, model: str, ms: float):
+        self.latency[model].record(ms)
+        record_latency(f"llm.{model}", ms)
+        self._failures[model] = 0
+    
+    def _failed(self, model: str):
+        increment_counter(f"llm.{model}.errors")
+        self._failures[model] += 1
+        if self._failures[model] >= self.max_failures:
+            self._unhealthy_until[model] = time.monotonic() + self.cooldown
+            self._failures[model] = 0
+            logger.warning(f"LLM model {model} marked unhealthy for {self.cooldown}s")
+    
+    async def _timed_call(self, model: str, *args) -> str:
+        start = time.perf_counter()
+        try:
+            result = await self.provider(model, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._failed(model)
+            raise
+        self._succeeded(model, (time.perf_counter() - start) * 1000)
+        return result
+    
+    async def complete(self, session_id: str, system_message: str, message: str,
+                       model: Optional[str] = None, max_tokens: int = DEFAULT_MAX_TOKENS_PER_RESPONSE) -> tuple:
+        """Return (reply, model that produced it); raises LlmTimeout or the last upstream error"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        queue = self.candidates(model)
+        args = (session_id, system_message, message, max_tokens)
+        running: Dict[asyncio.Task, str] = {}
+        last_error: Optional[Exception] = None
+        
+        def launch():
+            next_model = queue.pop(0)
+            running[asyncio.ensure_future(self._timed_call(next_model, *args))] = next_model
+            return next_model
+        
+        primary = launch()
+        hedge_at = loop.time() + self.hedge_after(primary) if self.hedging else None
+        try:
+            while running:
+                now = loop.time()
+                if now >= deadline:
+                    break
+                timeout = deadline - now
+                if hedge_at is not None and queue:
+                    timeout = min(timeout, max(0.0, hedge_at - now))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                for task in done:
+                    answered_by = running.pop(task)
+                    if task.exception() is None:
+                        if answered_by != primary:
+                            increment_counter("llm_router.hedge_won" if running else "llm_router.fallback")
+                        return task.result(), answered_by
+                    last_error = task.exception()
+                
+                if queue and (not running or (hedge_at is not None and loop.time() >= hedge_at)):
+                    # Primary failed (fallback) or is slower than its usual p95 (hedge)
+                    increment_counter("llm_router.hedged" if running else "llm_router.retried")
+                    launch()
+                    hedge_at = None
+        finally:
+            for task in running:
+                task.cancel()
+        
+        if running:
+            for timed_out in running.values():
+                self._failed(timed_out)
+            increment_counter("llm_router.deadline_exceeded")
+            raise LlmTimeout()
+        raise last_error or LlmTimeout()
+    
+    @property
+    def streaming(self) -> bool:
+        """Whether the provider can stream deltas (the pooled client); LlmChat cannot"""
+        return hasattr(self.provider, "stream")
+    
+    async def stream(self, session_id: str, system_message: str, message: str,
+                     model: Optional[str] = None, max_tokens: int = DEFAULT_MAX_TOKENS_PER_RESPONSE):
+        """Yield the reply as the model's own deltas.
+
+        Candidates are tried in the same order as complete(), without hedging:
+        a model that fails or misses the deadline before its first delta hands
+        over to the next one. Once text has been sent the model is committed,
+        and a later error is raised to the caller.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        last_error: Optional[Exception] = None
+        for attempt, candidate in enumerate(self.candidates(model)):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            if attempt:
+                increment_counter("llm_router.retried")
+            start = time.perf_counter()
+            deltas = self.provider.stream(candidate, session_id, system_message, message, max_tokens)
+            try:
+                try:
+                    first = await asyncio.wait_for(deltas.__anext__(), remaining)
+                except StopAsyncIteration:
+                    first = None
+                except asyncio.TimeoutError:
+                    self._failed(candidate)
+                    last_error = LlmTimeout()
+                    continue
+                except Exception as e:
+                    self._failed(candidate)
+                    last_error = e
+                    continue
+                record_latency(f"llm.{candidate}.first_token", (time.perf_counter() - start) * 1000)
+                if attempt:
+                    increment_counter("llm_router.fallback")
+                try:
+                    if first is not None:
+                        yield first
+                        async for delta in deltas:
+                            yield delta
+                except Exception:
+                    self._failed(candidate)
+                    raise
+                self._succeeded(candidate, (time.perf_counter() - start) * 1000)
+                return
+            finally:
+                await deltas.aclose()
+        if isinstance(last_error, LlmTimeout) or last_error is None:
+            increment_counter("llm_router.deadline_exceeded")
+        raise last_error or LlmTimeout()
+    
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        return {
+            model: {
+                **self.latency[model].summary(),
+                "healthy": self.healthy(model),
+                "cooldown_s": round(max(0.0, self._unhealthy_until.get(model, 0.0) - now), 1),
+                "hedge_after_ms": round(self.hedge_after(model) * 1000, 1)
+            }
+            for model in LLM_MODELS
+        }
+
+model_router = ModelRouter(
+    models=[m.strip() for m in os.environ.get('LLM_ROUTE_MODELS', 'gemini-3-flash-preview,gemini-2.5-flash').split(',') if m.strip() in LLM_MODELS],
+    provider=default_llm_provider(),
+    deadline=float(os.environ.get('LLM_DEADLINE_SECONDS', '25')),
+    hedge_delay=float(os.environ.get('LLM_HEDGE_DELAY_SECONDS', '6')),
+    hedging=os.environ.get('LLM_HEDGING', 'true').lower() == 'true'
+)
+
+
+# ==================== PROMPT BUILDER ====================
+
+DEFAULT_PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '1500'))
+# Split of the budget left after the fixed instructions; what a section doesn't use goes to the others
+PROMPT_SECTION_SHARES = {"knowledge": 0.5, "history": 0.3, "products": 0.2}
+MIN_PARTIAL_PIECE_TOKENS = 40
+_PROMPT_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+
+def estimate_tokens(text: str) -> int:
+    """Local token estimate: ~4 characters per BPE piece of a word, one token per punctuation mark"""
+    if not text:
+        return 0
+    return sum((len(t) + 3) // 4 if t[0].isalnum() or t[0] == "_" else 1 for t in _PROMPT_TOKEN_RE.findall(text))
+
+def shorten_to_tokens(text: str, max_tokens: int) -> str:
+    """Leading sentences of text that fit in max_tokens (leading words if not even the first one does)"""
+    kept, used = [], 0
+    for sentence in _SENTENCE_END_RE.split(text):
+        cost = estimate_tokens(sentence)
+        if used + cost > max_tokens:
+            break
+        kept.append(sentence)
+        used += cost
+    if kept:
+        return " ".join(kept)
+    words, used = [], 1
+    for word in text.split():
+        used += estimate_tokens(word)
+        if used > max_tokens:
+            break
+        words.append(word)
+    return " ".join(words) + " …" if words else ""
+
+def allocate_prompt_budget(budget: int, demands: Dict[str, int]) -> Dict[str, int]:
+    """Split budget by PROMPT_SECTION_SHARES, then hand what a section doesn't need to the others"""
+    budget = max(0, budget)
+    allocation = {name: min(demands.get(name, 0), int(budget * share)) for name, share in PROMPT_SECTION_SHARES.items()}
+    spare = budget - sum(allocation.values())
+    for name in PROMPT_SECTION_SHARES:
+        extra = min(spare, demands.get(name, 0) - allocation[name])
+        allocation[name] += extra
+        spare -= extra
+    return allocation
+
+def pack_pieces(pieces: List[str], budget: int) -> tuple:
+    """Keep pieces in rank order while they fit, shorten the first one that doesn't and drop the rest.
+
+    Returns (kept pieces, tokens used, number of pieces dropped or shortened).
+    """
+    kept, used = [], 0
+    for i, piece in enumerate(pieces):
+        cost = estimate_tokens(piece) + 1  # +1 for the separator
+        if used + cost <= budget:
+            kept.append(piece)
+            used += cost
+            continue
+        if budget - used >= MIN_PARTIAL_PIECE_TOKENS:
+            short = shorten_to_tokens(piece, budget - used - 1)
+            if short:
+                kept.append(short)
+                used += estimate_tokens(short) + 1
+        return kept, used, len(pieces) - i
+    return kept, used, 0
+
+def build_chat_system_message(bot_name: str, company_name: str, kb_content: str, product_context: str,
+                              history_context: str = "") -> str:
+    """Build the system prompt for the sales assistant"""
+    return f"""Sei {bot_name}, un assistente vendite AI professionale e amichevole per {company_name}.
+Il tuo obiettivo è aiutare i visitatori a trovare prodotti e rispondere alle loro domande.
+Rispondi sempre in italiano, in modo conciso e utile.
+
+IMPORTANTE - RICERCA PRODOTTI:
+- Se l'utente cerca un prodotto e trovi risultati nel catalogo, descrivi brevemente i prodotti trovati
+- Non inventare prodotti o prezzi, usa solo quelli forniti nel contesto
+- Se non trovi prodotti corrispondenti, suggerisci di descrivere meglio cosa cerca o di contattare l'azienda
+
+{f"CONOSCENZE AZIENDALI:{chr(10)}{kb_content}" if kb_content else ""}
+{product_context}
+{f"{chr(10)}CONVERSAZIONE PRECEDENTE:{chr(10)}{history_context}" if history_context else ""}
+"""
+
+def build_chat_prompt(bot_name: str, company_name: str, message: str, knowledge: List[str],
+                      products: List[Dict], history: List[str] = (),
+                      budget: int = DEFAULT_PROMPT_TOKEN_BUDGET) -> Dict:
+    """Assemble the system prompt within a token budget.
+
+    knowledge, products and history come best first (history most recent
+    first). The fixed instructions and the visitor message are always kept;
+    the rest of the budget is split across the three sections and each
+    section keeps its highest-ranked pieces that fit.
+    """
+    product_lines = [
+        f"{i}. {p.get('name', 'Prodotto')} - {p.get('price', 'Prezzo non disponibile')}"
+        for i, p in enumerate(products, 1)
+    ]
+    base_tokens = estimate_tokens(build_chat_system_message(bot_name, company_name, "", "")) + estimate_tokens(message)
+    sections = {"knowledge": list(knowledge), "products": product_lines, "history": list(history)}
+    demands = {name: sum(estimate_tokens(p) + 1 for p in pieces) for name, pieces in sections.items()}
+    allocation = allocate_prompt_budget(budget - base_tokens, demands)
+    
+    packed, tokens, trimmed = {}, {"base": base_tokens}, 0
+    for name, pieces in sections.items():
+        packed[name], tokens[name], dropped = pack_pieces(pieces, allocation[name])
+        trimmed += dropped
+    
+    product_context = ""
+    if packed["products"]:
+        product_context = "\n\nPRODOTTI TROVATI NEL CATALOGO:\n" + "\n".join(packed["products"]) + "\n"
+    # History is packed newest first but reads oldest first
+    system_message = build_chat_system_message(
+        bot_name, company_name, "\n\n".join(packed["knowledge"]), product_context,
+        "\n".join(reversed(packed["history"]))
+    )
+    tokens["total"] = estimate_tokens(system_message) + estimate_tokens(message)
+    tokens["budget"] = budget
+    tokens["trimmed_pieces"] = trimmed
+    return {"system_message": system_message, "tokens": tokens}
+
+
+# ==================== MESSAGE WRITER ====================
+
+# Flush ids kept per conversation to recognise a counter bump that already landed
+COUNTER_FLUSH_IDS = 20
+
+class MessageWriter:
+    """Write-behind buffer for chat messages, new conversations and conversation counters.
+
+    Documents are flushed with insert_many/bulk_write when the buffer reaches
+    flush_size or every flush_interval seconds. Unflushed documents stay
+    readable through pending_messages/pending_conversation.
+
+    Each counter bump carries a flush id that is recorded on the
+    conversation, so retrying a bulk_write that partly landed doesn't count
+    the same messages twice.
+    """
+    def __init__(self, flush_size: int, flush_interval: float, max_buffer: int):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._conversations: List[Dict] = []
+        self._messages: List[Dict] = []
+        self._counters: Dict[str, Dict] = {}
+        self._failed_counters: List[Dict] = []
+        self._in_flight: tuple = ([], [])
+        self._retry = False
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    def add(self, messages: List[Dict], new_conversation: Optional[Dict] = None, count: int = 0):
+        """Queue messages (and the conversation they open) and bump that conversation's counters"""
+        if new_conversation:
+            self._conversations.append(new_conversation)
+        self._messages.extend(messages)
+        if count:
+            session_id = messages[0]["session_id"]
+            counter = self._counters.setdefault(
+                session_id, {"session_id": session_id, "flush_id": uuid.uuid4().hex, "count": 0}
+            )
+            counter["count"] += count
+            counter["last_message_at"] = messages[-1]["timestamp"]
+        if len(self._messages) >= self.flush_size:
+            spawn_background(self.flush())
+    
+    def pending_messages(self, session_id: str = None, conversation_id: str = None) -> List[Dict]:
+        return [
+            m for m in self._in_flight[1] + self._messages
+            if (session_id and m["session_id"] == session_id)
+            or (conversation_id and m["conversation_id"] == conversation_id)
+        ]
+    
+    def pending_conversation(self, session_id: str) -> Optional[Dict]:
+        for conversation in self._in_flight[0] + self._conversations:
+            if conversation["session_id"] == session_id:
+                return conversation
+        return None
+    
+    async def flush(self):
+        async with self._lock:
+            if not (self._conversations or self._messages or self._counters or self._failed_counters):
+                return
+            conversations, messages = self._conversations, self._messages
+            counters = self._failed_counters + list(self._counters.values())
+            self._conversations, self._messages, self._counters, self._failed_counters = [], [], {}, []
+            self._in_flight = (conversations, messages)
+            retry, self._retry = self._retry, False
+            start = time.perf_counter()
+            try:
+                # Conversations first so the counter updates below can find them
+                if conversations:
+                    await self._write(db.conversations, conversations, retry)
+                if messages:
+                    await self._write(db.messages, messages, retry)
+                if counters:
+                    await db.conversations.bulk_write([
+                        UpdateOne(
+                            {"session_id": c["session_id"], "counter_flushes": {"$ne": c["flush_id"]}},
+                            {"$set": {"last_message_at": c["last_message_at"]},
+                             "$inc": {"messages_count": c["count"]},
+                             "$push": {"counter_flushes": {"$each": [c["flush_id"]], "$slice": -COUNTER_FLUSH_IDS}}}
+                        )
+                        for c in counters
+                    ], ordered=False)
+                record_latency("message_writer.flush", (time.perf_counter() - start) * 1000)
+                increment_counter("message_writer.messages", len(messages))
+            except Exception as e:
+                logger.error(f"Error flushing {len(messages)} messages: {e}")
+                increment_counter("message_writer.errors")
+                self._requeue(conversations, messages, counters)
+            finally:
+                self._in_flight = ([], [])
+    
+    async def _write(self, collection, docs: List[Dict], retry: bool):
+        """insert_many normally; upserts by id when retrying a batch that may have partly landed"""
+        if retry:
+            await collection.bulk_write(
+                [UpdateOne({"id": d["id"]}, {"$setOnInsert": d}, upsert=True) for d in docs], ordered=False
+            )
+        else:
+            # Copies, so the buffered dicts never pick up Mongo's _id
+            await collection.insert_many([dict(d) for d in docs], ordered=False)
+    
+    def _requeue(self, conversations: List[Dict], messages: List[Dict], counters: List[Dict]):
+        self._retry = True
+        self._conversations = conversations + self._conversations
+        self._messages = messages + self._messages
+        # Retried with their own flush ids, never merged into newer bumps
+        self._failed_counters = counters + self._failed_counters
+        overflow = len(self._messages) - self.max_buffer
+        if overflow > 0:
+            logger.error(f"Message buffer full, dropping {overflow} oldest messages")
+            del self._messages[:overflow]
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Message writer error: {e}")
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+message_writer = MessageWriter(
+    flush_size=int(os.environ.get('MESSAGE_FLUSH_SIZE', '200')),
+    flush_interval=float(os.environ.get('MESSAGE_FLUSH_INTERVAL_SECONDS', '0.5')),
+    max_buffer=int(os.environ.get('MESSAGE_BUFFER_MAX', '20000'))
+)
+
+
+# ==================== CONVERSATION MEMORY ====================
+
+HISTORY_MESSAGES = int(os.environ.get('HISTORY_MESSAGES', '12'))
+HISTORY_COMPACT_BATCH = int(os.environ.get('HISTORY_COMPACT_BATCH', '8'))
+HISTORY_MESSAGE_TOKENS = int(os.environ.get('HISTORY_MESSAGE_TOKENS', '150'))
+HISTORY_SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '300'))
+HISTORY_SUMMARY_LINE_TOKENS = 40
+HISTORY_FIELDS = {"_id": 0, "id": 1, "role": 1, "content": 1, "timestamp": 1}
+HISTORY_ROLE_LABELS = {"user": "Visitatore", "assistant": "Assistente"}
+
+def history_line(message: Dict, max_tokens: int = HISTORY_MESSAGE_TOKENS) -> str:
+    content = " ".join(message["content"].split())
+    if estimate_tokens(content) > max_tokens:
+        content = shorten_to_tokens(content, max_tokens)
+    return f"{HISTORY_ROLE_LABELS.get(message['role'], message['role'])}: {content}"
+
+def fold_into_summary(summary: str, messages: List[Dict]) -> str:
+    """Append one short line per compacted message and keep the newest lines within HISTORY_SUMMARY_TOKENS.
+
+    Extractive on purpose: it runs on the chat path's background tasks and
+    must not cost a model call per compaction.
+    """
+    lines = summary.split("\n") if summary else []
+    lines.extend(history_line(m, HISTORY_SUMMARY_LINE_TOKENS) for m in messages)
+    kept, used = [], 0
+    for line in reversed(lines):
+        used += estimate_tokens(line) + 1
+        if used > HISTORY_SUMMARY_TOKENS:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+async def load_conversation_history(conversation: Dict) -> Dict:
+    """Messages not yet folded into the conversation summary, newest first.
+
+    Reads at most HISTORY_MESSAGES + HISTORY_COMPACT_BATCH messages through
+    the (session_id, timestamp) index, plus any still in the write buffer.
+    "compact" is set once that many have piled up, so the summary is
+    rewritten once per batch rather than on every turn.
+    """
+    session_id = conversation["session_id"]
+    summary_until = conversation.get("summary_until", "")
+    limit = HISTORY_MESSAGES + HISTORY_COMPACT_BATCH
+    pending = [m for m in message_writer.pending_messages(session_id=session_id) if m["timestamp"] > summary_until]
+    if not pending and not conversation.get("messages_count"):
+        # Conversation opened by this request: nothing to read
+        return {"summary": "", "messages": [], "compact": False}
+    stored = await db.messages.find(
+        {"session_id": session_id, "timestamp": {"$gt": summary_until}}, HISTORY_FIELDS
+    ).sort("timestamp", -1).to_list(limit)
+    recent = sorted(merge_pending_messages(stored, pending), key=lambda m: m["timestamp"], reverse=True)[:limit]
+    return {
+        "summary": conversation.get("summary", ""),
+        "messages": recent,
+        "compact": len(recent) >= limit
+    }
+
+async def compact_conversation(conversation: Dict):
+    """Fold everything older than the last HISTORY_MESSAGES messages into the stored summary"""
+    summary_until = conversation.get("summary_until", "")
+    messages = await db.messages.find(
+        {"session_id": conversation["session_id"], "timestamp": {"$gt": summary_until}}, HISTORY_FIELDS
+    ).sort("timestamp", 1).to_list(None)
+    older = messages[:-HISTORY_MESSAGES]
+    if not older:
+        return
+    # Conditional on summary_until so two overlapping compactions can't fold the same messages twice
+    result = await db.conversations.update_one(
+        {"id": conversation["id"], "summary_until": conversation.get("summary_until")},
+        {"$set": {
+            "summary": fold_into_summary(conversation.get("summary", ""), older),
+            "summary_until": older[-1]["timestamp"]
+        }}
+    )
+    if result.modified_count:
+        increment_counter("conversation_memory.compactions")
+
+def history_pieces(history: Dict) -> List[str]:
+    """Prompt pieces for build_chat_prompt: recent messages newest first, then the summary"""
+    pieces = [history_line(m) for m in history["messages"]]
+    if history["summary"]:
+        pieces.append(f"Riassunto dei messaggi precedenti:\n{history['summary']}")
+    return pieces
+
+
+# ==================== INGESTION JOBS ====================
+
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', '5'))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', '2'))
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', '2'))
+JOB_PUBLIC_FIELDS = {"_id": 0, "payload": 0, "lease_owner": 0}
+
+def utc_in(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+async def active_source_job(source_id: str) -> Optional[Dict]:
+    """The queued or running job holding a source, if any"""
+    return await db.jobs.find_one({"active_source": source_id}, {"_id": 0, "id": 1, "type": 1, "status": 1})
+
+async def enqueue_job(job_type: str, user_id: str, source_id: Optional[str] = None, payload: Optional[Dict] = None) -> str:
+    """Persist a queued job and wake a worker; returns the job id.
+
+    A source has at most one queued or running job: the job carries the
+    source id in active_source (unique, removed when the job ends) and if
+    another job already holds the source, that job's id is returned instead.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
         "id": str(uuid.uuid4()),
-        "source_id": source_id,
+        "type": job_type,
         "user_id": user_id,
-        "product_url": url,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "source_id": source_id,
+        "payload": payload or {},
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": JOB_MAX_ATTEMPTS,
+        "run_after": now,
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "progress": {"stage": "queued"},
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now
     }
+    if source_id:
+        job["active_source"] = source_id
+    for _ in range(3):
+        try:
+            await db.jobs.insert_one(job)
+        except DuplicateKeyError:
+            active = await active_source_job(source_id)
+            if active:
+                increment_counter(f"jobs.{job_type}.deduplicated")
+                return active["id"]
+            # The other job ended between the insert and the lookup
+            job.pop("_id", None)
+            continue
+        job_worker.wake()
+        return job["id"]
+    raise HTTPException(status_code=409, detail="Un'altra elaborazione della fonte è in corso")
+
+class JobCancelled(Exception):
+    """Raised from JobProgress.update once the job no longer belongs to this worker
+    (cancelled, deleted, or its lease was taken over)"""
+
+class JobProgress:
+    """Handed to job handlers: records progress and renews the lease while the job runs.
+
+    Each update is also the handler's cancellation point: it raises
+    JobCancelled when the job was cancelled or taken over.
+    """
+    def __init__(self, job: Dict, owner: str):
+        self.job = job
+        self.owner = owner
     
-    # Find name from h1 or title
-    h1 = soup.select_one('h1')
-    if h1:
-        product['name'] = h1.get_text(strip=True)[:200]
-    else:
-        title = soup.select_one('title')
-        if title:
-            product['name'] = title.get_text(strip=True).split('|')[0].split('-')[0].strip()[:200]
+    async def update(self, stage: str, done: Optional[int] = None, total: Optional[int] = None):
+        progress = {"stage": stage}
+        if done is not None:
+            progress["done"] = done
+        if total is not None:
+            progress["total"] = total
+        result = await db.jobs.update_one(
+            {"id": self.job["id"], "lease_owner": self.owner, "status": "running"},
+            {"$set": {"progress": progress, "lease_expires_at": utc_in(JOB_LEASE_SECONDS),
+                      "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        if result.matched_count == 0:
+            raise JobCancelled(f"job {self.job['id']} cancelled")
+
+class JobWorker:
+    """Runs queued jobs from db.jobs on a few worker coroutines.
+
+    A job is claimed with find_one_and_update, which sets a lease; a job
+    whose worker died is picked up again once its lease expires. Failures
+    are retried with exponential backoff up to max_attempts.
+    """
+    def __init__(self, handlers: Dict[str, Any], concurrency: int):
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
     
-    # Find main image
-    main_img = soup.select_one('.product-image img, .woocommerce-product-gallery img, [class*="product"] img')
-    if main_img:
-        img_src = main_img.get('src') or main_img.get('data-src')
-        if img_src and not img_src.startswith('http'):
-            img_src = base_url + img_src if img_src.startswith('/') else base_url + '/' + img_src
-        product['image_url'] = img_src
+    def wake(self):
+        self._wakeup.set()
     
-    # Find price
-    price_el = soup.select_one('.price, [class*="price"], .woocommerce-Price-amount')
-    if price_el:
-        product['price'] = price_el.get_text(strip=True)
-        price_match = re.search(r'[\d,.]+', product['price'].replace(',', '.'))
-        if price_match:
+    async def claim(self) -> Optional[Dict]:
+        now = datetime.now(timezone.utc).isoformat()
+        return await db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ]},
+            {
+                "$set": {"status": "running", "lease_owner": self.owner,
+                         "lease_expires_at": utc_in(JOB_LEASE_SECONDS), "updated_at": now},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_after", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _finish(self, job: Dict, update: Dict):
+        update["updated_at"] = datetime.now(timezone.utc).isoformat()
+        changes = {"$set": {**update, "lease_owner": None, "lease_expires_at": None}}
+        if update["status"] != "queued":
+            # Ended: the source is free for the next job
+            changes["$unset"] = {"active_source": ""}
+        await db.jobs.update_one({"id": job["id"], "lease_owner": self.owner}, changes)
+    
+    async def run_job(self, job: Dict):
+        handler = self.handlers[job["type"]]
+        start = time.perf_counter()
+        try:
+            if job["attempts"] > job["max_attempts"]:
+                raise RuntimeError("lease expired too many times")
+            result = await handler(job, JobProgress(job, self.owner))
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back rather than waiting for the lease to lapse
+            await self._finish(job, {"status": "queued", "attempts": job["attempts"] - 1})
+            raise
+        except JobCancelled:
+            logger.info(f"Job {job['id']} ({job['type']}) stopped: cancelled")
+            increment_counter(f"jobs.{job['type']}.cancelled")
+            await discard_orphaned_content(job)
+            return
+        except Exception as e:
+            logger.error(f"Job {job['id']} ({job['type']}) failed on attempt {job['attempts']}: {e}")
+            increment_counter(f"jobs.{job['type']}.errors")
+            if job["attempts"] < job["max_attempts"]:
+                await self._finish(job, {
+                    "status": "queued",
+                    "error": str(e),
+                    "run_after": utc_in(JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+                })
+            else:
+                await self._finish(job, {"status": "failed", "error": str(e), "progress": {"stage": "failed"}})
+                await job_failed(job, str(e))
+            return
+        record_latency(f"jobs.{job['type']}", (time.perf_counter() - start) * 1000)
+        await discard_orphaned_content(job)
+        # Payloads (uploaded PDFs included) are only needed until the job succeeds
+        await self._finish(job, {"status": "done", "result": result, "error": None,
+                                 "progress": {"stage": "done"}, "payload": {}})
+    
+    async def _run(self):
+        while True:
             try:
-                product['price_value'] = float(price_match.group().replace(',', '.'))
-            except:
-                pass
+                job = await self.claim()
+            except Exception as e:
+                logger.error(f"Job claim error: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run_job(job)
     
-    # Find description
-    desc_el = soup.select_one('.description, .product-description, [class*="description"]')
-    if desc_el:
-        product['description'] = desc_el.get_text(strip=True)[:500]
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
     
-    product['in_stock'] = True
-    return product
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
 
-async def search_products(user_id: str, query: str, limit: int = 6) -> List[Dict]:
-    """Search products by text query"""
-    # Create search regex for each word in the query
-    words = query.lower().split()
-    search_conditions = []
-    
-    for word in words:
-        if len(word) > 2:  # Skip very short words
-            regex = {"$regex": word, "$options": "i"}
-            search_conditions.append({
-                "$or": [
-                    {"name": regex},
-                    {"description": regex},
-                    {"category": regex},
-                    {"brand": regex}
-                ]
-            })
-    
-    if not search_conditions:
-        return []
+async def job_failed(job: Dict, error: str):
+    """Mark the source a job was building as failed"""
+    if job.get("source_id") and job["type"] in ("url_source", "crawl_source", "pdf_source"):
+        await db.knowledge_sources.update_one(
+            {"id": job["source_id"]}, {"$set": {"status": "error", "error": error}}
+        )
+    if job["type"] == "pdf_source" and job.get("source_id"):
+        await delete_pdf_uploads(source_id=job["source_id"])
+
+async def cancel_source_jobs(source_id: str):
+    """Cancel queued and running jobs for a source; running handlers stop at their next progress update"""
+    await db.jobs.update_many(
+        {"source_id": source_id, "status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "cancelled", "progress": {"stage": "cancelled"}, "lease_owner": None,
+                  "lease_expires_at": None, "updated_at": datetime.now(timezone.utc).isoformat()},
+         "$unset": {"active_source": ""}}
+    )
+
+async def discard_orphaned_content(job: Dict):
+    """Delete whatever a job stored for a source that was deleted while it ran"""
+    source_id = job.get("source_id")
+    if not source_id or await db.knowledge_sources.find_one({"id": source_id}, {"_id": 0, "id": 1}):
+        return
+    await reset_source_content(source_id, job["user_id"])
+    await delete_pdf_uploads(source_id=source_id)
+
+async def reset_source_content(source_id: str, user_id: str):
+    """Drop chunks, products and page states a previous attempt may have stored, so a retry starts clean"""
+    await db.knowledge_chunks.delete_many({"source_id": source_id})
+    await invalidate_knowledge_index(user_id)
+    await db.products.delete_many({"source_id": source_id})
+    await unindex_products(user_id, source_id=source_id)
+    await db.source_pages.delete_many({"source_id": source_id})
+
+PRODUCT_CONTENT_FIELDS = ("name", "description", "price", "price_value", "image_url",
+                          "category", "brand", "sku", "in_stock")
+
+def product_fingerprint(product: Dict) -> str:
+    """Hash of the scraped fields, so rescans only rewrite products that changed"""
+    values = [product.get(field) for field in PRODUCT_CONTENT_FIELDS]
+    return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+async def insert_source_products(user_id: str, products: List[Dict]):
+    for product in products:
+        product["fingerprint"] = product_fingerprint(product)
+    await db.products.insert_many(attach_embeddings(products))
+    await index_products(user_id, products)
+
+async def store_source_products(source_id: str, user_id: str, products: List[Dict]) -> int:
+    if products:
+        await insert_source_products(user_id, products)
+    await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"products_count": len(products)}})
+    return len(products)
+
+async def load_page_states(source_id: str) -> Dict[str, Dict]:
+    pages = await db.source_pages.find({"source_id": source_id}, {"_id": 0, "source_id": 0, "user_id": 0}).to_list(None)
+    return {page.pop("url"): page for page in pages}
+
+async def save_page_states(source_id: str, user_id: str, states: Dict[str, Dict], changed: set):
+    """Write the states of changed pages and forget pages that left the catalog"""
+    now = datetime.now(timezone.utc).isoformat()
+    operations = [
+        UpdateOne({"source_id": source_id, "url": url},
+                  {"$set": {**states[url], "user_id": user_id, "fetched_at": now}}, upsert=True)
+        for url in changed
+    ]
+    if operations:
+        await db.source_pages.bulk_write(operations, ordered=False)
+    await db.source_pages.delete_many({"source_id": source_id, "url": {"$nin": list(states)}})
+
+async def sync_source_products(source_id: str, user_id: str, products: List[Dict], keep_urls: set) -> Dict:
+    """Apply a rescan as a diff on the stored products.
+
+    New and changed products (by fingerprint) are upserted keyed on
+    product_url, so existing products keep their id and cart items stay
+    valid; unchanged ones are not written. Products whose product_url is
+    no longer in keep_urls, and duplicates left by older scans, are deleted.
+    """
+    existing, duplicates = {}, []
+    async for doc in db.products.find({"source_id": source_id}, {"_id": 0, "id": 1, "product_url": 1, "fingerprint": 1}):
+        if doc.get("product_url") in existing:
+            duplicates.append(doc["id"])
+        else:
+            existing[doc.get("product_url")] = doc
     
-    # Find products matching all words
-    products = await db.products.find(
-        {"user_id": user_id, "$and": search_conditions},
-        {"_id": 0}
-    ).limit(limit).to_list(limit)
+    changed, added, scanned = [], 0, set()
+    for product in products:
+        if product["product_url"] in scanned:
+            continue
+        scanned.add(product["product_url"])
+        product["fingerprint"] = product_fingerprint(product)
+        current = existing.get(product["product_url"])
+        if current is None:
+            added += 1
+        elif current.get("fingerprint") == product["fingerprint"]:
+            continue
+        else:
+            product["id"] = current["id"]
+        changed.append(product)
     
-    # If no exact match, try partial match
-    if not products and words:
-        products = await db.products.find(
-            {"user_id": user_id, "$or": search_conditions},
-            {"_id": 0}
-        ).limit(limit).to_list(limit)
+    if changed:
+        now = datetime.now(timezone.utc).isoformat()
+        operations = []
+        for product in attach_embeddings(changed):
+            fields = {key: value for key, value in product.items() if key not in ("id", "created_at")}
+            operations.append(UpdateOne(
+                {"source_id": source_id, "product_url": product["product_url"]},
+                {"$set": {**fields, "updated_at": now},
+                 "$setOnInsert": {"id": product["id"], "created_at": product["created_at"]}},
+                upsert=True
+            ))
+        await db.products.bulk_write(operations, ordered=False)
+        await index_products(user_id, changed)
     
-    return products
+    removed = duplicates + [doc["id"] for url, doc in existing.items() if url not in keep_urls]
+    if removed:
+        await db.products.delete_many({"source_id": source_id, "id": {"$in": removed}})
+        await unindex_products(user_id, removed)
+    
+    products_count = await db.products.count_documents({"source_id": source_id})
+    await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"products_count": products_count}})
+    return {"products_count": products_count, "added": added, "updated": len(changed) - added,
+            "removed": len(removed)}
+
+async def run_url_source_job(job: Dict, progress: JobProgress) -> Dict:
+    source_id, user_id, url = job["source_id"], job["user_id"], job["payload"]["url"]
+    if job["attempts"] > 1:
+        await reset_source_content(source_id, user_id)
+    
+    await progress.update("fetching")
+    response = await fetch_client.get(url)
+    if response.status_code != 200:
+        # Error pages would otherwise be indexed as the source's content
+        raise FetchError(f"{url}: HTTP {response.status_code}")
+    html = response.text
+    
+    await progress.update("indexing")
+    await store_page_content(source_id, user_id, html)
+    
+    await progress.update("extracting_products")
+    products = await parse_pool.run(extract_products_from_html, html, url, source_id, user_id)
+    products_count = await store_source_products(source_id, user_id, products)
+    page_url = normalize_crawl_url(url)
+    await save_page_states(source_id, user_id, {page_url: page_state(response, products)}, {page_url})
+    return {"products_count": products_count}
+
+async def store_page_content(source_id: str, user_id: str, html: str):
+    """Store and index the readable text of a page, not its markup"""
+    text = await parse_pool.run(extract_page_text, html)
+    text = text[:KNOWLEDGE_TEXT_MAX_CHARS]
+    html_bytes = len(html.encode("utf-8"))
+    await db.knowledge_sources.update_one(
+        {"id": source_id},
+        {"$set": {**source_content_fields(text), "html_bytes": html_bytes,
+                  "status": "active" if text else "error"}}
+    )
+    record_size("knowledge.html_bytes", html_bytes)
+    record_size("knowledge.text_bytes", len(text.encode("utf-8")))
+    if text:
+        await index_knowledge_source(source_id, user_id, text)
+
+async def crawl_source(source_id: str, user_id: str, url: str, max_pages: int, progress: JobProgress,
+                       on_products, start_response: Optional[FetchResult] = None,
+                       known_pages: Optional[Dict[str, Dict]] = None) -> CatalogCrawler:
+    """Run a CatalogCrawler, reporting its stats on the source document and the job"""
+    async def report(stats: Dict):
+        await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"crawl_stats": stats}})
+        await progress.update("crawling", stats["pages"] + stats["unchanged_pages"], stats["discovered"])
+    
+    crawler = CatalogCrawler(url, source_id, user_id, on_products, report, max_pages=max_pages,
+                             known_pages=known_pages)
+    await crawler.run(start_response)
+    return crawler
+
+async def run_crawl_source_job(job: Dict, progress: JobProgress) -> Dict:
+    source_id, user_id, url = job["source_id"], job["user_id"], job["payload"]["url"]
+    if job["attempts"] > 1:
+        await reset_source_content(source_id, user_id)
+    
+    await progress.update("fetching")
+    response = await fetch_client.get(url)
+    if response.status_code != 200:
+        # Error pages would otherwise be indexed as the source's content
+        raise FetchError(f"{url}: HTTP {response.status_code}")
+    html = response.text
+    
+    await progress.update("indexing")
+    await store_page_content(source_id, user_id, html)
+    await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"products_count": 0, "crawl_stats": None}})
+    
+    # Products are stored batch by batch as the crawl finds them
+    async def store_batch(products: List[Dict]):
+        await insert_source_products(user_id, products)
+        await db.knowledge_sources.update_one({"id": source_id}, {"$inc": {"products_count": len(products)}})
+    
+    max_pages = job["payload"].get("max_pages") or CRAWL_MAX_PAGES
+    crawler = await crawl_source(source_id, user_id, url, max_pages, progress, store_batch, start_response=response)
+    await save_page_states(source_id, user_id, crawler.page_states, crawler.changed_pages)
+    stats = crawler.stats()
+    return {"products_count": stats["products"], "crawl_stats": stats}
+
+async def run_pdf_source_job(job: Dict, progress: JobProgress) -> Dict:
+    source_id, user_id = job["source_id"], job["user_id"]
+    if job["attempts"] > 1:
+        await reset_source_content(source_id, user_id)
+    
+    payload = job["payload"]
+    await progress.update("downloading")
+    # Spooled to local disk so the parse pool's workers can open it by path
+    with tempfile.NamedTemporaryFile(suffix=".pdf", dir=PDF_SPOOL_DIR) as spool:
+        if payload.get("pdf") is not None:
+            # Queued before uploads moved to GridFS
+            spool.write(payload["pdf"])
+        else:
+            await pdf_uploads.download_to_stream(ObjectId(payload["file_id"]), spool)
+        spool.flush()
+        ingested = await ingest_pdf(spool.name, source_id, user_id, progress)
+    
+    await progress.update("indexing")
+    await db.knowledge_sources.update_one(
+        {"id": source_id},
+        {"$set": {**source_content_fields(ingested["text"]), "pdf_pages": ingested["pages"],
+                  "pdf_total_pages": ingested["total_pages"], "status": "active"}}
+    )
+    # Chunks went straight to the collection; the tenant's index picks them up on reload
+    await invalidate_knowledge_index(user_id)
+    await delete_pdf_uploads(source_id=source_id)
+    return {"chunks": ingested["chunks"], "pages": ingested["pages"], "total_pages": ingested["total_pages"]}
+
+async def run_rescan_job(job: Dict, progress: JobProgress) -> Dict:
+    source_id, user_id = job["source_id"], job["user_id"]
+    source = await db.knowledge_sources.find_one(
+        {"id": source_id, "user_id": user_id}, {"_id": 0, "url": 1, "crawl": 1, "max_pages": 1}
+    )
+    if not source:
+        # Deleted after the rescan was queued: end it as cancelled rather than report an empty scan
+        await cancel_source_jobs(source_id)
+        raise JobCancelled(f"source {source_id} no longer exists")
+    
+    # Pages fetched before are requested conditionally and only changed ones are parsed
+    known_pages = await load_page_states(source_id)
+    products = []
+    await progress.update("fetching")
+    if source.get("crawl"):
+        async def collect(batch: List[Dict]):
+            products.extend(batch)
+        
+        crawler = await crawl_source(source_id, user_id, source["url"], source.get("max_pages") or CRAWL_MAX_PAGES,
+                                     progress, collect, known_pages=known_pages)
+        states, changed = crawler.page_states, crawler.changed_pages
+    else:
+        page_url = normalize_crawl_url(source["url"])
+        known = known_pages.get(page_url)
+        response = await fetch_client.get(source["url"], headers=conditional_headers(known))
+        if page_unchanged(response, known):
+            states, changed = {page_url: known}, set()
+        else:
+            if response.status_code != 200:
+                raise FetchError(f"{source['url']}: HTTP {response.status_code}")
+            products = await parse_pool.run(extract_products_from_html, response.text, source["url"], source_id, user_id)
+            states, changed = {page_url: page_state(response, products)}, {page_url}
+    
+    # Stored products only change once the whole scan succeeded
+    await progress.update("storing")
+    keep_urls = {product_url for state in states.values() for product_url in state.get("product_urls", [])}
+    result = await sync_source_products(source_id, user_id, products, keep_urls)
+    await save_page_states(source_id, user_id, states, changed)
+    return {**result, "changed_pages": len(changed), "unchanged_pages": len(states) - len(changed)}
+
+job_worker = JobWorker(
+    handlers={"url_source": run_url_source_job, "crawl_source": run_crawl_source_job,
+              "pdf_source": run_pdf_source_job, "rescan": run_rescan_job},
+    concurrency=INGESTION_WORKERS
+)
 
 
 # ==================== AUTH ROUTES ====================
@@ -495,7 +3772,7 @@ async def register(user: UserCreate):
     user_doc = {
         "id": user_id,
         "email": user.email,
-        "password": hash_password(user.password),
+        "password": await hash_password(user.password),
         "company_name": user.company_name,
         "widget_key": widget_key,
         "created_at": datetime.now(timezone.utc).isoformat()
@@ -520,10 +3797,18 @@ async def register(user: UserCreate):
 
 @api_router.post("/auth/login")
 async def login(user: UserLogin):
-    db_user = await db.users.find_one({"email": user.email}, {"_id": 0})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    timer = StageTimer("auth.login")
+    db_user = await timer.timed("lookup", db.users.find_one({"email": user.email}, {"_id": 0}))
+    if not db_user or not await timer.timed("verify", verify_password(user.password, db_user["password"])):
+        increment_counter("auth.login_failures")
+        timer.finish()
         raise HTTPException(status_code=401, detail="Credenziali non valide")
     
+    # The cost changed since this hash was made: upgrade it without holding up the login
+    if password_needs_rehash(db_user["password"]):
+        spawn_background(rehash_password(db_user["id"], user.password, db_user["password"]))
+    
+    timer.finish()
     token = create_token(db_user["id"])
     return {
         "token": token, 
@@ -549,22 +3834,17 @@ async def get_me(user = Depends(get_current_user)):
 
 @api_router.get("/knowledge", response_model=List[KnowledgeSourceResponse])
 async def get_knowledge_sources(user = Depends(get_current_user)):
-    sources = await db.knowledge_sources.find({"user_id": user["id"]}, {"_id": 0}).to_list(100)
+    sources = await db.knowledge_sources.find(
+        {"user_id": user["id"]}, {"_id": 0, "content": 0, "content_z": 0}
+    ).to_list(100)
     return sources
 
 @api_router.post("/knowledge/url")
 async def add_url_source(source: KnowledgeSourceCreate, user = Depends(get_current_user)):
     if not source.url:
         raise HTTPException(status_code=400, detail="URL richiesto")
-    
-    # Fetch URL content
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(source.url, timeout=30.0)
-            content = response.text[:10000]  # Limit content
-    except Exception as e:
-        logger.error(f"Error fetching URL: {e}")
-        content = ""
+    if source.max_pages is not None and not 1 <= source.max_pages <= CRAWL_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"max_pages deve essere compreso tra 1 e {CRAWL_MAX_PAGES}")
     
     source_id = str(uuid.uuid4())
     source_doc = {
@@ -573,33 +3853,29 @@ async def add_url_source(source: KnowledgeSourceCreate, user = Depends(get_curre
         "type": "url",
         "name": source.name,
         "url": source.url,
-        "content": content,
-        "content_preview": content[:200] if content else None,
-        "status": "active" if content else "error",
+        "content": "",
+        "content_preview": None,
+        "status": "processing",
         "products_count": 0,
+        "crawl": source.crawl,
+        "max_pages": source.max_pages,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.knowledge_sources.insert_one(source_doc)
     
-    # Extract products in background
-    products_count = 0
-    try:
-        products = await extract_products_from_url(source.url, source_id, user["id"])
-        if products:
-            await db.products.insert_many(products)
-            products_count = len(products)
-            await db.knowledge_sources.update_one(
-                {"id": source_id},
-                {"$set": {"products_count": products_count}}
-            )
-    except Exception as e:
-        logger.error(f"Error extracting products: {e}")
+    # Fetching, indexing and product extraction run on the ingestion workers
+    if source.crawl:
+        job_id = await enqueue_job("crawl_source", user["id"], source_id,
+                                   {"url": source.url, "max_pages": source.max_pages})
+    else:
+        job_id = await enqueue_job("url_source", user["id"], source_id, {"url": source.url})
+    await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"job_id": job_id}})
     
     return {
-        "id": source_doc["id"], 
-        "status": source_doc["status"], 
-        "products_count": products_count,
-        "message": f"Fonte aggiunta con successo. {products_count} prodotti estratti."
+        "id": source_id,
+        "job_id": job_id,
+        "status": "processing",
+        "message": "Fonte aggiunta, elaborazione in corso."
     }
 
 @api_router.post("/knowledge/pdf")
@@ -608,39 +3884,72 @@ async def add_pdf_source(
     name: str = Form(...),
     user = Depends(get_current_user)
 ):
+    source_id = str(uuid.uuid4())
+    # RequestSizeLimit turned away bodies far over the limit before Starlette spooled
+    # them to disk; copy the file into GridFS a chunk at a time and stop as soon as it
+    # goes over the limit
+    upload = pdf_uploads.open_upload_stream(
+        file.filename or "upload.pdf", metadata={"user_id": user["id"], "source_id": source_id}
+    )
+    size = 0
     try:
-        content = await file.read()
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-        text_content = ""
-        for page in pdf_reader.pages[:20]:  # Limit pages
-            text_content += page.extract_text() or ""
-        text_content = text_content[:15000]  # Limit content
-    except Exception as e:
-        logger.error(f"Error reading PDF: {e}")
-        raise HTTPException(status_code=400, detail="Errore nella lettura del PDF")
+        while True:
+            chunk = await file.read(PDF_UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            if size == 0 and not chunk.startswith(b"%PDF"):
+                raise HTTPException(status_code=400, detail="Errore nella lettura del PDF")
+            size += len(chunk)
+            if size > MAX_PDF_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="PDF troppo grande")
+            await upload.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Errore nella lettura del PDF")
+    except BaseException:
+        await upload.abort()
+        raise
+    await upload.close()
+    record_size("pdf.upload_bytes", size)
     
     source_doc = {
-        "id": str(uuid.uuid4()),
+        "id": source_id,
         "user_id": user["id"],
         "type": "pdf",
         "name": name,
         "url": None,
-        "content": text_content,
-        "content_preview": text_content[:200] if text_content else None,
-        "status": "active",
+        "content": "",
+        "content_preview": None,
+        "status": "processing",
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.knowledge_sources.insert_one(source_doc)
+    job_id = await enqueue_job("pdf_source", user["id"], source_id, {"file_id": str(upload._id), "bytes": size})
+    await db.knowledge_sources.update_one({"id": source_id}, {"$set": {"job_id": job_id}})
     
-    return {"id": source_doc["id"], "status": "active", "message": "PDF caricato con successo"}
+    return {"id": source_id, "job_id": job_id, "status": "processing", "message": "PDF caricato, elaborazione in corso."}
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, user = Depends(get_current_user)):
+    """Status, progress and result of an ingestion job"""
+    job = await db.jobs.find_one({"id": job_id, "user_id": user["id"]}, JOB_PUBLIC_FIELDS)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return job
 
 @api_router.delete("/knowledge/{source_id}")
 async def delete_knowledge_source(source_id: str, user = Depends(get_current_user)):
     result = await db.knowledge_sources.delete_one({"id": source_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Fonte non trovata")
-    # Also delete associated products
+    # A running job stops at its next progress update and removes anything it wrote after this
+    await cancel_source_jobs(source_id)
+    # Also delete associated chunks and products
+    await db.knowledge_chunks.delete_many({"source_id": source_id})
+    await invalidate_knowledge_index(user["id"])
     await db.products.delete_many({"source_id": source_id})
+    await unindex_products(user["id"], source_id=source_id)
+    await db.source_pages.delete_many({"source_id": source_id})
+    await delete_pdf_uploads(source_id=source_id)
     return {"message": "Fonte eliminata"}
 
 
@@ -651,14 +3960,26 @@ async def get_products(user = Depends(get_current_user), limit: int = 50):
     """Get all products for the user"""
     products = await db.products.find(
         {"user_id": user["id"]}, 
-        {"_id": 0}
+        PRODUCT_PUBLIC_FIELDS
     ).limit(limit).to_list(limit)
     return products
 
 @api_router.get("/products/search")
-async def search_products_api(q: str, user = Depends(get_current_user)):
-    """Search products by query"""
-    products = await search_products(user["id"], q, limit=10)
+async def search_products_api(
+    q: str,
+    fuzzy: bool = True,
+    threshold: float = PRODUCT_FUZZY_THRESHOLD,
+    semantic: bool = SEMANTIC_SEARCH_ENABLED,
+    user = Depends(get_current_user)
+):
+    """Search products by query, tolerating typos unless fuzzy=false"""
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="La soglia deve essere compresa tra 0 e 1")
+    products = await search_products(
+        user["id"], q, limit=10,
+        fuzzy_threshold=threshold if fuzzy else None,
+        semantic=semantic
+    )
     return products
 
 @api_router.get("/products/by-source/{source_id}")
@@ -666,7 +3987,7 @@ async def get_products_by_source(source_id: str, user = Depends(get_current_user
     """Get products from a specific knowledge source"""
     products = await db.products.find(
         {"user_id": user["id"], "source_id": source_id}, 
-        {"_id": 0}
+        PRODUCT_PUBLIC_FIELDS
     ).to_list(100)
     return products
 
@@ -680,22 +4001,12 @@ async def rescan_products(source_id: str, user = Depends(get_current_user)):
     if not source:
         raise HTTPException(status_code=404, detail="Fonte URL non trovata")
     
-    # Delete existing products from this source
-    await db.products.delete_many({"source_id": source_id})
-    
-    # Re-extract products
-    products = await extract_products_from_url(source["url"], source_id, user["id"])
-    products_count = 0
-    if products:
-        await db.products.insert_many(products)
-        products_count = len(products)
-    
-    await db.knowledge_sources.update_one(
-        {"id": source_id},
-        {"$set": {"products_count": products_count}}
-    )
-    
-    return {"message": f"Scansione completata. {products_count} prodotti trovati.", "products_count": products_count}
+    # A rescan already under way is reused by enqueue_job; the first import has to finish first
+    active = await active_source_job(source_id)
+    if active and active["type"] != "rescan":
+        raise HTTPException(status_code=409, detail="Importazione della fonte ancora in corso")
+    job_id = await enqueue_job("rescan", user["id"], source_id)
+    return {"message": "Scansione avviata.", "job_id": job_id}
 
 # Product manual add/edit
 class ProductCreate(BaseModel):
@@ -718,18 +4029,23 @@ async def create_product(product: ProductCreate, user = Depends(get_current_user
         **product.model_dump(),
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.products.insert_one(product_doc)
+    await db.products.insert_one(attach_embeddings([product_doc])[0])
+    await index_products(user["id"], [product_doc])
     return {"id": product_doc["id"], "message": "Prodotto aggiunto"}
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, product: ProductCreate, user = Depends(get_current_user)):
     """Update a product"""
-    result = await db.products.update_one(
+    fields = attach_embeddings([product.model_dump()])[0]
+    updated = await db.products.find_one_and_update(
         {"id": product_id, "user_id": user["id"]},
-        {"$set": {**product.model_dump(), "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {**fields, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={**PRODUCT_INDEX_FIELDS, "embedding": 1},
+        return_document=ReturnDocument.AFTER
     )
-    if result.matched_count == 0:
+    if not updated:
         raise HTTPException(status_code=404, detail="Prodotto non trovato")
+    await index_products(user["id"], [updated])
     return {"message": "Prodotto aggiornato"}
 
 @api_router.delete("/products/{product_id}")
@@ -738,6 +4054,7 @@ async def delete_product(product_id: str, user = Depends(get_current_user)):
     result = await db.products.delete_one({"id": product_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Prodotto non trovato")
+    await unindex_products(user["id"], [product_id])
     return {"message": "Prodotto eliminato"}
 
 
@@ -760,31 +4077,58 @@ async def update_widget_config(config: WidgetConfigUpdate, user = Depends(get_cu
         {"user_id": user["id"]},
         {"$set": update_doc}
     )
+    await invalidate_tenant(user["id"])
     return {"message": "Configurazione aggiornata"}
 
 @api_router.get("/widget/public/{widget_key}")
 async def get_public_widget_config(widget_key: str):
-    user = await db.users.find_one({"widget_key": widget_key}, {"_id": 0})
-    if not user:
+    tenant = await get_tenant_context(widget_key)
+    if not tenant:
         raise HTTPException(status_code=404, detail="Widget non trovato")
     
-    config = await db.widget_configs.find_one({"user_id": user["id"]}, {"_id": 0, "user_id": 0})
-    return config
+    config = tenant["widget_config"]
+    return {k: v for k, v in config.items() if k != "user_id"} if config else None
 
 
 # ==================== CHAT ROUTES ====================
 
-@api_router.post("/chat/message")
-async def send_chat_message(req: ChatMessageRequest):
-    # Validate widget key
-    user = await db.users.find_one({"widget_key": req.widget_key}, {"_id": 0})
-    if not user:
+def sse_event(event: str, data: Any) -> str:
+    """Format a server-sent event frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+_background_tasks = set()
+
+def spawn_background(coro):
+    """Run a coroutine detached from the request, keeping a reference until it completes"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+LLM_OVERLOADED_MESSAGE = "Il servizio è molto richiesto in questo momento. Riprova tra qualche secondo."
+AI_FALLBACK_RESPONSE = "Mi scuso, ma al momento non riesco a rispondere. Per favore riprova più tardi o contatta direttamente l'azienda."
+
+async def find_conversation(session_id: str) -> Optional[Dict]:
+    """Conversation for a session, including one opened moments ago and still in the write buffer"""
+    pending = message_writer.pending_conversation(session_id)
+    if pending:
+        return pending
+    return await db.conversations.find_one({"session_id": session_id}, {"_id": 0})
+
+async def prepare_chat_turn(req: ChatMessageRequest, timer: StageTimer) -> Dict:
+    """Resolve the tenant and assemble the prompt context, running independent reads concurrently"""
+    # Widget key and session lookups don't depend on each other
+    tenant, conversation = await asyncio.gather(
+        timer.timed("tenant", get_tenant_context(req.widget_key)),
+        timer.timed("conversation", find_conversation(req.session_id))
+    )
+    if not tenant:
         raise HTTPException(status_code=404, detail="Widget non valido")
+    user = tenant["user"]
     
-    # Get or create conversation
-    conversation = await db.conversations.find_one({"session_id": req.session_id}, {"_id": 0})
+    new_conversation = None
     if not conversation:
-        conversation = {
+        conversation = new_conversation = {
             "id": str(uuid.uuid4()),
             "user_id": user["id"],
             "session_id": req.session_id,
@@ -793,103 +4137,362 @@ async def send_chat_message(req: ChatMessageRequest):
             "started_at": datetime.now(timezone.utc).isoformat(),
             "last_message_at": datetime.now(timezone.utc).isoformat()
         }
-        await db.conversations.insert_one(conversation)
     
-    # Save user message
-    user_msg_id = str(uuid.uuid4())
+    # Visitor message is written behind too, but queued now so a failed model call doesn't lose it
     user_msg = {
-        "id": user_msg_id,
+        "id": str(uuid.uuid4()),
         "conversation_id": conversation["id"],
         "session_id": req.session_id,
         "role": "user",
         "content": req.message,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.messages.insert_one(user_msg)
-    
-    # Search for products based on user message
-    found_products = await search_products(user["id"], req.message, limit=6)
     
-    # Get knowledge base content
-    sources = await db.knowledge_sources.find({"user_id": user["id"], "status": "active"}, {"_id": 0}).to_list(50)
-    knowledge_context = "\n\n".join([s.get("content", "")[:2000] for s in sources if s.get("content")])
+    # Product search and knowledge retrieval only need the tenant id, history only the conversation
+    found_products, knowledge, history = await asyncio.gather(
+        timer.timed("products", search_products(user["id"], req.message, limit=6)),
+        timer.timed("knowledge", retrieve_knowledge(user["id"], req.message)),
+        timer.timed("history", load_conversation_history(conversation))
+    )
+    if history["compact"]:
+        spawn_background(compact_conversation(conversation))
+    # Queued after the history read so the prompt doesn't see the question twice
+    message_writer.add([user_msg], new_conversation, count=1)
     
-    # Get widget config for bot personality
-    widget_config = await db.widget_configs.find_one({"user_id": user["id"]}, {"_id": 0})
+    widget_config = tenant["widget_config"]
     bot_name = widget_config.get("bot_name", "SalesGenius") if widget_config else "SalesGenius"
+    company_name = user.get('company_name', "un'azienda")
     
-    # Build product context for AI
-    product_context = ""
-    if found_products:
-        product_context = "\n\nPRODOTTI TROVATI NEL CATALOGO:\n"
-        for i, p in enumerate(found_products, 1):
-            product_context += f"{i}. {p.get('name', 'Prodotto')} - {p.get('price', 'Prezzo non disponibile')}\n"
+    with timer.stage("prompt"):
+        pieces = history_pieces(history)
+        prompt = build_chat_prompt(
+            bot_name, company_name, req.message, knowledge, found_products or [], pieces,
+            budget=tenant["ai_settings"].get("prompt_token_budget") or DEFAULT_PROMPT_TOKEN_BUDGET
+        )
+    for section, count in prompt["tokens"].items():
+        record_size(f"prompt.{section}_tokens", count)
     
-    # Generate AI response
-    try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        
-        company_name = user.get('company_name', "un'azienda")
-        kb_content = knowledge_context[:2000] if knowledge_context else ''
-        
-        system_message = f"""Sei {bot_name}, un assistente vendite AI professionale e amichevole per {company_name}.
-Il tuo obiettivo è aiutare i visitatori a trovare prodotti e rispondere alle loro domande.
-Rispondi sempre in italiano, in modo conciso e utile.
-
-IMPORTANTE - RICERCA PRODOTTI:
-- Se l'utente cerca un prodotto e trovi risultati nel catalogo, descrivi brevemente i prodotti trovati
-- Non inventare prodotti o prezzi, usa solo quelli forniti nel contesto
-- Se non trovi prodotti corrispondenti, suggerisci di descrivere meglio cosa cerca o di contattare l'azienda
+    return {
+        "user": user,
+        "ai_settings": tenant["ai_settings"],
+        "conversation": conversation,
+        "new_conversation": new_conversation,
+        "user_msg": user_msg,
+        "found_products": found_products,
+        "system_message": prompt["system_message"],
+        "prompt_tokens": prompt["tokens"],
+        "has_history": bool(pieces),
+        "context_fingerprint": context_fingerprint(
+            bot_name, company_name, tenant["ai_settings"], knowledge, found_products or []
+        )
+    }
 
-{f"CONOSCENZE AZIENDALI:{chr(10)}{kb_content}" if kb_content else ""}
-{product_context}
-"""
-        
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=req.session_id,
-            system_message=system_message
-        ).with_model("gemini", "gemini-3-flash-preview")
-        
-        user_message = UserMessage(text=req.message)
-        ai_response = await chat.send_message(user_message)
-        
+async def generate_ai_response(session_id: str, system_message: str, message: str, ai_settings: Dict) -> str:
+    """Generate the assistant reply through the model router, falling back to a canned apology on errors"""
+    try:
+        response, model = await model_router.complete(
+            session_id,
+            system_message,
+            message,
+            model=ai_settings.get("ai_model") or DEFAULT_AI_MODEL,
+            max_tokens=ai_settings.get("max_tokens_per_response") or DEFAULT_MAX_TOKENS_PER_RESPONSE
+        )
+        return response
+    except LlmTimeout:
+        logger.error(f"AI Error: no reply within {model_router.deadline}s")
+        return AI_FALLBACK_RESPONSE
     except Exception as e:
         logger.error(f"AI Error: {e}")
-        ai_response = "Mi scuso, ma al momento non riesco a rispondere. Per favore riprova più tardi o contatta direttamente l'azienda."
+        return AI_FALLBACK_RESPONSE
+
+def normalize_question(message: str) -> str:
+    """Accent-folded words only, so 'Spedizione gratuita?' and 'spedizione  gratuita' match"""
+    return " ".join(_TOKEN_RE.findall(fold_accents(message)))
+
+def context_fingerprint(bot_name: str, company_name: str, ai_settings: Dict,
+                        knowledge: List[str], products: List[Dict]) -> str:
+    """Hash of what a reply depends on besides the question and the conversation:
+    persona, model settings, retrieved knowledge chunks and found product ids"""
+    parts = [bot_name, company_name, json.dumps(ai_settings, sort_keys=True, default=str),
+             *knowledge, *(product.get("id") or "" for product in products)]
+    return hashlib.sha1("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+def answer_cache_key(turn: Dict, message: str) -> tuple:
+    """Cache key: tenant, normalised question and the fingerprint of the retrieved context"""
+    return (turn["user"]["id"], normalize_question(message), turn["context_fingerprint"])
+
+async def answer_chat_turn(turn: Dict, req: ChatMessageRequest) -> str:
+    """Reply from the answer cache when the same question met the same context, else generate.
+
+    Turns whose prompt carries conversation history are neither cached nor
+    coalesced: their reply may refer to that history, so it can't be handed
+    to another conversation.
+    """
+    user = turn["user"]
     
-    # Save AI response
-    ai_msg_id = str(uuid.uuid4())
+    async def generate():
+        return await llm_scheduler.run(
+            user["id"],
+            lambda: generate_ai_response(req.session_id, turn["system_message"], req.message, turn["ai_settings"]),
+            weight=float(user.get("llm_weight", 1.0))
+        )
+    
+    if turn["has_history"]:
+        return await generate()
+    
+    key = answer_cache_key(turn, req.message)
+    cached = answer_cache.get(key)
+    if cached:
+        turn["answer_cached"] = True
+        return cached["content"]
+    
+    async def generate_and_cache():
+        response = await generate()
+        if response is not AI_FALLBACK_RESPONSE:
+            answer_cache.set(key, {"user_id": user["id"], "content": response})
+        return response
+    
+    # Identical questions asked at the same time share one model call
+    return await answer_flights.do(key, generate_and_cache)
+
+def replay_deltas(response: str):
+    return re.findall(r'\S+\s*|\s+', response)
+
+async def stream_ai_response(turn: Dict, req: ChatMessageRequest):
+    """Yield the assistant reply as text deltas.
+
+    With the pooled client (LLM_API_BASE) the model's own deltas are forwarded
+    as they arrive. LlmChat only exposes a full completion, so on that path,
+    and for cached answers, the reply is re-emitted word by word as soon as it
+    is available; product cards have already been flushed to the client by then.
+    """
+    if not model_router.streaming:
+        for delta in replay_deltas(await answer_chat_turn(turn, req)):
+            yield delta
+        return
+    
+    key = answer_cache_key(turn, req.message)
+    cached = answer_cache.get(key) if not turn["has_history"] else None
+    if cached:
+        turn["answer_cached"] = True
+        for delta in replay_deltas(cached["content"]):
+            yield delta
+        return
+    
+    user, ai_settings = turn["user"], turn["ai_settings"]
+    
+    async def generate():
+        parts = []
+        deltas = model_router.stream(
+            req.session_id,
+            turn["system_message"],
+            req.message,
+            model=ai_settings.get("ai_model") or DEFAULT_AI_MODEL,
+            max_tokens=ai_settings.get("max_tokens_per_response") or DEFAULT_MAX_TOKENS_PER_RESPONSE
+        )
+        async with llm_scheduler.slot(user["id"], weight=float(user.get("llm_weight", 1.0))):
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            except Exception as e:
+                if parts:
+                    raise
+                # Nothing sent yet: same canned apology as generate_ai_response
+                logger.error(f"AI Error: {e!r}")
+                yield AI_FALLBACK_RESPONSE
+                return
+            finally:
+                # Closes the upstream response right away once nobody is listening
+                await deltas.aclose()
+        if not turn["has_history"]:
+            answer_cache.set(key, {"user_id": user["id"], "content": "".join(parts)})
+    
+    # Identical questions asked at the same time share one streamed model call (see answer_chat_turn
+    # for why turns with history don't)
+    replies = generate() if turn["has_history"] else answer_flights.stream(key, generate)
+    try:
+        async for delta in replies:
+            yield delta
+    finally:
+        await replies.aclose()
+
+def save_ai_message(turn: Dict, session_id: str, content: str, idempotency_key: Optional[str] = None) -> Dict:
+    """Queue the assistant reply and its counter bump for write-behind"""
+    found_products = turn["found_products"]
     ai_msg = {
-        "id": ai_msg_id,
-        "conversation_id": conversation["id"],
-        "session_id": req.session_id,
+        "id": turn.get("ai_msg_id") or str(uuid.uuid4()),
+        "conversation_id": turn["conversation"]["id"],
+        "session_id": session_id,
         "role": "assistant",
-        "content": ai_response,
+        "content": content,
         "products": found_products if found_products else None,
+        "prompt_tokens": turn["prompt_tokens"],
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    await db.messages.insert_one(ai_msg)
-    
-    # Update conversation
-    await db.conversations.update_one(
-        {"session_id": req.session_id},
-        {"$set": {"last_message_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"messages_count": 2}}
+    if idempotency_key:
+        ai_msg["idempotency_key"] = idempotency_key
+    message_writer.add([ai_msg], count=1)
+    return ai_msg
+
+async def find_idempotent_reply(session_id: str, idempotency_key: str) -> Optional[Dict]:
+    """Assistant message already saved for this idempotency key, buffered or stored"""
+    for m in message_writer.pending_messages(session_id=session_id):
+        if m["role"] == "assistant" and m.get("idempotency_key") == idempotency_key:
+            return m
+    return await db.messages.find_one(
+        {"session_id": session_id, "idempotency_key": idempotency_key, "role": "assistant"}, {"_id": 0}
     )
-    
+
+def chat_message_response(ai_msg: Dict) -> Dict:
     return {
-        "id": ai_msg_id,
-        "session_id": req.session_id,
+        "id": ai_msg["id"],
+        "session_id": ai_msg["session_id"],
         "role": "assistant",
-        "content": ai_response,
-        "products": found_products if found_products else None,
+        "content": ai_msg["content"],
+        "products": ai_msg["products"],
         "timestamp": ai_msg["timestamp"]
     }
 
+async def handle_chat_message(req: ChatMessageRequest, timer: StageTimer) -> Dict:
+    if req.idempotency_key:
+        with timer.stage("idempotency"):
+            saved = await find_idempotent_reply(req.session_id, req.idempotency_key)
+        if saved:
+            increment_counter("chat.idempotent_replay")
+            return chat_message_response(saved)
+    
+    turn = await prepare_chat_turn(req, timer)
+    
+    # Generate AI response
+    with timer.stage("llm"):
+        try:
+            ai_response = await answer_chat_turn(turn, req)
+        except LlmOverloaded:
+            raise HTTPException(status_code=429, detail=LLM_OVERLOADED_MESSAGE, headers={"Retry-After": "2"})
+    
+    # Save AI response
+    with timer.stage("persist"):
+        ai_msg = save_ai_message(turn, req.session_id, ai_response, req.idempotency_key)
+    return chat_message_response(ai_msg)
+
+@api_router.post("/chat/message")
+async def send_chat_message(req: ChatMessageRequest, response: Response):
+    """Answer a visitor message.
+
+    The model call goes through the pooled client only when LLM_API_BASE is
+    set; the default path still builds an LlmChat per call (call_llm_chat).
+    """
+    timer = StageTimer("chat")
+    if req.idempotency_key:
+        # A retry racing the original request waits for it instead of starting a second turn
+        result = await chat_flights.do(
+            (req.session_id, req.idempotency_key), lambda: handle_chat_message(req, timer)
+        )
+        if result is None:
+            # Joined a streamed turn that ended without a complete reply
+            result = await handle_chat_message(req, timer)
+    else:
+        result = await handle_chat_message(req, timer)
+    
+    timer.finish()
+    response.headers["Server-Timing"] = timer.server_timing()
+    return result
+
+async def replay_chat_stream(reply: Dict):
+    """Server-sent events for a reply that was already generated"""
+    yield sse_event("start", {"id": reply["id"], "session_id": reply["session_id"]})
+    yield sse_event("products", {"products": reply["products"] or []})
+    for delta in replay_deltas(reply["content"]):
+        yield sse_event("token", {"text": delta})
+    yield sse_event("done", reply)
+
+def chat_event_stream(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.post("/chat/message/stream")
+async def stream_chat_message(req: ChatMessageRequest):
+    """Same as /chat/message, but sends products and reply tokens as server-sent events"""
+    timer = StageTimer("chat_stream")
+    flight = None
+    try:
+        if req.idempotency_key:
+            flight_key = (req.session_id, req.idempotency_key)
+            flight = chat_flights.start(flight_key, CHAT_STREAM_FLIGHT_TIMEOUT_SECONDS)
+            if flight is None:
+                # A retry racing the original request waits for it instead of starting a second turn
+                replay = await chat_flights.join(flight_key)
+            else:
+                with timer.stage("idempotency"):
+                    saved = await find_idempotent_reply(req.session_id, req.idempotency_key)
+                replay = chat_message_response(saved) if saved else None
+            if replay:
+                increment_counter("chat.idempotent_replay")
+                if flight:
+                    flight.set_result(replay)
+                timer.finish()
+                return chat_event_stream(replay_chat_stream(replay))
+        turn = await prepare_chat_turn(req, timer)
+    except BaseException:
+        if flight and not flight.done():
+            flight.set_result(None)
+        raise
+    turn["ai_msg_id"] = str(uuid.uuid4())
+    
+    async def event_stream():
+        parts = []
+        reply = None
+        llm_started = time.perf_counter()
+        try:
+            yield sse_event("start", {"id": turn["ai_msg_id"], "session_id": req.session_id})
+            yield sse_event("products", {"products": turn["found_products"] or []})
+            async for delta in stream_ai_response(turn, req):
+                if not parts:
+                    timer.stages["first_token"] = (time.perf_counter() - llm_started) * 1000
+                parts.append(delta)
+                yield sse_event("token", {"text": delta})
+            timer.stages["llm"] = (time.perf_counter() - llm_started) * 1000
+            with timer.stage("persist"):
+                reply = chat_message_response(
+                    save_ai_message(turn, req.session_id, "".join(parts), req.idempotency_key)
+                )
+            if flight:
+                flight.set_result(reply)
+            yield sse_event("done", reply)
+        except LlmOverloaded:
+            yield sse_event("error", {"detail": LLM_OVERLOADED_MESSAGE, "retry_after": 2})
+        except Exception as e:
+            logger.error(f"Chat stream error: {e}")
+            yield sse_event("error", {"detail": "Errore durante la generazione della risposta"})
+        finally:
+            if reply is None and parts:
+                # Failed or abandoned mid-stream: keep what was generated so far, but not under
+                # the idempotency key, so a retry generates a complete reply
+                save_ai_message(turn, req.session_id, "".join(parts))
+            if flight and not flight.done():
+                flight.set_result(None)
+            timer.finish()
+    
+    return chat_event_stream(event_stream())
+
+def merge_pending_messages(messages: List[Dict], pending: List[Dict]) -> List[Dict]:
+    """Add buffered messages not yet flushed to a list read from db.messages"""
+    stored = {m["id"] for m in messages}
+    unflushed = [m for m in pending if m["id"] not in stored]
+    if not unflushed:
+        return messages
+    return sorted(messages + unflushed, key=lambda m: m["timestamp"])
+
 @api_router.get("/chat/history/{session_id}")
 async def get_chat_history(session_id: str):
+    # Snapshot the write buffer before reading, so a flush in between can't hide a message
+    pending = message_writer.pending_messages(session_id=session_id)
     messages = await db.messages.find({"session_id": session_id}, {"_id": 0}).sort("timestamp", 1).to_list(100)
-    return messages
+    return merge_pending_messages(messages, pending)
 
 
 # ==================== CART ROUTES ====================
@@ -902,11 +4505,12 @@ async def add_to_cart(
     quantity: int = 1
 ):
     """Add a product to the visitor's cart"""
-    user = await db.users.find_one({"widget_key": widget_key}, {"_id": 0})
-    if not user:
+    tenant = await get_tenant_context(widget_key)
+    if not tenant:
         raise HTTPException(status_code=404, detail="Widget non valido")
+    user = tenant["user"]
     
-    product = await db.products.find_one({"id": product_id, "user_id": user["id"]}, {"_id": 0})
+    product = await db.products.find_one({"id": product_id, "user_id": user["id"]}, PRODUCT_PUBLIC_FIELDS)
     if not product:
         raise HTTPException(status_code=404, detail="Prodotto non trovato")
     
@@ -939,9 +4543,10 @@ async def add_to_cart(
 @api_router.get("/cart/{session_id}")
 async def get_cart(session_id: str, widget_key: str):
     """Get cart items for a session"""
-    user = await db.users.find_one({"widget_key": widget_key}, {"_id": 0})
-    if not user:
+    tenant = await get_tenant_context(widget_key)
+    if not tenant:
         raise HTTPException(status_code=404, detail="Widget non valido")
+    user = tenant["user"]
     
     items = await db.cart_items.find({"session_id": session_id}, {"_id": 0}).to_list(50)
     
@@ -965,18 +4570,21 @@ async def remove_from_cart(session_id: str, product_id: str):
 async def get_conversations(user = Depends(get_current_user)):
     conversations = await db.conversations.find(
         {"user_id": user["id"]}, 
-        {"_id": 0}
+        {"_id": 0, "counter_flushes": 0}
     ).sort("last_message_at", -1).to_list(100)
     return conversations
 
 @api_router.get("/conversations/{conversation_id}/messages")
 async def get_conversation_messages(conversation_id: str, user = Depends(get_current_user)):
-    conversation = await db.conversations.find_one({"id": conversation_id, "user_id": user["id"]}, {"_id": 0})
+    conversation = await db.conversations.find_one(
+        {"id": conversation_id, "user_id": user["id"]}, {"_id": 0, "counter_flushes": 0}
+    )
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversazione non trovata")
     
+    pending = message_writer.pending_messages(conversation_id=conversation_id)
     messages = await db.messages.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1).to_list(200)
-    return {"conversation": conversation, "messages": messages}
+    return {"conversation": conversation, "messages": merge_pending_messages(messages, pending)}
 
 
 # ==================== SUPER ADMIN ROUTES ====================
@@ -1029,13 +4637,23 @@ async def delete_user(user_id: str, user = Depends(get_current_user)):
     
     # Delete user and related data
     await db.users.delete_one({"id": user_id})
+    invalidate_principal(user_id)
     await db.knowledge_sources.delete_many({"user_id": user_id})
+    await db.knowledge_chunks.delete_many({"user_id": user_id})
     await db.products.delete_many({"user_id": user_id})
+    await db.jobs.delete_many({"user_id": user_id})
+    await db.source_pages.delete_many({"user_id": user_id})
+    await delete_pdf_uploads(user_id=user_id)
+    product_indexes.invalidate(user_id)
+    semantic_indexes.invalidate(user_id)
+    await bump_index_version(user_id, "products")
     await db.conversations.delete_many({"user_id": user_id})
     await db.leads.delete_many({"user_id": user_id})
     await db.widget_configs.delete_many({"user_id": user_id})
     await db.team_members.delete_many({"org_id": user_id})
     await db.admin_settings.delete_many({"org_id": user_id})
+    await invalidate_tenant(user_id)
+    await invalidate_knowledge_index(user_id)
     
     return {"message": f"Utente {target_user['email']} eliminato con tutti i suoi dati"}
 
@@ -1052,6 +4670,8 @@ async def update_user_admin(user_id: str, company_name: str = None, email: str =
     
     if update_data:
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        invalidate_principal(user_id)
+        await invalidate_tenant(user_id)
     
     return {"message": "Utente aggiornato"}
 
@@ -1069,13 +4689,27 @@ async def get_collections(user = Depends(get_current_user)):
     return result
 
 
+@api_router.get("/superadmin/metrics")
+async def get_metrics(user = Depends(get_current_user)):
+    """Get in-process latency percentiles and counters (Super Admin only)"""
+    check_super_admin(user)
+    return {
+        "latency": {name: stats.summary() for name, stats in sorted(latency_metrics.items())},
+        "sizes": {name: stats.summary(suffix="") for name, stats in sorted(size_metrics.items())},
+        "counters": dict(sorted(counter_metrics.items())),
+        "llm_scheduler": llm_scheduler.snapshot(),
+        "llm_models": model_router.snapshot()
+    }
+
+
 # ==================== LEADS ROUTES ====================
 
 @api_router.post("/leads")
 async def create_lead(lead: LeadCreate):
-    user = await db.users.find_one({"widget_key": lead.widget_key}, {"_id": 0})
-    if not user:
+    tenant = await get_tenant_context(lead.widget_key)
+    if not tenant:
         raise HTTPException(status_code=404, detail="Widget non valido")
+    user = tenant["user"]
     
     lead_doc = {
         "id": str(uuid.uuid4()),
@@ -1223,6 +4857,7 @@ async def invite_team_member(invite: TeamMemberInvite, user = Depends(get_curren
     # If user exists, update their org_id
     if existing_user:
         await db.users.update_one({"id": existing_user["id"]}, {"$set": {"org_id": org_id, "role": invite.role}})
+        invalidate_principal(existing_user["id"])
     
     return {"message": f"Invito inviato a {invite.email}", "member": {
         "id": member_doc["id"],
@@ -1252,6 +4887,7 @@ async def update_team_member(member_id: str, update: TeamMemberUpdate, user = De
     member = await db.team_members.find_one({"id": member_id}, {"_id": 0})
     if member and member.get("user_id"):
         await db.users.update_one({"id": member["user_id"]}, {"$set": {"role": update.role}})
+        invalidate_principal(member["user_id"])
     
     return {"message": "Ruolo aggiornato"}
 
@@ -1274,6 +4910,7 @@ async def remove_team_member(member_id: str, user = Depends(get_current_user)):
     # Remove org_id from user if exists
     if member.get("user_id"):
         await db.users.update_one({"id": member["user_id"]}, {"$unset": {"org_id": "", "role": ""}})
+        invalidate_principal(member["user_id"])
     
     return {"message": "Membro rimosso"}
 
@@ -1298,8 +4935,9 @@ async def get_admin_settings(user = Depends(get_current_user)):
             "language": "it",
             "notification_new_lead": True,
             "notification_new_conversation": False,
-            "ai_model": "gemini-3-flash-preview",
-            "max_tokens_per_response": 500
+            "ai_model": DEFAULT_AI_MODEL,
+            "max_tokens_per_response": DEFAULT_MAX_TOKENS_PER_RESPONSE,
+            "prompt_token_budget": DEFAULT_PROMPT_TOKEN_BUDGET
         }
     
     return settings
@@ -1310,6 +4948,13 @@ async def update_admin_settings(settings: AdminSettingsUpdate, user = Depends(ge
     check_admin_role(user)
     org_id = user.get("org_id", user["id"])
     
+    if settings.ai_model is not None and settings.ai_model not in LLM_MODELS:
+        raise HTTPException(status_code=400, detail="Modello AI non disponibile")
+    if settings.max_tokens_per_response is not None and settings.max_tokens_per_response <= 0:
+        raise HTTPException(status_code=400, detail="max_tokens_per_response deve essere positivo")
+    if settings.prompt_token_budget is not None and settings.prompt_token_budget < 500:
+        raise HTTPException(status_code=400, detail="prompt_token_budget deve essere almeno 500")
+    
     update_data = {k: v for k, v in settings.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
@@ -1322,6 +4967,8 @@ async def update_admin_settings(settings: AdminSettingsUpdate, user = Depends(ge
     # Update company name in users table too
     if settings.company_name:
         await db.users.update_one({"id": org_id}, {"$set": {"company_name": settings.company_name}})
+        invalidate_principal(org_id)
+    await invalidate_tenant(org_id)
     
     return {"message": "Impostazioni aggiornate"}
 
@@ -1333,14 +4980,27 @@ async def get_api_config(user = Depends(get_current_user)):
     # Check if custom API key is set
     has_custom_key = bool(os.environ.get("CUSTOM_LLM_KEY"))
     
+    org_id = user.get("org_id", user["id"])
+    settings = await db.admin_settings.find_one({"org_id": org_id}, {"_id": 0, "ai_model": 1})
+    current_model = (settings or {}).get("ai_model")
+    # A stored model that was since dropped from LLM_MODELS is routed as the default one
+    current_model = current_model if current_model in LLM_MODELS else DEFAULT_AI_MODEL
+    model_status = model_router.snapshot()
+    
     return {
-        "current_model": "gemini-3-flash-preview",
-        "provider": "Google Gemini",
+        "current_model": current_model,
+        "provider": "OpenAI" if LLM_MODELS[current_model]["provider"] == "openai" else "Google Gemini",
         "using_emergent_key": not has_custom_key,
         "available_models": [
-            {"id": "gemini-3-flash-preview", "name": "Gemini 3 Flash", "cost_input": 0.10, "cost_output": 0.40},
-            {"id": "gemini-2.5-flash", "name": "Gemini 2.5 Flash", "cost_input": 0.15, "cost_output": 0.60},
-            {"id": "gpt-5.2", "name": "GPT-5.2", "cost_input": 2.50, "cost_output": 10.00}
+            {
+                "id": model_id,
+                "name": spec["name"],
+                "cost_input": spec["cost_input"],
+                "cost_output": spec["cost_output"],
+                "healthy": model_status[model_id]["healthy"],
+                "p50_ms": model_status[model_id]["p50_ms"]
+            }
+            for model_id, spec in LLM_MODELS.items()
         ],
         "instructions": {
             "emergent_key": "Stai usando la Emergent LLM Key universale. I costi vengono addebitati al tuo account Emergent.",
@@ -1370,6 +5030,8 @@ async def update_profile(
     
     if update_data:
         await db.users.update_one({"id": user["id"]}, {"$set": update_data})
+        invalidate_principal(user["id"])
+        await invalidate_tenant(user["id"])
     
     return {"message": "Profilo aggiornato"}
 
@@ -1377,6 +5039,12 @@ async def update_profile(
 # Include router and middleware
 app.include_router(api_router)
 
+app.add_middleware(
+    RequestSizeLimit,
+    limits={"/api/knowledge/pdf": MAX_PDF_UPLOAD_BYTES + PDF_FORM_OVERHEAD_BYTES},
+    detail="PDF troppo grande"
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -1385,6 +5053,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup_db_client():
+    """Start the background workers and LLM client and create the indexes backing tenant-scoped lookups"""
+    message_writer.start()
+    job_worker.start()
+    await fetch_client.start()
+    parse_pool.start()
+    await parse_pool.warm_up()
+    if model_router.provider is llm_client:
+        await llm_client.start()
+    try:
+        await db.products.create_index([("user_id", 1), ("id", 1)])
+        await db.products.create_index([("source_id", 1), ("product_url", 1)])
+        await db.source_pages.create_index([("source_id", 1), ("url", 1)], unique=True)
+        await db["pdf_uploads.files"].create_index("metadata.source_id")
+        await db.knowledge_chunks.create_index([("user_id", 1), ("source_id", 1)])
+        await db.messages.create_index([("session_id", 1), ("idempotency_key", 1)], sparse=True)
+        await db.messages.create_index([("session_id", 1), ("timestamp", -1)])
+        await db.jobs.create_index("id", unique=True)
+        await db.jobs.create_index([("status", 1), ("run_after", 1)])
+        await db.jobs.create_index("active_source", unique=True, sparse=True)
+        await db.index_versions.create_index("user_id", unique=True)
+        await db.knowledge_chunks.create_index([("source_id", 1), ("position", 1)], unique=True)
+    except Exception as e:
+        logger.error(f"Error creating indexes: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Let detached and buffered writes finish before the connection goes away
+    await job_worker.stop()
+    if _background_tasks:
+        await asyncio.gather(*list(_background_tasks), return_exceptions=True)
+    await message_writer.stop()
+    await llm_client.close()
+    await fetch_client.close()
+    parse_pool.close()
+    password_executor.shutdown(wait=False)
     client.close()
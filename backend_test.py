@@ -359,6 +359,27 @@ class SalesGeniusAPITester:
                 200
             )
 
+        # Streaming variant (server-sent events)
+        print(f"\n🔍 Testing Stream Chat Message...")
+        try:
+            response = requests.post(
+                f"{self.base_url}/api/chat/message/stream",
+                json={
+                    "session_id": session_id,
+                    "message": "Hello, this is a streaming test",
+                    "widget_key": widget_key
+                },
+                stream=True,
+                timeout=60
+            )
+            events = [line[6:].strip() for line in response.iter_lines(decode_unicode=True)
+                      if line and line.startswith("event:")]
+            passed = response.status_code == 200 and events[:2] == ["start", "products"] and events[-1] == "done"
+            self.log_result("Stream Chat Message", passed,
+                            f"Status {response.status_code}, events {events[:3]}...{events[-1:]}" if not passed else "")
+        except Exception as e:
+            self.log_result("Stream Chat Message", False, f"Exception: {str(e)}")
+
     def test_team_management_endpoints(self):
         """Test team management endpoints"""
         print("\n" + "="*50)
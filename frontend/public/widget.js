@@ -675,6 +675,95 @@
     if (typingEl) typingEl.remove();
   }
 
+  function createStreamingMessage() {
+    const messagesEl = document.getElementById('sg-widget-messages');
+    const msgEl = document.createElement('div');
+    msgEl.className = 'sg-message sg-bot';
+    const textEl = document.createElement('div');
+    textEl.className = 'sg-message-text';
+    msgEl.appendChild(textEl);
+    messagesEl.appendChild(msgEl);
+    
+    const entry = { text: '', type: 'bot', products: null };
+    messages.push(entry);
+    
+    return {
+      appendText(delta) {
+        entry.text += delta;
+        textEl.textContent = entry.text;
+        messagesEl.scrollTop = messagesEl.scrollHeight;
+      },
+      setText(text) {
+        entry.text = text;
+        textEl.textContent = text;
+      },
+      setProducts(products) {
+        if (!products || products.length === 0 || entry.products) return;
+        entry.products = products;
+        const grid = document.createElement('div');
+        grid.className = 'sg-products-grid';
+        grid.innerHTML = products.map(createProductCard).join('');
+        msgEl.appendChild(grid);
+        messagesEl.scrollTop = messagesEl.scrollHeight;
+      }
+    };
+  }
+
+  function parseSseFrame(frame) {
+    let event = 'message';
+    let data = '';
+    frame.split('\n').forEach(line => {
+      if (line.startsWith('event:')) event = line.slice(6).trim();
+      else if (line.startsWith('data:')) data += line.slice(5).trim();
+    });
+    return { event, data: data ? JSON.parse(data) : null };
+  }
+
+  async function streamReply(payload) {
+    const res = await fetch(`${API_BASE}/chat/message/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+      body: JSON.stringify(payload)
+    });
+    if (!res.ok || !res.body) return false;
+    
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let bubble = null;
+    let finished = false;
+    
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const { event, data } = parseSseFrame(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+        
+        if (event === 'start') {
+          hideTyping();
+          bubble = createStreamingMessage();
+        } else if (event === 'products' && bubble) {
+          bubble.setProducts(data.products);
+        } else if (event === 'token' && bubble) {
+          bubble.appendText(data.text);
+        } else if (event === 'done' && bubble) {
+          bubble.setText(data.content);
+          bubble.setProducts(data.products);
+          finished = true;
+        } else if (event === 'error') {
+          if (!bubble) bubble = createStreamingMessage();
+          bubble.setText((data && data.detail) || 'Mi scuso, si è verificato un errore. Riprova più tardi.');
+          finished = true;
+        }
+      }
+    }
+    return finished || bubble !== null;
+  }
+
   async function sendMessage() {
     const input = document.getElementById('sg-widget-input');
     const sendBtn = document.getElementById('sg-widget-send');
@@ -690,24 +779,33 @@
     // Show typing indicator
     showTyping();
     
+    const payload = {
+      session_id: sessionId,
+      message: text,
+      widget_key: widgetKey,
+      // Same key on the fallback request, so a reply already saved by the stream is not generated twice
+      idempotency_key: 'msg_' + Math.random().toString(36).substr(2, 9) + '_' + Date.now()
+    };
+    
     try {
-      const res = await fetch(`${API_BASE}/chat/message`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          session_id: sessionId,
-          message: text,
-          widget_key: widgetKey
-        })
-      });
+      // Stream tokens as they arrive; fall back to the plain endpoint if streaming is unavailable
+      const streamed = window.ReadableStream && window.TextDecoder ? await streamReply(payload) : false;
       
-      hideTyping();
-      
-      if (res.ok) {
-        const data = await res.json();
-        addMessage(data.content, 'bot', data.products);
-      } else {
-        addMessage('Mi scuso, si è verificato un errore. Riprova più tardi.', 'bot');
+      if (!streamed) {
+        const res = await fetch(`${API_BASE}/chat/message`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify(payload)
+        });
+        
+        hideTyping();
+        
+        if (res.ok) {
+          const data = await res.json();
+          addMessage(data.content, 'bot', data.products);
+        } else {
+          addMessage('Mi scuso, si è verificato un errore. Riprova più tardi.', 'bot');
+        }
       }
     } catch (e) {
       hideTyping();
@@ -5,6 +5,7 @@ import { Button } from "../components/ui/button";
 import { Input } from "../components/ui/input";
 import { Label } from "../components/ui/label";
 import { Badge } from "../components/ui/badge";
+import { Switch } from "../components/ui/switch";
 import {
   Dialog,
   DialogContent,
@@ -34,6 +35,7 @@ export default function KnowledgeBase() {
   // Form states
   const [urlName, setUrlName] = useState("");
   const [urlValue, setUrlValue] = useState("");
+  const [urlCrawl, setUrlCrawl] = useState(false);
   const [pdfName, setPdfName] = useState("");
   const [pdfFile, setPdfFile] = useState(null);
 
@@ -41,6 +43,13 @@ export default function KnowledgeBase() {
     fetchSources();
   }, []);
 
+  // Sources are fetched and parsed by background jobs: refresh until none is still processing
+  useEffect(() => {
+    if (!sources.some((source) => source.status === "processing")) return;
+    const timer = setTimeout(fetchSources, 3000);
+    return () => clearTimeout(timer);
+  }, [sources]);
+
   const fetchSources = async () => {
     try {
       const res = await fetchWithAuth(`${API_URL}/knowledge`);
@@ -61,14 +70,15 @@ export default function KnowledgeBase() {
     try {
       const res = await fetchWithAuth(`${API_URL}/knowledge/url`, {
         method: "POST",
-        body: JSON.stringify({ type: "url", name: urlName, url: urlValue })
+        body: JSON.stringify({ type: "url", name: urlName, url: urlValue, crawl: urlCrawl })
       });
       
       if (res.ok) {
-        toast.success("URL aggiunto con successo");
+        toast.success("URL aggiunto, elaborazione in corso");
         setAddUrlOpen(false);
         setUrlName("");
         setUrlValue("");
+        setUrlCrawl(false);
         fetchSources();
       } else {
         const error = await res.json();
@@ -103,7 +113,7 @@ export default function KnowledgeBase() {
       });
       
       if (res.ok) {
-        toast.success("PDF caricato con successo");
+        toast.success("PDF caricato, elaborazione in corso");
         setAddPdfOpen(false);
         setPdfName("");
         setPdfFile(null);
@@ -190,6 +200,20 @@ export default function KnowledgeBase() {
                     data-testid="url-value-input"
                   />
                 </div>
+                <div className="flex items-center justify-between">
+                  <div className="space-y-0.5">
+                    <Label htmlFor="urlCrawl">Scansiona l'intero catalogo</Label>
+                    <p className="text-sm text-muted-foreground">
+                      Segue sitemap e pagine successive per importare tutti i prodotti
+                    </p>
+                  </div>
+                  <Switch
+                    id="urlCrawl"
+                    checked={urlCrawl}
+                    onCheckedChange={setUrlCrawl}
+                    data-testid="url-crawl-switch"
+                  />
+                </div>
                 <Button type="submit" className="w-full" disabled={submitting} data-testid="submit-url-btn">
                   {submitting ? <span className="spinner mr-2" /> : <Plus className="w-4 h-4 mr-2" />}
                   Aggiungi
@@ -294,11 +318,29 @@ export default function KnowledgeBase() {
                         <p className="text-xs text-muted-foreground mt-1">
                           Aggiunto: {formatDate(source.created_at)}
                         </p>
+                        {source.text_tokens != null && (
+                          <p className="text-xs text-muted-foreground" data-testid={`text-size-${index}`}>
+                            Testo: {(source.text_bytes / 1024).toFixed(1)} KB · {source.text_tokens} token
+                            {source.html_bytes ? ` (pagina ${(source.html_bytes / 1024).toFixed(0)} KB)` : ""}
+                          </p>
+                        )}
+                        {source.pdf_pages != null && (
+                          <p className="text-xs text-muted-foreground" data-testid={`pdf-pages-${index}`}>
+                            {source.pdf_pages} pagine indicizzate
+                            {source.pdf_total_pages > source.pdf_pages ? ` su ${source.pdf_total_pages}` : ""}
+                          </p>
+                        )}
+                        {source.crawl_stats && (
+                          <p className="text-xs text-muted-foreground" data-testid={`crawl-stats-${index}`}>
+                            {source.crawl_stats.pages} pagine · {source.crawl_stats.products} prodotti ·{" "}
+                            {source.crawl_stats.pages_per_sec} pagine/s · {source.crawl_stats.products_per_sec} prodotti/s
+                          </p>
+                        )}
                       </div>
                     </div>
                     <div className="flex items-center gap-2">
-                      <Badge className={source.status === "active" ? "badge-active" : "badge-error"}>
-                        {source.status === "active" ? "Attivo" : "Errore"}
+                      <Badge className={source.status === "error" ? "badge-error" : "badge-active"}>
+                        {source.status === "active" ? "Attivo" : source.status === "processing" ? "In elaborazione" : "Errore"}
                       </Badge>
                       {source.url && (
                         <Button variant="ghost" size="icon" asChild>
@@ -163,15 +163,37 @@ export default function Products() {
         method: "POST"
       });
       if (res.ok) {
-        const data = await res.json();
-        toast.success(data.message);
+        const { job_id } = await res.json();
+        const job = await waitForJob(job_id);
+        if (job.status === "done") {
+          const { products_count, added, updated, removed } = job.result;
+          toast.success(
+            `Scansione completata. ${products_count} prodotti (${added} nuovi, ${updated} aggiornati, ${removed} rimossi).`
+          );
+        } else {
+          toast.error(job.error || "Errore nella scansione");
+        }
         fetchData();
+      } else {
+        const error = await res.json();
+        toast.error(error.detail || "Errore nella scansione");
       }
     } catch (error) {
       toast.error("Errore nella scansione");
     }
   };
 
+  // Rescans run as background jobs: poll until the job finishes, fails or is cancelled
+  const waitForJob = async (jobId) => {
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, 2000));
+      const res = await fetchWithAuth(`${API_URL}/jobs/${jobId}`);
+      if (!res.ok) throw new Error("job status");
+      const job = await res.json();
+      if (["done", "failed", "cancelled"].includes(job.status)) return job;
+    }
+  };
+
   // Filter products
   const filteredProducts = products.filter(p => {
     const matchesSearch = !searchQuery || 